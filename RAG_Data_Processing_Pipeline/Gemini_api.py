@@ -1,16 +1,25 @@
+import copy
+import functools
+import json
 import os
+import queue
 import time
-import google.generativeai as genai
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from dotenv import load_dotenv
-from PyPDF2 import PdfReader
-import pypandoc
-from docx import Document
 from logging_config import setup_logging
-import re
+from chunker import Chunker, estimate_tokens
+from extraction import TextExtraction
+from gemini_scheduler import GeminiError, GeminiScheduler, check_response
+from manifest import RunManifest, document_name
+from metrics import Metrics
+from rate_limiter import RateLimiter
+from render import DEFAULT_TEMPLATE, sanitize_text
+from response_cache import ResponseCache
 import logging
+from typing import TYPE_CHECKING, Iterable, Iterator
 
-# Setup logging
-setup_logging()
+if TYPE_CHECKING:
+    from dedup import NearDuplicateIndex
 
 # System prompt for the generative model
 SYSTEM_PROMPT = """
@@ -39,64 +48,64 @@ EXAMPLE FORMAT:
 Remember, accuracy and readability are key. Do not alter the original content, just improve its organization and presentation.
 """
 
-# Load environment variables and configure API
-load_dotenv("../.env")
-genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-model = genai.GenerativeModel(model_name='gemini-1.5-flash',
-                              system_instruction=SYSTEM_PROMPT)
+MODEL_NAME = 'gemini-1.5-flash'
+GENERATION_CONFIG = {"max_output_tokens": 8192}
+
+# Sent by stream_chunk when a chunk is retried from the start
+RESTART_CHUNK = object()
+
+@functools.lru_cache(maxsize=1)
+def default_model():
+    # google.generativeai takes over a second to import, so it is only loaded once a request is made
+    import google.generativeai as genai
+    genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+    return genai.GenerativeModel(model_name=MODEL_NAME, system_instruction=SYSTEM_PROMPT)
 
 class DocumentProcessor:
-    def __init__(self, input_directory: str, output_directory: str):
+    def __init__(self, input_directory: str, output_directory: str, max_concurrency: int = 1,
+                 rate_limiter: RateLimiter = None, cache: ResponseCache = None, pdf_workers: int = 1,
+                 render_pdf: bool = True, manifest: RunManifest = None, model=None, metrics: Metrics = None,
+                 stream: bool = False, scheduler: GeminiScheduler = None, dedup: "NearDuplicateIndex" = None,
+                 extraction: TextExtraction = None):
         self.input_directory = input_directory
         self.output_directory = output_directory
+        self.max_concurrency = max(1, max_concurrency)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.cache = cache
+        # Text of the input files, from a cache of earlier extractions where there is one
+        self.extraction = extraction or TextExtraction(pdf_workers=pdf_workers)
+        self.render_pdf = render_pdf
+        self.manifest = manifest
+        # Anything with GenerativeModel's generate_content, e.g. the benchmark's fake backend. None uses the
+        # module's model, which is left out of the copy pickled into worker processes
+        self.model = model
+        self.metrics = metrics or Metrics(enabled=False)
+        # Append each response to the markdown file as it arrives instead of writing the document at the end
+        self.stream = stream
+        # Retries and the adaptive cap on Gemini requests in flight, shared by every document of this processor
+        self.scheduler = scheduler or GeminiScheduler(self.max_concurrency, metrics=self.metrics)
+        # Near-duplicates of an already formatted document reuse its markdown instead of going to Gemini
+        self.dedup = dedup
 
     def read_file(self, file_path: str) -> str:
-        if file_path.endswith(".pdf"):
-            return self.read_pdf(file_path)
-        elif file_path.endswith(".rtf"):
-            return self.read_rtf(file_path)
-        elif file_path.endswith(".docx"):
-            return self.read_docx(file_path)
-        elif file_path.endswith(".txt"):
-            return self.read_txt(file_path)
-        else:
-            raise ValueError(f"Unsupported file type: {file_path}")
+        return self.extraction.read_text(file_path)
 
-    def read_pdf(self, file_path: str) -> str:
-        with open(file_path, 'rb') as f:
-            reader = PdfReader(f)
-            return "\n".join(page.extract_text() for page in reader.pages)
+    def iter_text(self, file_path: str) -> Iterator[str]:
+        # Pieces joined with "\n" give exactly what read_file returns
+        return self.extraction.iter_text(file_path)
 
-    def read_rtf(self, file_path: str) -> str:
-        return pypandoc.convert_file(file_path, 'plain')
+    def source_hash(self, file_path: str) -> str:
+        return self.extraction.content_hash(file_path)
 
-    def read_docx(self, file_path: str) -> str:
-        doc = Document(file_path)
-        return "\n".join(para.text for para in doc.paragraphs)
-
-    def read_txt(self, file_path: str) -> str:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read()
+    def chunk_text_stream(self, pieces: Iterable[str], max_tokens: int = 8000, overlap: int = 20) -> Iterator[str]:
+        # Same chunks as chunk_text on "\n".join(pieces), but only about one chunk of text is held at a time
+        return Chunker(max_tokens, overlap).iter_chunks(pieces)
 
     def chunk_text(self, text: str, max_tokens: int = 8000, overlap: int = 20) -> list:
-        words = text.split()
-        chunks = []
-        start = 0
-
-        print(f"Started chunking with: {len(words)} words. Start: {start}")
-
-        while start < len(words):
-            end = start + max_tokens
-            if end > len(words):
-                end = len(words)
-            chunk = " ".join(words[start:end])
-            chunks.append(chunk)
-            start = end - overlap if end < len(words) else end
+        return Chunker(max_tokens, overlap).chunk_text(text)
 
-        return chunks
-
-    def generate_content(self, content: str, is_first_chunk: bool, is_last_chunk: bool) -> str:
-        context = f"""
+    def build_context(self, content: str, is_first_chunk: bool, is_last_chunk: bool) -> str:
+        return f"""
 ADDITIONAL INSTRUCTIONS:
 {'This is the beginning of the transcript.' if is_first_chunk else 'This is a continuation of the transcript.'}
 {'This is the end of the transcript.' if is_last_chunk else 'The transcript continues after this chunk.'}
@@ -105,72 +114,406 @@ Ensure your formatting is consistent with previous and following chunks.
 Here is the transcript chunk:
 {content}
 """
-        try:
-            response = model.generate_content(
+
+    def request_content(self, context: str, input_tokens: int, stream: bool = False):
+        with self.metrics.timer("gemini_rate_limit_wait_seconds"):
+            self.rate_limiter.acquire(input_tokens)
+        if stream:
+            return (self.model or default_model()).generate_content(
                 contents=context,
-                generation_config=genai.types.GenerationConfig(max_output_tokens=8192)
+                generation_config=dict(GENERATION_CONFIG),
+                stream=True
+            )
+        with self.metrics.timer("gemini_request_seconds"):
+            return (self.model or default_model()).generate_content(
+                contents=context,
+                generation_config=dict(GENERATION_CONFIG)
             )
 
-            # Log the response for debugging
-            logging.info(f"API response: {response}")
+    def split_chunk(self, content: str) -> list:
+        # Two or more smaller pieces of a chunk whose formatted output didn't fit in max_output_tokens
+        pieces = Chunker(estimate_tokens(content) // 2 + 1, 0).chunk_text(content)
+        return pieces if len(pieces) > 1 else None
 
-            if not response.candidates or not response.candidates[0].content.parts:
-                logging.error("Unexpected API response format or empty response.")
-                return ""
+    def record_usage(self, response, input_tokens: int, text: str) -> None:
+        if self.metrics.enabled:
+            # Use the token counts Gemini reports when it does, our estimate otherwise
+            usage = getattr(response, 'usage_metadata', None)
+            self.metrics.inc("gemini_requests_total", status="ok")
+            self.metrics.inc("gemini_input_tokens_total", getattr(usage, 'prompt_token_count', None) or input_tokens)
+            self.metrics.inc("gemini_output_tokens_total",
+                             getattr(usage, 'candidates_token_count', None) or estimate_tokens(text))
 
-            return response.candidates[0].content.parts[0].text.strip()
-        except Exception as e:
-            logging.error(f"Error in generate_content: {e}")
-            return ""
+    def generate_content(self, content: str, is_first_chunk: bool, is_last_chunk: bool) -> str:
+        # Transient errors are retried by the scheduler; anything left is raised so a failed chunk can't turn
+        # into a silently empty section
+        context = self.build_context(content, is_first_chunk, is_last_chunk)
+        cache_key = None
+        if self.cache:
+            cache_key = ResponseCache.make_key(MODEL_NAME, SYSTEM_PROMPT, is_first_chunk, is_last_chunk,
+                                               GENERATION_CONFIG, content)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self.metrics.inc("gemini_cache_hits_total")
+                return cached
+
+        input_tokens = estimate_tokens(context)
+        try:
+            response = self.scheduler.call(lambda: self.request_content(context, input_tokens))
+            # Formatting the whole response is expensive, so it is only logged when debugging
+            logging.debug("API response: %s", response)
+            text = response.candidates[0].content.parts[0].text.strip()
+            if not text:
+                raise GeminiError("empty", "Empty response from Gemini")
+        except GeminiError as e:
+            self.metrics.inc("gemini_requests_total", status=e.kind)
+            pieces = self.split_chunk(content) if e.kind == "truncated" else None
+            if not pieces:
+                logging.error(f"Gemini request failed ({e.kind}): {e}")
+                raise
+            logging.warning(f"Gemini output hit max_output_tokens, formatting the chunk as {len(pieces)} pieces")
+            text = "\n".join(self.generate_content(piece, is_first_chunk and i == 0, is_last_chunk and i == len(pieces) - 1)
+                             for i, piece in enumerate(pieces))
+        else:
+            self.record_usage(response, input_tokens, text)
+
+        if self.cache:
+            self.cache.put(cache_key, text)
+        return text
+
+    def generate_content_stream(self, content: str, is_first_chunk: bool, is_last_chunk: bool) -> Iterator[str]:
+        # Yields the response text as Gemini streams it. Errors are raised as they are, stream_chunk decides
+        # whether to retry
+        context = self.build_context(content, is_first_chunk, is_last_chunk)
+        cache_key = None
+        if self.cache:
+            cache_key = ResponseCache.make_key(MODEL_NAME, SYSTEM_PROMPT, is_first_chunk, is_last_chunk,
+                                               GENERATION_CONFIG, content)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self.metrics.inc("gemini_cache_hits_total")
+                yield cached
+                return
+
+        input_tokens = estimate_tokens(context)
+        response = self.request_content(context, input_tokens, stream=True)
+        started = time.perf_counter()
+        pieces = []
+        part = None
+        for part in response:
+            check_response(part, require_content=False)
+            text = part.text
+            if not pieces:
+                self.metrics.observe("gemini_first_byte_seconds", time.perf_counter() - started)
+            pieces.append(text)
+            yield text
+        self.metrics.observe("gemini_request_seconds", time.perf_counter() - started)
+
+        text = "".join(pieces).strip()
+        if not text:
+            raise GeminiError("empty", "Empty response from Gemini")
+        self.record_usage(part, input_tokens, text)
+        if self.cache:
+            self.cache.put(cache_key, text)
 
     def sanitize_text(self, text: str) -> str:
-        return re.sub(r'[^\x00-\x7F]+', '', text)
+        return sanitize_text(text)
 
     def convert_markdown_to_pdf(self, markdown_content: str, output_file: str) -> None:
-        custom_template = os.path.abspath(r"C:\Users\kamdy\Desktop\CultureX\github\RAG_Data_Processing_Pipeline\custom-template.tex")
+        import pypandoc
+        custom_template = DEFAULT_TEMPLATE
         sanitized_content = self.sanitize_text(markdown_content)
         try:
-            pypandoc.convert_text(sanitized_content, 'pdf', format='md', outputfile=output_file,
-                                extra_args=[f'--template={custom_template}'])
+            with self.metrics.timer("render_seconds"):
+                pypandoc.convert_text(sanitized_content, 'pdf', format='md', outputfile=output_file,
+                                    extra_args=[f'--template={custom_template}'])
         except Exception as e:
             logging.error(f"Error converting Markdown to PDF: {e}")
         
-    def process_file(self, file_path: str) -> None:
-        print(f"Processing {file_path}")
-        content = self.read_file(file_path)
-        print(f"Read content from {file_path}")
-        chunks = self.chunk_text(content)
-        print(f"Split content into {len(chunks)} chunks")
-        formatted_content = []
-
-        for i, chunk in enumerate(chunks):
-            is_first_chunk = (i == 0)
-            is_last_chunk = (i == len(chunks) - 1)
-            print(f"Started processing chunk {i}")
-            formatted_chunk = self.generate_content(chunk, is_first_chunk, is_last_chunk)
-            print(f"generate content ran on chunk {i}")
-            formatted_content.append(formatted_chunk)
-            print(f"Processed chunk {i+1}/{len(chunks)}")
-            time.sleep(2)  # To avoid hitting API rate limits
+    def format_chunk(self, chunks: list, i: int) -> str:
+        is_first_chunk = (i == 0)
+        is_last_chunk = (i == len(chunks) - 1)
+        logging.debug(f"Started processing chunk {i}")
+        formatted_chunk = self.generate_content(chunks[i], is_first_chunk, is_last_chunk)
+        logging.debug(f"Processed chunk {i+1}/{len(chunks)}")
+        return formatted_chunk
+
+    def format_chunks(self, chunks: list) -> list:
+        if self.max_concurrency == 1 or len(chunks) < 2:
+            return [self.format_chunk(chunks, i) for i in range(len(chunks))]
+
+        # Keep up to max_concurrency requests in flight; the shared rate limiter does the pacing
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(chunks))) as executor:
+            futures = [executor.submit(self.format_chunk, chunks, i) for i in range(len(chunks))]
+            # Collect in submission order so the markdown matches the sequential output
+            return [future.result() for future in futures]
+
+    def output_paths(self, file_path: str) -> tuple:
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        return (os.path.join(self.output_directory, f"{name}_processed.md"),
+                os.path.join(self.output_directory, f"{name}_processed.pdf"))
+
+    def already_formatted(self, file_path: str) -> dict:
+        # Manifest entry of an earlier run that formatted this exact source, if its markdown is still there
+        if not self.manifest:
+            return None
+        formatted = self.manifest.get(document_name(file_path), "formatted")
+        if not formatted or not os.path.exists(self.formatted_path(file_path, formatted)):
+            return None
+        return formatted if formatted["input_hash"] == self.source_hash(file_path) else None
+
+    def formatted_path(self, file_path: str, formatted: dict) -> str:
+        # A near-duplicate's markdown is the one it was matched to
+        return formatted["info"].get("duplicate_of") or self.output_paths(file_path)[0]
+
+    def mark_formatted(self, file_path: str, source_hash: str, chunks: int) -> None:
+        if self.manifest:
+            self.manifest.mark_done(document_name(file_path), "formatted", source_hash, chunks=chunks)
+        if self.dedup:
+            self.dedup.mark_formatted(self.output_paths(file_path)[0])
+
+    def reuse_duplicate(self, file_path: str, chunks: list) -> str:
+        # Markdown of an already formatted near-duplicate of this document, recorded as its formatted output.
+        # Otherwise the document is registered, to become a match for others once it is formatted
+        if not self.dedup or not self.manifest:
+            return None
+        markdown_output_path = self.output_paths(file_path)[0]
+        signature = self.dedup.signature(chunks)
+        if signature is None:
+            return None
+        match = self.dedup.find(signature, exclude=markdown_output_path)
+        if not match or not os.path.exists(match["markdown_path"]):
+            self.dedup.add(markdown_output_path, signature, len(chunks))
+            return None
+        logging.info(f"{os.path.basename(file_path)} is a near-duplicate ({match['similarity']:.0%} similar) of "
+                     f"{match['markdown_path']}, reusing its formatted output")
+        self.manifest.mark_done(document_name(file_path), "formatted", self.source_hash(file_path), chunks=0,
+                                duplicate_of=match["markdown_path"], chunks_saved=len(chunks))
+        self.metrics.inc("documents_deduplicated_total")
+        self.metrics.inc("chunks_saved_total", len(chunks))
+        return match["markdown_path"]
+
+    def extract_chunks(self, file_path: str) -> list:
+        source = "cache" if self.extraction.is_cached(file_path) else "extractor"
+        with self.metrics.timer("extract_seconds", format=os.path.splitext(file_path)[1].lstrip('.'), source=source):
+            chunks = list(self.chunk_text_stream(self.iter_text(file_path)))
+        logging.info(f"Split {os.path.basename(file_path)} into {len(chunks)} chunks")
+        self.metrics.inc("chunks_total", len(chunks))
+        self.metrics.observe("document_input_tokens", sum(estimate_tokens(chunk) for chunk in chunks))
+        if self.manifest:
+            self.manifest.mark_done(document_name(file_path), "extracted", self.source_hash(file_path), chunks=len(chunks))
+        return chunks
+
+    def write_formatted(self, file_path: str, chunks: list) -> str:
+        if self.stream:
+            return self.write_formatted_stream(file_path, chunks)
+        markdown_output_path, pdf_output_path = self.output_paths(file_path)
+        formatted_content = self.format_chunks(chunks)
 
         full_formatted_content = "\n".join(formatted_content)
-        markdown_output_path = os.path.join(self.output_directory, f"{os.path.splitext(os.path.basename(file_path))[0]}_processed.md")
-        pdf_output_path = os.path.join(self.output_directory, f"{os.path.splitext(os.path.basename(file_path))[0]}_processed.pdf")
 
         # Save the Markdown content
         with open(markdown_output_path, 'w', encoding='utf-8') as f:
             f.write(full_formatted_content)
 
-        # Convert Markdown to PDF
-        self.convert_markdown_to_pdf(full_formatted_content, pdf_output_path)
+        # A chunk that fails raises out of format_chunks, so every chunk has been formatted by now
+        self.mark_formatted(file_path, self.source_hash(file_path), len(chunks))
 
-        print(f"Completed processing {file_path}")
+        # Convert Markdown to PDF, unless a separate render stage takes care of it
+        if self.render_pdf:
+            self.convert_markdown_to_pdf(full_formatted_content, pdf_output_path)
+        return markdown_output_path
 
-    def run(self) -> None:
-        for filename in os.listdir(self.input_directory):
-            file_path = os.path.join(self.input_directory, filename)
-            if filename.endswith((".pdf", ".rtf", ".docx", ".txt")):
-                self.process_file(file_path)
+    def load_progress(self, progress_path: str) -> dict:
+        try:
+            with open(progress_path, 'r') as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError):
+            return None
+
+    def save_progress(self, progress_path: str, progress: dict) -> None:
+        tmp_path = f"{progress_path}.tmp"
+        with open(tmp_path, 'w') as json_file:
+            json.dump(progress, json_file)
+        os.replace(tmp_path, progress_path)
+
+    def stream_chunk(self, chunks: list, i: int, pieces: queue.Queue) -> None:
+        # Producer side of write_formatted_stream: text pieces, then None, or the exception that stopped the chunk.
+        # RESTART_CHUNK tells the writer to drop what it has of this chunk before a retry
+        attempt = 0
+        while True:
+            try:
+                with self.scheduler.slot():
+                    for piece in self.generate_content_stream(chunks[i], i == 0, i == len(chunks) - 1):
+                        pieces.put(piece)
+                self.scheduler.record_success()
+                pieces.put(None)
+                return
+            except Exception as e:
+                if isinstance(e, GeminiError) and e.kind == "truncated":
+                    # Output too long for one response: fall back to formatting the chunk in smaller pieces
+                    pieces.put(RESTART_CHUNK)
+                    try:
+                        pieces.put(self.generate_content(chunks[i], i == 0, i == len(chunks) - 1))
+                        pieces.put(None)
+                    except Exception as fallback_error:
+                        pieces.put(fallback_error)
+                    return
+                delay = self.scheduler.retry_delay(e, attempt)
+                if delay is None:
+                    self.metrics.inc("gemini_requests_total", status=getattr(e, 'kind', 'error'))
+                    pieces.put(e)
+                    return
+                pieces.put(RESTART_CHUNK)
+            time.sleep(delay)
+            attempt += 1
+
+    def write_formatted_stream(self, file_path: str, chunks: list) -> str:
+        # Writes the same markdown as write_formatted, but each chunk goes to disk as it streams in. The
+        # .progress.json sidecar records how many chunks are complete and where they end, so a crashed or
+        # failed document resumes from its last complete chunk
+        markdown_output_path, pdf_output_path = self.output_paths(file_path)
+        progress_path = f"{markdown_output_path}.progress.json"
+        source_hash = self.source_hash(file_path)
+        progress = self.load_progress(progress_path)
+        if not (progress and progress["source_hash"] == source_hash and progress["chunks"] == len(chunks)
+                and os.path.exists(markdown_output_path)):
+            progress = {"source_hash": source_hash, "chunks": len(chunks), "completed": 0, "offset": 0}
+        elif progress["completed"]:
+            logging.info(f"Resuming {file_path} at chunk {progress['completed'] + 1}/{len(chunks)}")
+
+        queues = {i: queue.Queue() for i in range(progress["completed"], len(chunks))}
+        with open(markdown_output_path, 'r+b' if progress["offset"] else 'wb') as f, \
+                ThreadPoolExecutor(max_workers=max(1, min(self.max_concurrency, len(queues)))) as executor:
+            # Anything past the last complete chunk is a partial response from the interrupted run
+            f.truncate(progress["offset"])
+            f.seek(progress["offset"])
+            for i, pieces in queues.items():
+                executor.submit(self.stream_chunk, chunks, i, pieces)
+
+            for i, pieces in queues.items():
+                # Chunks are joined with newlines and each response is stripped, as in write_formatted;
+                # trailing whitespace is held back until more text follows it
+                if i:
+                    f.write(b"\n")
+                chunk_start = f.tell()
+                pending = ""
+                started = False
+                while True:
+                    piece = pieces.get()
+                    if piece is None:
+                        break
+                    if piece is RESTART_CHUNK:
+                        f.truncate(chunk_start)
+                        f.seek(chunk_start)
+                        pending = ""
+                        started = False
+                        continue
+                    if isinstance(piece, Exception):
+                        f.truncate(progress["offset"])
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        raise RuntimeError(f"Chunk {i + 1}/{len(chunks)} of {file_path} failed, "
+                                           f"kept {progress['completed']} complete chunks: {piece}")
+                    text = pending + piece if started else piece.lstrip()
+                    if not text:
+                        continue
+                    started = True
+                    stripped = text.rstrip()
+                    pending = text[len(stripped):]
+                    f.write(stripped.encode('utf-8'))
+                    f.flush()
+
+                progress.update(completed=i + 1, offset=f.tell())
+                self.save_progress(progress_path, progress)
+                logging.debug(f"Processed chunk {i + 1}/{len(chunks)}")
+
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+        self.mark_formatted(file_path, source_hash, len(chunks))
+        if self.render_pdf:
+            with open(markdown_output_path, 'r', encoding='utf-8') as f:
+                self.convert_markdown_to_pdf(f.read(), pdf_output_path)
+        return markdown_output_path
+
+    def process_file(self, file_path: str) -> int:
+        logging.info(f"Processing {file_path}")
+        formatted = self.already_formatted(file_path)
+        if formatted:
+            logging.info(f"Skipping {file_path}, already formatted in an earlier run")
+            self.metrics.inc("documents_skipped_total")
+            return formatted["info"].get("chunks", 0)
+
+        chunks = self.extract_chunks(file_path)
+        if self.reuse_duplicate(file_path, chunks):
+            return 0
+        with self.metrics.timer("document_format_seconds"):
+            self.write_formatted(file_path, chunks)
+
+        logging.info(f"Completed processing {file_path}")
+        return len(chunks)
+
+    def process_file_with_summary(self, file_path: str, collect_metrics: bool = False) -> dict:
+        started = time.perf_counter()
+        summary = {"file": os.path.basename(file_path), "success": False, "chunks": 0, "duration": 0.0, "error": None,
+                   "cache_hits": 0, "cache_misses": 0}
+        cache_before = self.cache.stats() if self.cache else None
+        try:
+            summary["chunks"] = self.process_file(file_path)
+            summary["success"] = True
+        except Exception as e:
+            logging.error(f"Error processing {file_path}: {e}")
+            summary["error"] = str(e)
+        summary["duration"] = time.perf_counter() - started
+        self.metrics.inc("documents_total", status="ok" if summary["success"] else "failed")
+        self.metrics.observe("document_seconds", summary["duration"])
+        if collect_metrics:
+            # Run in a worker process: hand this document's metrics back to the parent
+            summary["metrics"] = self.metrics.drain()
+        if self.cache:
+            cache_after = self.cache.stats()
+            summary["cache_hits"] = cache_after["hits"] - cache_before["hits"]
+            summary["cache_misses"] = cache_after["misses"] - cache_before["misses"]
+        return summary
+
+    def list_input_files(self, largest_first: bool = False) -> list:
+        # The youtube_links_<date>.txt list written by the fetch stage is not a document
+        file_paths = [os.path.join(self.input_directory, filename) for filename in os.listdir(self.input_directory)
+                      if filename.lower().endswith(self.extraction.extensions()) and not filename.startswith("youtube_links_")]
+        return sorted(file_paths, key=os.path.getsize, reverse=largest_first)
+
+    def run(self, workers: int = 1, document_concurrency: int = 1) -> list:
+        # In-process, shortest documents first, which minimises the mean time until a document is done. Across
+        # worker processes, largest files first so one huge PDF doesn't end up as the tail of a parallel run
+        parallel = workers > 1
+        file_paths = self.list_input_files(largest_first=parallel)
+        if not parallel or len(file_paths) < 2:
+            if document_concurrency <= 1:
+                return [self.process_file_with_summary(file_path) for file_path in file_paths]
+            # Several documents share the scheduler's request slots, so one backing off doesn't hold up the rest
+            with ThreadPoolExecutor(max_workers=document_concurrency) as executor:
+                return list(executor.map(self.process_file_with_summary, file_paths))
+
+        workers = min(workers, len(file_paths))
+        # The copy is pickled into each worker process, rate limiter and cache are rebuilt there
+        worker_processor = copy.copy(self)
+        worker_processor.rate_limiter = self.rate_limiter.split(workers)
+        # Files are already spread across processes, don't fan out again per PDF
+        worker_processor.extraction = self.extraction.with_pdf_workers(1)
+        results = {}
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(worker_processor.process_file_with_summary, file_path, self.metrics.enabled): file_path
+                       for file_path in file_paths}
+            for future in as_completed(futures):
+                file_path = futures[future]
+                try:
+                    results[file_path] = future.result()
+                    self.metrics.merge(results[file_path].pop("metrics", None))
+                except Exception as e:
+                    # The worker process itself died, e.g. out of memory on a huge PDF
+                    logging.error(f"Worker failed on {file_path}: {e}")
+                    results[file_path] = {"file": os.path.basename(file_path), "success": False, "chunks": 0,
+                                          "duration": 0.0, "error": str(e), "cache_hits": 0, "cache_misses": 0}
+        return [results[file_path] for file_path in file_paths]
 
 def main():
     input_folder_path = os.path.abspath(r"C:\Users\kamdy\Desktop\CultureX\github\RAG_Data_Processing_Pipeline\Data\test")
@@ -180,4 +523,6 @@ def main():
     processor.run()
 
 if __name__ == "__main__":
+    load_dotenv("../.env")
+    setup_logging()
     main()
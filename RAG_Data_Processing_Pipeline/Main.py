@@ -1,22 +1,46 @@
+import time
+
+# Taken before any other import, so the startup time main logs includes them
+STARTED = time.perf_counter()
+
 import json
 import os
 import datetime
 import logging
+import sys
 from dotenv import load_dotenv
 import argparse
+from typing import TYPE_CHECKING
 from logging_config import setup_logging
-from langchain_community.document_loaders import YoutubeLoader
-from Zotero_RAG import ZoteroClient, ZoteroContentHandler
-from Gemini_api import DocumentProcessor
-from zotero_attach import ZoteroAttacher
-from tests.document_length_test import DocumentLengthTest
-import re
-
-# Load environment variables
-load_dotenv("../.env")
-
-def create_folders(base_path: str) -> tuple:
-    current_date = datetime.datetime.now().strftime("%Y-%m-%d")
+from rate_limiter import RateLimiter, DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_TOKENS_PER_MINUTE
+from response_cache import ResponseCache, DEFAULT_CACHE_MAX_BYTES
+from manifest import RunManifest, document_name, file_hash
+from metrics import Metrics
+from item_store import ItemStore
+
+# Stage modules are imported by the functions that run them, so a single stage doesn't pay for the others'
+# dependencies (google.generativeai, pyzotero, pypandoc, numpy, ...)
+if TYPE_CHECKING:
+    from Zotero_RAG import ZoteroContentHandler
+    from dedup import NearDuplicateIndex
+    from extraction import TextExtraction
+    from retrieval_index import RetrievalIndex
+    from target_scheduler import Target
+
+# Pipeline stages in the order main runs them
+STAGES = ['fetch', 'transcripts', 'format', 'index', 'render', 'attach', 'validate']
+STAGE_HELP = {
+    'fetch': 'Store the Zotero items, download their attachments and write the YouTube links.',
+    'transcripts': 'Fetch the transcripts of the YouTube links.',
+    'format': 'Format the documents with Gemini into markdown.',
+    'index': 'Add the formatted markdown to the section retrieval index.',
+    'render': 'Render the markdown to PDF.',
+    'attach': 'Attach the PDFs of YouTube transcripts to their Zotero items.',
+    'validate': 'Check every formatted document against its input.',
+}
+
+def create_folders(base_path: str, run_date: str = None) -> tuple:
+    current_date = run_date or datetime.datetime.now().strftime("%Y-%m-%d")
     input_folder_name = f"input_{current_date}"
     output_folder_name = f"output_{current_date}"
     input_folder_path = os.path.join(base_path, input_folder_name)
@@ -25,101 +49,688 @@ def create_folders(base_path: str) -> tuple:
     os.makedirs(output_folder_path, exist_ok=True)
     return input_folder_path, output_folder_path
 
-def initialize_zotero_client(input_folder_path: str) -> ZoteroContentHandler:
-    zotero_client = ZoteroClient(os.getenv('ZOTERO_API_KEY'), os.getenv('GROUP_ID'))
+def initialize_zotero_client(input_folder_path: str, sync_state_path: str = None,
+                             metrics: Metrics = None, item_store: ItemStore = None) -> "ZoteroContentHandler":
+    from Zotero_RAG import ZoteroClient, ZoteroContentHandler
+    zotero_client = ZoteroClient(os.getenv('ZOTERO_API_KEY'), os.getenv('GROUP_ID'), metrics=metrics)
     logging.info("Zotero client initialized.")
-    zotero_content_handler = ZoteroContentHandler(input_folder_path, zotero_client)
+    zotero_content_handler = ZoteroContentHandler(input_folder_path, zotero_client, sync_state_path,
+                                                  item_store=item_store)
     logging.info("Zotero content handler initialized.")
     return zotero_content_handler
 
-def process_zotero_items(zotero_content_handler: ZoteroContentHandler, input_folder_path: str, collection_id: str = None) -> None:
+def process_zotero_items(zotero_content_handler: "ZoteroContentHandler", input_folder_path: str, collection_id: str = None,
+                         incremental: bool = False) -> None:
     if collection_id:
-        zotero_content_handler.handle_items(input_folder_path, collection_id)
+        zotero_content_handler.handle_items(input_folder_path, collection_id, incremental)
         logging.info("Zotero items from collection have been processed.")
     else:
-        zotero_content_handler.handle_all_items(input_folder_path)
+        zotero_content_handler.handle_all_items(input_folder_path, incremental)
         logging.info("All Zotero items have been processed.")
 
-def process_youtube_links(input_folder_path: str, youtube_links_filename: str) -> None:
+def process_youtube_links(input_folder_path: str, youtube_links_filename: str, cache_dir: str = None,
+                          max_workers: int = 4, item_store: ItemStore = None) -> list:
     youtube_links_file_path = os.path.join(input_folder_path, youtube_links_filename)
     if os.path.exists(youtube_links_file_path):
         with open(youtube_links_file_path, 'r') as file:
             youtube_links = file.readlines()
 
         logging.info(f"Found {len(youtube_links)} YouTube links to process.")
-        for url in youtube_links:
-            url = url.strip()
-            loader = YoutubeLoader.from_youtube_url(url, add_video_info=True)
-            documents = loader.load()
-            for doc in documents:
-                sanitized_title = sanitize_filename(doc.metadata.get('title', 'untitled'))
-                with open(os.path.join(input_folder_path, f"{sanitized_title}.txt"), 'w', encoding='utf-8') as f:
-                    f.write(doc.page_content)
-            logging.info(f"Processed YouTube video: {url}")
+        from transcripts import TranscriptFetcher, extract_video_id
+        fetcher = TranscriptFetcher(cache_dir or os.path.join(input_folder_path, "transcript_cache"), max_workers=max_workers)
+        # Transcripts are written as the documents the item store named for the video's items
+        names = {link.strip(): item_store.documents_for_url(link.strip()) for link in youtube_links} if item_store else None
+        results = fetcher.fetch_all(youtube_links, input_folder_path, names)
+        if item_store:
+            # Transcripts that failed are fetched again with the next sync
+            failed = {result["video_id"] for result in results if result["status"] == "failed"}
+            for url, documents in names.items():
+                item_store.set_failed(documents, extract_video_id(url) in failed)
+        for result in results:
+            if result["status"] in ("failed", "invalid"):
+                logging.warning(f"YouTube video {result['video_id'] or result.get('url')} {result['status']}: {result['error']}")
+        return results
     else:
         logging.warning(f"YouTube links file not found: {youtube_links_file_path}")
+        return []
+
+def process_documents_with_gemini(input_folder_path: str, output_folder_path: str, max_concurrency: int = 1,
+                                  rate_limiter: RateLimiter = None, workers: int = 1,
+                                  cache: ResponseCache = None, manifest: RunManifest = None,
+                                  metrics: Metrics = None, stream: bool = False, document_concurrency: int = 1,
+                                  dedup: "NearDuplicateIndex" = None, extraction: "TextExtraction" = None) -> list:
+    from Gemini_api import DocumentProcessor
+    # PDFs are rendered afterwards by render_documents so LaTeX stays off the Gemini critical path
+    processor = DocumentProcessor(input_folder_path, output_folder_path, max_concurrency, rate_limiter, cache,
+                                  render_pdf=False, manifest=manifest, metrics=metrics, stream=stream, dedup=dedup,
+                                  extraction=extraction)
+    results = processor.run(workers, document_concurrency)
+    for result in results:
+        if result["success"]:
+            logging.info(f"Processed {result['file']}: {result['chunks']} chunks in {result['duration']:.1f}s")
+        else:
+            logging.warning(f"Failed to process {result['file']} after {result['duration']:.1f}s: {result['error']}")
+    failed = sum(1 for result in results if not result["success"])
+    logging.info(f"All documents have been processed by DocumentProcessor ({len(results) - failed} succeeded, {failed} failed).")
+    if cache:
+        hits = sum(result["cache_hits"] for result in results)
+        misses = sum(result["cache_misses"] for result in results)
+        logging.info(f"Gemini response cache: {hits} hits, {misses} misses.")
+    return results
+
+def text_extraction(base_path: str) -> "TextExtraction":
+    # Extracted text is cached next to the dated folders, so a rerun or a later validation never re-reads a PDF
+    from extraction import TextExtraction
+    return TextExtraction(os.path.join(base_path, "text_cache"))
+
+def log_extraction_times(metrics: Metrics) -> None:
+    for histogram in metrics.report()["histograms"]:
+        if histogram["name"] == "extract_seconds":
+            labels = histogram["labels"]
+            logging.info(f"Extracted {histogram['count']} {labels.get('format')} files from the {labels.get('source')} "
+                         f"in {histogram['sum']:.1f}s (p50 {histogram['p50']:.3f}s, max {histogram['max']:.3f}s)")
+
+def input_files(input_folder_path: str) -> list:
+    return sorted(filename for filename in os.listdir(input_folder_path)
+                  if filename.endswith((".pdf", ".rtf", ".docx", ".txt")) and not filename.startswith("youtube_links_"))
+
+def record_duplicates(input_folder_path: str, manifest: RunManifest, item_store: ItemStore) -> dict:
+    # Points the item store's entry of every document formatted as a near-duplicate at the markdown it reuses,
+    # so index, attach and validate pick that up for its parent item
+    stats = {"documents": 0, "chunks_saved": 0}
+    for filename in input_files(input_folder_path):
+        formatted = manifest.get(document_name(filename), "formatted")
+        duplicate_of = formatted and formatted["info"].get("duplicate_of")
+        item_store.set_duplicate(document_name(filename), duplicate_of or None)
+        if duplicate_of:
+            stats["documents"] += 1
+            stats["chunks_saved"] += formatted["info"].get("chunks_saved", 0)
+    logging.info(f"Near-duplicate detection: {stats['documents']} documents reused an earlier formatted output, "
+                 f"{stats['chunks_saved']} chunks not sent to Gemini.")
+    return stats
+
+def duplicate_outputs(input_folder_path: str, item_store: ItemStore) -> dict:
+    # Document name -> markdown reused from the document it duplicates, for the documents of this run
+    outputs = {}
+    for filename in input_files(input_folder_path):
+        document = item_store.document(document_name(filename))
+        if document and document["duplicate_of"]:
+            outputs[document["document"]] = document["duplicate_of"]
+    return outputs
+
+def render_documents(output_folder_path: str, render_workers: int = 4, manifest: RunManifest = None,
+                     metrics: Metrics = None) -> list:
+    from render import MarkdownRenderer
+    renderer = MarkdownRenderer(max_workers=render_workers, metrics=metrics)
+    results = renderer.render_directory(output_folder_path)
+    if manifest:
+        for result in results:
+            if result["status"] != "failed":
+                manifest.mark_done(document_name(result["file"]), "rendered", result["markdown_hash"])
+    return results
+
+def record_downloads(input_folder_path: str, manifest: RunManifest) -> None:
+    for filename in input_files(input_folder_path):
+        file_path = os.path.join(input_folder_path, filename)
+        manifest.mark_done(document_name(filename), "downloaded", file_hash(file_path))
+
+def index_documents(input_folder_path: str, output_folder_path: str, index_dir: str, item_store: ItemStore,
+                    manifest: RunManifest = None, metrics: Metrics = None) -> dict:
+    from retrieval_index import RetrievalIndex
+    metrics = metrics or Metrics(enabled=False)
+    index = RetrievalIndex(index_dir)
+
+    stats = {"indexed": 0, "skipped": 0, "removed": 0, "sections": 0}
+    stats["removed"] = remove_deleted_documents(index, item_store)
 
-def process_documents_with_gemini(input_folder_path: str, output_folder_path: str) -> None:
-    processor = DocumentProcessor(input_folder_path, output_folder_path)
-    processor.run()
-    logging.info("All documents have been processed by DocumentProcessor.")
+    # Near-duplicates are indexed under their own parent item, from the markdown they reuse
+    markdown_paths = {document_name(filename): os.path.join(output_folder_path, filename)
+                      for filename in sorted(os.listdir(output_folder_path)) if filename.endswith("_processed.md")}
+    markdown_paths.update(duplicate_outputs(input_folder_path, item_store))
+    for document, markdown_path in markdown_paths.items():
+        item_info = item_store.document(document)
+        if not item_info:
+            logging.warning(f"No parent item ID found for {document}, not indexed")
+            continue
+        if not os.path.exists(markdown_path):
+            continue
+        markdown_hash = file_hash(markdown_path)
+        if manifest and manifest.is_done(document, "indexed", markdown_hash):
+            stats["skipped"] += 1
+            continue
+        with metrics.timer("index_seconds"):
+            with open(markdown_path, 'r', encoding='utf-8') as markdown_file:
+                sections = index.add_document(item_info["parent_item_id"], document, markdown_file.read())
+        metrics.inc("sections_indexed_total", sections)
+        stats["indexed"] += 1
+        stats["sections"] += sections
+        if manifest:
+            manifest.mark_done(document, "indexed", markdown_hash, parent_item_id=item_info["parent_item_id"],
+                               sections=sections)
+    logging.info(f"Retrieval index: {stats['indexed']} documents indexed ({stats['sections']} sections), "
+                 f"{stats['skipped']} unchanged, {stats['removed']} sections of deleted items removed.")
+    return stats
 
-def sanitize_filename(filename: str) -> str:
-    return re.sub(r'[\\/*?:"<>|]', "_", filename).replace(" ", "").replace(",", "").replace("'", "").replace(".", "")
+def remove_deleted_documents(index: "RetrievalIndex", item_store: ItemStore) -> int:
+    # Sections of documents whose item or parent item was deleted from Zotero leave the index. A deleted
+    # attachment only takes its own document's sections, not the ones its parent has from other attachments
+    deleted = item_store.deleted_documents()
+    removed = sum(index.remove(document["parent_item_id"], document["document"]) for document in deleted)
+    item_store.forget_documents(document["document"] for document in deleted)
+    return removed
 
-def attach_pdfs_to_zotero_items(output_folder_path: str, parent_mapping_path: str) -> None:
+def attach_pdfs_to_zotero_items(input_folder_path: str, output_folder_path: str, item_store: ItemStore,
+                                manifest: RunManifest = None, attach_workers: int = 4, metrics: Metrics = None) -> None:
+    from zotero_attach import ZoteroAttacher
     zotero_api_key = os.getenv('ZOTERO_API_KEY')
     zotero_group_id = os.getenv('GROUP_ID')
-    attacher = ZoteroAttacher(zotero_api_key, zotero_group_id)
-
-    with open(parent_mapping_path, 'r') as json_file:
-        parent_item_mapping = json.load(json_file)
-
-    # Iterate over the processed PDFs and attach them to Zotero items
-    for filename in os.listdir(output_folder_path):
-        if filename.endswith("_processed.pdf"):
-            sanitized_filename = sanitize_filename(os.path.splitext(filename)[0])
-            pdf_file_path = os.path.join(output_folder_path, filename)
-
-            # Debug logs to check the filenames and sanitized versions
-            logging.debug(f"Original filename: {filename}")
-            logging.debug(f"Sanitized filename: {sanitized_filename}_processed.pdf")
-            
-            item_info = parent_item_mapping.get(f"{sanitized_filename}.pdf")
-            if not item_info:
-                item_info = parent_item_mapping.get(f"{sanitized_filename}_processed.pdf")
-                
-            if item_info:
-                parent_item_id = item_info["parent_item_id"]
-                is_youtube_video = item_info["is_youtube_video"]
-                attacher.attach_pdf_to_item(pdf_file_path, parent_item_id, is_youtube_video)
-            else:
-                logging.warning(f"No parent item ID found for {filename}")
-
-def main(collection_id: str = None) -> None:
+    attacher = ZoteroAttacher(zotero_api_key, zotero_group_id, max_workers=attach_workers, metrics=metrics)
+
+    # Near-duplicates get the PDF of the document whose markdown they reuse
+    pdf_paths = {document_name(filename): os.path.join(output_folder_path, filename)
+                 for filename in os.listdir(output_folder_path) if filename.endswith("_processed.pdf")}
+    pdf_paths.update({document: f"{os.path.splitext(markdown_path)[0]}.pdf"
+                      for document, markdown_path in duplicate_outputs(input_folder_path, item_store).items()})
+
+    # Group the processed PDFs by parent item so each parent gets a single upload
+    groups = {}
+    pdf_hashes = {}
+    documents = {}
+    for document, pdf_file_path in pdf_paths.items():
+        filename = os.path.basename(pdf_file_path)
+        item_info = item_store.document(document)
+        if not item_info:
+            logging.warning(f"No parent item ID found for {filename}")
+            continue
+        if item_info["kind"] != "youtube":
+            logging.info(f"Skipped attaching {pdf_file_path} to item {item_info['parent_item_id']} as it is not a YouTube video.")
+            continue
+        if not os.path.exists(pdf_file_path):
+            logging.warning(f"{pdf_file_path} reused by {document} has not been rendered")
+            continue
+        if manifest:
+            pdf_hashes[pdf_file_path] = file_hash(pdf_file_path)
+            if manifest.is_done(document, "attached", pdf_hashes[pdf_file_path]):
+                logging.info(f"Skipping {filename} for {document}, already attached in an earlier run")
+                continue
+        group = groups.setdefault(item_info["parent_item_id"], [])
+        # A duplicate attached to the same parent as its original needs no second upload
+        if pdf_file_path not in group:
+            group.append(pdf_file_path)
+            documents[(item_info["parent_item_id"], pdf_file_path)] = document
+
+    results = attacher.attach_groups(groups)
+    if manifest:
+        for parent_item_id, result in results.items():
+            for pdf_file_path in result["attached"] + result["skipped"]:
+                manifest.mark_done(documents[(parent_item_id, pdf_file_path)], "attached", pdf_hashes[pdf_file_path],
+                                   parent_item_id=parent_item_id)
+
+def shared_resources(args: argparse.Namespace, base_path: str, metrics: Metrics = None) -> dict:
+    # What every target of a streaming run shares: one Gemini rate limit and cap on requests in flight, the
+    # renderer, and the caches and indexes that live next to the dated folders. Zotero clients are kept per
+    # target and attachers per library, so a long-running schedule sets them up once
+    from gemini_scheduler import GeminiScheduler
+    from render import MarkdownRenderer
+    from retrieval_index import RetrievalIndex
+    from transcripts import TranscriptFetcher
+    return {
+        "rate_limiter": RateLimiter(args.requests_per_minute, args.tokens_per_minute),
+        "cache": ResponseCache(os.path.join(base_path, "gemini_cache"), int(args.cache_max_mb * 1024 * 1024),
+                               bypass=args.no_cache),
+        "scheduler": GeminiScheduler(args.max_concurrency, metrics=metrics),
+        "dedup": near_duplicate_index(args, base_path),
+        "extraction": text_extraction(base_path),
+        "renderer": MarkdownRenderer(max_workers=args.render_workers, metrics=metrics),
+        "transcript_fetcher": TranscriptFetcher(os.path.join(base_path, "transcript_cache")),
+        "index": RetrievalIndex(args.index_dir or os.path.join(base_path, "retrieval_index")),
+        "clients": {},
+        "attachers": {},
+    }
+
+def prepare_target(args: argparse.Namespace, target: "Target", target_path: str, input_folder_path: str,
+                   output_folder_path: str, manifest: RunManifest, item_store: ItemStore, shared: dict,
+                   metrics: Metrics = None) -> dict:
+    # What one target of a streaming run keeps to itself: its folders, manifest, item store and sync state,
+    # which live under target_path
+    from Gemini_api import DocumentProcessor
+    from Zotero_RAG import ZoteroClient, ZoteroContentHandler
+    from zotero_attach import ZoteroAttacher
+    if target.name not in shared["clients"]:
+        shared["clients"][target.name] = ZoteroClient(os.getenv('ZOTERO_API_KEY'), target.library, metrics=metrics)
+    if target.library not in shared["attachers"]:
+        shared["attachers"][target.library] = ZoteroAttacher(os.getenv('ZOTERO_API_KEY'), target.library, metrics=metrics)
+    zotero_client = shared["clients"][target.name]
+    processor = DocumentProcessor(input_folder_path, output_folder_path, args.max_concurrency, shared["rate_limiter"],
+                                  shared["cache"], render_pdf=False, manifest=manifest, metrics=metrics,
+                                  stream=args.stream_responses, scheduler=shared["scheduler"], dedup=shared["dedup"],
+                                  extraction=shared["extraction"])
+    return {
+        "target": target,
+        "path": target_path,
+        "input_folder_path": input_folder_path,
+        "output_folder_path": output_folder_path,
+        "manifest": manifest,
+        "item_store": item_store,
+        "zotero_client": zotero_client,
+        "handler": ZoteroContentHandler(input_folder_path, zotero_client, item_store=item_store),
+        "processor": processor,
+        "attacher": shared["attachers"][target.library],
+        "render_manifest": shared["renderer"].load_manifest(output_folder_path),
+        "sync_state": None,
+        "delta": None,
+    }
+
+def fetch_target(args: argparse.Namespace, run: dict) -> dict:
+    # Stores the target's items and names its documents; the pipeline then reads them back from the store
+    from Zotero_RAG import SyncState
+    target = run["target"]
+    zotero_client = run["zotero_client"]
+    if args.incremental:
+        run["sync_state"] = SyncState(os.path.join(run["path"], "zotero_sync_state.json"))
+        run["delta"] = run["handler"].sync_delta(run["sync_state"], target.collection_id)
+        items = run["delta"]["items"]
+    elif target.collection_id:
+        items = zotero_client.get_items_from_collection(target.collection_id)
+    else:
+        items = zotero_client.iter_items()
+    run["stored"] = run["handler"].store_items(items)
+    if run["delta"]:
+        run["handler"].apply_deleted(run["delta"]["deleted"])
+    logging.info(f"Target {target.name}: stored {run['stored']['items']} items, {run['stored']['documents']} documents to process.")
+    return run
+
+def target_documents(run: dict):
+    # The target's documents of this fetch, read from its item store a page at a time as the pipeline takes them
+    from item_store import DOWNLOAD_KINDS
+    for entry in run["item_store"].documents(run["stored"]["fetched_at"], DOWNLOAD_KINDS + ("youtube",)):
+        yield {"run": run, "entry": entry}
+
+def run_targets(args: argparse.Namespace, runs: list, shared: dict, metrics: Metrics = None) -> dict:
+    # Fetch the item lists up front, then move each document through download, extraction, formatting,
+    # rendering and attach as soon as it is ready instead of waiting for the whole batch at every step. All
+    # targets go through the same stages, so they share the download, Gemini and render workers; documents are
+    # let in from each target in turn by weight, so a large target can't hold the queues against the others
+    from concurrent.futures import ThreadPoolExecutor
+    from streaming_pipeline import StreamingPipeline, Stage
+    from target_scheduler import TargetProgress, fair_share
+    from transcripts import extract_video_id
+    metrics = metrics or Metrics(enabled=False)
+    renderer = shared["renderer"]
+    index = shared["index"]
+    transcript_fetcher = shared["transcript_fetcher"]
+
+    def fetch(run: dict) -> dict:
+        try:
+            return fetch_target(args, run)
+        except Exception as e:
+            # One library failing to sync doesn't hold up the others
+            logging.error(f"Target {run['target'].name}: fetching items failed, skipped this round: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(runs), args.download_workers))) as executor:
+        runs = [run for run in executor.map(fetch, runs) if run]
+    # Here rather than in the concurrent fetches, as the index takes one writer at a time
+    for run in runs:
+        removed = remove_deleted_documents(index, run["item_store"])
+        if removed:
+            logging.info(f"Target {run['target'].name}: {removed} sections of deleted items removed from the retrieval index.")
+
+    def download(document: dict) -> dict:
+        run, entry = document["run"], document["entry"]
+        if entry["kind"] == "youtube":
+            video_id = extract_video_id(entry["url"])
+            if not video_id:
+                logging.warning(f"Not a YouTube video URL: {entry['url']}")
+                return None
+            file_paths = transcript_fetcher.fetch(video_id, run["input_folder_path"], [entry["document"]])["file_paths"]
+            run["item_store"].set_failed([entry["document"]], not file_paths)
+            if not file_paths:
+                return None
+            source_path = file_paths[0]
+        else:
+            if run["handler"].downloader.download(entry, run["input_folder_path"])["status"] == "failed":
+                return None
+            source_path = os.path.join(run["input_folder_path"], entry["file_name"])
+        run["manifest"].mark_done(document_name(source_path), "downloaded", file_hash(source_path))
+        document.update(source_path=source_path, chunks=None)
+        return document
+
+    def extract(document: dict) -> dict:
+        processor = document["run"]["processor"]
+        source_path = document["source_path"]
+        formatted = processor.already_formatted(source_path)
+        if formatted:
+            document["markdown_path"] = processor.formatted_path(source_path, formatted)
+        else:
+            chunks = processor.extract_chunks(source_path)
+            # A near-duplicate goes on with the markdown it reuses and skips formatting
+            document["markdown_path"] = processor.reuse_duplicate(source_path, chunks)
+            if not document["markdown_path"]:
+                document["chunks"] = chunks
+        document["duplicate"] = document["markdown_path"] not in (None, processor.output_paths(source_path)[0])
+        return document
+
+    def format_document(document: dict) -> dict:
+        if document["chunks"] is not None:
+            document["markdown_path"] = document["run"]["processor"].write_formatted(document["source_path"],
+                                                                                    document.pop("chunks"))
+        return document
+
+    def index_document(document: dict) -> dict:
+        manifest = document["run"]["manifest"]
+        markdown_path = document["markdown_path"]
+        markdown_hash = file_hash(markdown_path)
+        if not manifest.is_done(document_name(document["source_path"]), "indexed", markdown_hash):
+            with open(markdown_path, 'r', encoding='utf-8') as markdown_file:
+                sections = index.add_document(document["entry"]["parent_item_id"], document_name(document["source_path"]),
+                                              markdown_file.read())
+            metrics.inc("sections_indexed_total", sections)
+            manifest.mark_done(document_name(document["source_path"]), "indexed", markdown_hash,
+                               parent_item_id=document["entry"]["parent_item_id"], sections=sections)
+        return document
+
+    def render(document: dict) -> dict:
+        markdown_path = document["markdown_path"]
+        pdf_path = f"{os.path.splitext(markdown_path)[0]}.pdf"
+        if document["duplicate"]:
+            # Rendered along with the document it duplicates; not rendered again here, which could race it
+            if not os.path.exists(pdf_path):
+                logging.warning(f"{pdf_path} reused by {document_name(document['source_path'])} has not been rendered yet")
+                return None
+        else:
+            result = renderer.render(markdown_path, pdf_path, document["run"]["render_manifest"])
+            if result["status"] == "failed":
+                return None
+            document["run"]["manifest"].mark_done(document_name(pdf_path), "rendered", result["markdown_hash"])
+        document["pdf_path"] = pdf_path
+        return document
+
+    def attach(document: dict) -> dict:
+        run, entry = document["run"], document["entry"]
+        # Only YouTube transcripts are attached back to Zotero, as in the batch attach step
+        if entry["kind"] != "youtube":
+            return document
+        pdf_hash = file_hash(document["pdf_path"])
+        if not run["manifest"].is_done(document_name(document["source_path"]), "attached", pdf_hash):
+            result = run["attacher"].attach_files(entry["parent_item_id"], [document["pdf_path"]])
+            if not result["failed"]:
+                run["manifest"].mark_done(document_name(document["source_path"]), "attached", pdf_hash,
+                                          parent_item_id=entry["parent_item_id"])
+        return document
+
+    stages = [
+        ('download', download, args.download_workers),
+        ('extract', extract, 1),
+        ('format', format_document, args.workers),
+        # A single writer, so the index's rows and document frequencies stay consistent
+        ('index', index_document, 1),
+        ('render', render, args.render_workers),
+        ('attach', attach, args.attach_workers),
+    ]
+    progress = TargetProgress([run["target"].name for run in runs], [name for name, _, _ in stages], metrics)
+    for run in runs:
+        progress.set_documents(run["target"].name, run["stored"]["documents"])
+
+    def target_of(document: dict) -> str:
+        return document["run"]["target"].name
+
+    def label(document: dict) -> str:
+        return f"{document['entry']['document']} ({target_of(document)})"
+
+    pipeline = StreamingPipeline([Stage(name, progress.wrap(name, func, target_of), workers, args.queue_size)
+                                  for name, func, workers in stages],
+                                 on_report=progress.log_stats if len(runs) > 1 else None, label=label)
+    documents = fair_share({run["target"].name: target_documents(run) for run in runs},
+                           {run["target"].name: run["target"].weight for run in runs})
+    pipeline.run(document for _, document in documents)
+
+    stats = {"stages": pipeline.stats(), "targets": progress.stats()}
+    for run in runs:
+        name = run["target"].name
+        renderer.save_manifest(run["output_folder_path"], run["render_manifest"])
+        record_duplicates(run["input_folder_path"], run["manifest"], run["item_store"])
+        with open(os.path.join(run["output_folder_path"], "pipeline_stats.json"), 'w') as json_file:
+            json.dump(stats["stages"], json_file, indent=2)
+        with open(os.path.join(run["output_folder_path"], "target_stats.json"), 'w') as json_file:
+            json.dump(stats["targets"][name], json_file, indent=2)
+        logging.info(f"Streaming pipeline completed {stats['targets'][name]['completed']} of "
+                     f"{run['stored']['documents']} documents of {name}.")
+        if run["sync_state"]:
+            run["sync_state"].set_version(run["delta"]["scope"], run["delta"]["version"])
+    return stats
+
+def run_streaming_pipeline(args: argparse.Namespace, base_path: str, input_folder_path: str, output_folder_path: str,
+                           manifest: RunManifest, item_store: ItemStore, metrics: Metrics = None) -> dict:
+    # The library in GROUP_ID, or its --collection_id, as the one target
+    from target_scheduler import Target
+    metrics = metrics or Metrics(enabled=False)
+    shared = shared_resources(args, base_path, metrics)
+    run = prepare_target(args, Target(os.getenv('GROUP_ID'), args.collection_id), base_path, input_folder_path,
+                         output_folder_path, manifest, item_store, shared, metrics)
+    return run_targets(args, [run], shared, metrics)["stages"]
+
+def run_schedule(args: argparse.Namespace, base_path: str, output_folder_path: str, metrics: Metrics = None) -> None:
+    # Streams every target through one pipeline per round, each under SAVE_PATH/targets/<target> with its own
+    # dated folders, manifest, item store and sync state. With --interval the rounds repeat, replacing one cron
+    # job per collection with a single process that holds the Gemini quota and worker pools for all of them
+    from target_scheduler import load_targets
+    metrics = metrics or Metrics(enabled=False)
+    targets = load_targets(args.target, args.targets_file)
+    logging.info(f"Scheduling {len(targets)} targets: {', '.join(f'{target.name} (weight {target.weight:g})' for target in targets)}")
+    shared = shared_resources(args, base_path, metrics)
+    while True:
+        started = time.time()
+        runs = []
+        for target in targets:
+            target_path = os.path.join(base_path, "targets", target.folder_name)
+            target_input_path, target_output_path = create_folders(target_path, args.run_date)
+            runs.append(prepare_target(args, target, target_path, target_input_path, target_output_path,
+                                       RunManifest(os.path.join(target_output_path, "run_manifest.db")),
+                                       ItemStore(os.path.join(target_path, "zotero_items.db")), shared, metrics))
+        with metrics.timer("stage_seconds", stage="schedule"):
+            stats = run_targets(args, runs, shared, metrics)
+        log_extraction_times(metrics)
+        for run in runs:
+            if run["target"].name not in stats["targets"]:
+                continue
+            with metrics.timer("stage_seconds", stage="validate"):
+                validate_documents(run["input_folder_path"], run["output_folder_path"], run["item_store"], base_path)
+            logging.info(f"Target {run['target'].name} run manifest: {run['manifest'].summary()}")
+        with open(os.path.join(output_folder_path, "target_stats.json"), 'w') as json_file:
+            json.dump(stats["targets"], json_file, indent=2)
+        if not args.interval:
+            return
+        write_run_report(metrics, output_folder_path, args, ['schedule', 'validate'], close=False)
+        wait = args.interval * 60 - (time.time() - started)
+        logging.info(f"Round finished in {time.time() - started:.0f}s, next round in {max(0, wait):.0f}s.")
+        time.sleep(max(0, wait))
+
+def validate_documents(input_folder_path: str, output_folder_path: str, item_store: ItemStore, base_path: str) -> list:
+    # Run the document length test
+    from tests.document_length_test import DocumentLengthTest
+    document_length_test = DocumentLengthTest(input_folder_path, output_folder_path, max_tokens=8000, overlap=20,
+                                              output_paths=duplicate_outputs(input_folder_path, item_store),
+                                              extraction=text_extraction(base_path))
+    return document_length_test.run_test()
+
+def near_duplicate_index(args: argparse.Namespace, base_path: str) -> "NearDuplicateIndex":
+    if args.no_dedup:
+        return None
+    from dedup import DEFAULT_THRESHOLD, NearDuplicateIndex
+    threshold = DEFAULT_THRESHOLD if args.dedup_threshold is None else args.dedup_threshold
+    return NearDuplicateIndex(os.path.join(base_path, "dedup_index.db"), threshold)
+
+def select_stages(from_stage: str = None, only_stage: str = None) -> list:
+    if only_stage:
+        return [only_stage]
+    if from_stage:
+        return STAGES[STAGES.index(from_stage):]
+    return STAGES
+
+def main(args: argparse.Namespace) -> None:
     base_path = os.getenv('SAVE_PATH')
-    input_folder_path, output_folder_path = create_folders(base_path)
+    input_folder_path, output_folder_path = create_folders(base_path, args.run_date)
     setup_logging(output_folder_path)
+    startup_seconds = time.perf_counter() - STARTED
+    logging.info(f"Started in {startup_seconds * 1000:.0f} ms")
 
-    zotero_content_handler = initialize_zotero_client(input_folder_path)
-    process_zotero_items(zotero_content_handler, input_folder_path, collection_id)
+    metrics = Metrics(enabled=not args.no_metrics,
+                      trace_path=os.path.join(output_folder_path, "trace.jsonl") if args.trace else None)
+    metrics.observe("startup_seconds", startup_seconds)
+    if args.command == 'schedule':
+        run_schedule(args, base_path, output_folder_path, metrics)
+        write_run_report(metrics, output_folder_path, args, ['schedule', 'validate'])
+        return
 
-    current_date_str = datetime.datetime.now().strftime("%Y-%m-%d")
-    youtube_links_filename = f'youtube_links_{current_date_str}.txt'
-    process_youtube_links(input_folder_path, youtube_links_filename)
+    # Per-document progress, so a rerun of the same day resumes where the last run stopped
+    manifest = RunManifest(os.path.join(output_folder_path, "run_manifest.db"))
+    # Zotero items and the documents named for them, kept next to the dated folders across runs
+    item_store = ItemStore(os.path.join(base_path, "zotero_items.db"))
+    stages = select_stages(args.from_stage, args.only_stage)
+    logging.info(f"Running stages: {', '.join(stages)}")
 
-    process_documents_with_gemini(input_folder_path, output_folder_path)
+    if args.streaming:
+        with metrics.timer("stage_seconds", stage="streaming"):
+            run_streaming_pipeline(args, base_path, input_folder_path, output_folder_path, manifest, item_store, metrics)
+        log_extraction_times(metrics)
+        stages = ['validate']
 
-    parent_mapping_path = os.path.join(input_folder_path, "parent_item_mapping.json")
-    attach_pdfs_to_zotero_items(output_folder_path, parent_mapping_path)
+    if 'fetch' in stages:
+        with metrics.timer("stage_seconds", stage="fetch"):
+            # The sync state lives next to the dated folders so it survives from one day to the next
+            zotero_content_handler = initialize_zotero_client(input_folder_path,
+                                                              os.path.join(base_path, "zotero_sync_state.json"), metrics,
+                                                              item_store)
+            process_zotero_items(zotero_content_handler, input_folder_path, args.collection_id, args.incremental)
 
-    # Run the document length test
-    document_length_test = DocumentLengthTest(input_folder_path, output_folder_path, max_tokens=8000, overlap=20)
-    document_length_test.run_test()
+    if 'transcripts' in stages:
+        with metrics.timer("stage_seconds", stage="transcripts"):
+            current_date_str = os.path.basename(input_folder_path)[len("input_"):]
+            youtube_links_filename = f'youtube_links_{current_date_str}.txt'
+            results = process_youtube_links(input_folder_path, youtube_links_filename,
+                                            os.path.join(base_path, "transcript_cache"), args.download_workers, item_store)
+        for result in results:
+            metrics.inc("transcripts_total", status=result["status"])
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Process documents from Zotero and YouTube transcripts.")
+    if 'fetch' in stages or 'transcripts' in stages:
+        record_downloads(input_folder_path, manifest)
+
+    if 'format' in stages:
+        rate_limiter = RateLimiter(args.requests_per_minute, args.tokens_per_minute)
+        cache = ResponseCache(os.path.join(base_path, "gemini_cache"), int(args.cache_max_mb * 1024 * 1024), bypass=args.no_cache)
+        dedup = near_duplicate_index(args, base_path)
+        with metrics.timer("stage_seconds", stage="format"):
+            process_documents_with_gemini(input_folder_path, output_folder_path, args.max_concurrency, rate_limiter,
+                                          args.workers, cache, manifest, metrics, args.stream_responses,
+                                          args.document_concurrency, dedup, text_extraction(base_path))
+        log_extraction_times(metrics)
+        record_duplicates(input_folder_path, manifest, item_store)
+
+    if 'index' in stages:
+        with metrics.timer("stage_seconds", stage="index"):
+            index_documents(input_folder_path, output_folder_path,
+                            args.index_dir or os.path.join(base_path, "retrieval_index"), item_store, manifest, metrics)
+
+    if 'render' in stages:
+        with metrics.timer("stage_seconds", stage="render"):
+            render_documents(output_folder_path, args.render_workers, manifest, metrics)
+
+    if 'attach' in stages:
+        with metrics.timer("stage_seconds", stage="attach"):
+            attach_pdfs_to_zotero_items(input_folder_path, output_folder_path, item_store, manifest, args.attach_workers,
+                                        metrics)
+
+    if 'validate' in stages:
+        with metrics.timer("stage_seconds", stage="validate"):
+            validate_documents(input_folder_path, output_folder_path, item_store, base_path)
+
+    logging.info(f"Run manifest: {manifest.summary()}")
+    write_run_report(metrics, output_folder_path, args, stages)
+
+def write_run_report(metrics: Metrics, output_folder_path: str, args: argparse.Namespace, stages: list,
+                     close: bool = True) -> None:
+    # close=False writes the report so far and keeps collecting, as between the rounds of a schedule
+    if close:
+        metrics.close()
+    if not metrics.enabled:
+        return
+    report_path = os.path.join(output_folder_path, "run_metrics.json")
+    metrics.write_json(report_path, {"stages": stages, "args": vars(args)})
+    logging.info(f"Run metrics written to {report_path}")
+    if args.metrics_textfile:
+        metrics.write_prometheus(args.metrics_textfile)
+        logging.info(f"Prometheus metrics written to {args.metrics_textfile}")
+
+def add_options(parser: argparse.ArgumentParser) -> None:
     parser.add_argument('--collection_id', type=str, help='The Zotero collection ID to use. If not provided, all items will be processed.')
+    parser.add_argument('--max_concurrency', type=int, default=1, help='Number of Gemini chunk requests to keep in flight per document.')
+    parser.add_argument('--requests_per_minute', type=float, default=DEFAULT_REQUESTS_PER_MINUTE, help='Gemini request rate limit.')
+    parser.add_argument('--tokens_per_minute', type=float, default=DEFAULT_TOKENS_PER_MINUTE, help='Gemini input token rate limit.')
+    parser.add_argument('--document_concurrency', type=int, default=1, help='Documents formatted at once within a process; they share the Gemini request slots so one backing off does not stall the others.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes used to process files in parallel (documents formatted at once in streaming mode).')
+    parser.add_argument('--cache_max_mb', type=float, default=DEFAULT_CACHE_MAX_BYTES / (1024 * 1024), help='Size cap of the on-disk Gemini response cache.')
+    parser.add_argument('--no_cache', action='store_true', help='Ignore cached Gemini responses (fresh responses are still cached).')
+    parser.add_argument('--incremental', action='store_true', help='Only fetch Zotero items modified since the last synced library version.')
+    parser.add_argument('--render_workers', type=int, default=4, help='Number of concurrent pandoc processes used to render PDFs.')
+    parser.add_argument('--attach_workers', type=int, default=4, help='Number of Zotero parent items uploaded to concurrently.')
+    parser.add_argument('--no_dedup', action='store_true', help='Send every document to Gemini, even near-duplicates of one already formatted.')
+    parser.add_argument('--dedup_threshold', type=float, help='Estimated Jaccard similarity of word 5-grams above which a document reuses an earlier formatted output (default 0.85).')
+    parser.add_argument('--index_dir', type=str, help='Directory of the section retrieval index (default: retrieval_index under SAVE_PATH).')
+    parser.add_argument('--run_date', type=str, help='Resume the run whose folders are dated YYYY-MM-DD instead of starting today\'s.')
+    parser.add_argument('--download_workers', type=int, default=4, help='Concurrent YouTube transcript fetches, and concurrent downloads in streaming mode.')
+    parser.add_argument('--stream_responses', action='store_true', help='Append Gemini responses to the markdown as they stream in; an interrupted document resumes from its last complete chunk.')
+    parser.add_argument('--no_metrics', action='store_true', help='Don\'t collect timings and counters or write run_metrics.json.')
+    parser.add_argument('--metrics_textfile', type=str, help='Also write the metrics in Prometheus text format to this path (e.g. for node_exporter).')
+    parser.add_argument('--trace', action='store_true', help='Append every timed span to trace.jsonl in the output folder.')
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    argv = sys.argv[1:] if argv is None else list(argv)
+    parser = argparse.ArgumentParser(description="Process documents from Zotero and YouTube transcripts.")
+    commands = parser.add_subparsers(dest='command', metavar='{run,schedule,' + ','.join(STAGES) + '}')
+    run_parser = commands.add_parser('run', help='Run every stage, or a range of them with --from-stage/--only-stage (the default).')
+    add_options(run_parser)
+    run_parser.add_argument('--streaming', action='store_true', help='Run fetch through attach as concurrent stages connected by bounded queues.')
+    run_parser.add_argument('--queue_size', type=int, default=8, help='Capacity of the queues between streaming stages.')
+    stage_group = run_parser.add_mutually_exclusive_group()
+    stage_group.add_argument('--from_stage', '--from-stage', choices=STAGES, help='Skip the stages before this one.')
+    stage_group.add_argument('--only_stage', '--only-stage', choices=STAGES, help='Run only this stage.')
+    schedule_help = ('Stream several Zotero libraries and collections through one pipeline, sharing the Gemini '
+                     'quota and the download, format and render workers between them.')
+    schedule_parser = commands.add_parser('schedule', help=schedule_help, description=schedule_help)
+    add_options(schedule_parser)
+    schedule_parser.add_argument('--target', action='append', default=[], metavar='LIBRARY[/COLLECTION][=WEIGHT]', help='A Zotero group library, or one of its collections, to process; repeat for each target. WEIGHT is its share of the workers relative to the other targets (default 1).')
+    schedule_parser.add_argument('--targets_file', type=str, help='JSON list of {"library", "collection", "weight"} targets, processed along with any --target.')
+    schedule_parser.add_argument('--interval', type=float, default=0, help='Minutes from the start of one round to the start of the next; 0 runs a single round and exits.')
+    schedule_parser.add_argument('--queue_size', type=int, default=8, help='Capacity of the queues between streaming stages.')
+    for stage in STAGES:
+        add_options(commands.add_parser(stage, help=STAGE_HELP[stage], description=STAGE_HELP[stage]))
 
-    args = parser.parse_args()
-    main(args.collection_id)
+    # Without a command every stage runs, as it did before there were commands
+    if not argv or (argv[0] not in commands.choices and argv[0] not in ('-h', '--help')):
+        argv = ['run'] + argv
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        if args.streaming and (args.from_stage or args.only_stage):
+            run_parser.error("--streaming runs every stage and can't be combined with --from-stage or --only-stage")
+    elif args.command == 'schedule':
+        from target_scheduler import load_targets
+        if args.collection_id:
+            schedule_parser.error("give collections as --target LIBRARY/COLLECTION")
+        try:
+            if not load_targets(args.target, args.targets_file):
+                schedule_parser.error("no targets, give --target or --targets_file")
+        except (OSError, ValueError, KeyError) as e:
+            schedule_parser.error(f"invalid targets: {e}")
+        args.streaming = False
+        args.from_stage = None
+        args.only_stage = None
+    else:
+        args.streaming = False
+        args.from_stage = None
+        args.only_stage = args.command
+    return args
+
+if __name__ == "__main__":
+    load_dotenv("../.env")
+    main(parse_args())
@@ -1,36 +1,179 @@
 import datetime
 import os
-from pyzotero import zotero
-from typing import List, Dict, Any
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Iterable, Iterator
 import logging
-from dotenv import load_dotenv
 import json
 import csv
-from logging_config import setup_logging
+from zotero_download import AttachmentDownloader
+from item_store import DOWNLOAD_KINDS, ItemStore
+from metrics import Metrics
 import re
 
-load_dotenv("../.env")
-
-# Setup logging
-setup_logging()
+# Largest page size the Zotero web API allows
+PAGE_SIZE = 100
 
 def sanitize_filename(filename: str) -> str:
     return re.sub(r'[\\/*?:"<>|]', "_", filename).replace(" ", "").replace(",", "").replace("'", "").replace(".", "")
 
+
+def classify_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    # Decides what to do with an item without any I/O; raises KeyError for items without a title
+    title = item['data']['title']
+    name = sanitize_filename(title)
+    parent_item_id = item['data']['parentItem'] if 'parentItem' in item['data'] else item['data']['key']
+    entry = {"kind": None, "title": title, "name": name, "parent_item_id": parent_item_id, "item": item}
+
+    if (
+        'url' in item['data']
+        and item['data']['itemType'] == 'videoRecording'
+    ):
+        entry.update(kind="youtube", url=item['data']['url'])
+    elif (
+        item['data']['itemType'] == 'attachment'
+        and item['data']['contentType'] == 'application/pdf'
+    ):
+        entry.update(kind="pdf", file_name=f"{name}.pdf", md5=item['data'].get('md5'))
+    elif (
+        item['data']['itemType'] == 'attachment'
+        and item['data']['contentType'] == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+    ):
+        entry.update(kind="docx", file_name=f"{name}.docx", md5=item['data'].get('md5'))
+    elif (
+        item['data']['itemType'] in ['document', 'journalArticle', 'webpage']
+        and 'attachment' in item['links']
+        and item['links']['attachment']['attachmentType'] == 'application/pdf'
+    ):
+        # Parent items only link to their attachment, so there is no md5 to compare against
+        entry.update(kind="document", file_name=f"{name}.pdf", md5=None)
+    return entry
+
+class SyncState:
+    # Last-seen Zotero library version per library/collection, kept between runs
+    def __init__(self, state_path: str):
+        self.state_path = state_path
+        self.state = {}
+        if os.path.exists(state_path):
+            try:
+                with open(state_path, 'r') as json_file:
+                    self.state = json.load(json_file)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ignoring unreadable sync state {state_path}: {e}")
+
+    def get_version(self, scope: str) -> int:
+        return self.state.get(scope, {}).get("version", 0)
+
+    def set_version(self, scope: str, version: int) -> None:
+        self.state[scope] = {"version": version, "synced_at": datetime.datetime.now().isoformat()}
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w') as json_file:
+            json.dump(self.state, json_file, indent=2)
+        os.replace(tmp_path, self.state_path)
+
 class ZoteroClient:
-    def __init__(self, api_key, group_id):
-        self.zotero = zotero.Zotero(group_id, 'group', api_key)
+    def __init__(self, api_key, group_id, page_workers: int = 4, endpoint: str = None, metrics: Metrics = None):
+        self.api_key = api_key
+        self.group_id = group_id
+        self.page_workers = max(1, page_workers)
+        # Point at a local server instead of api.zotero.org, e.g. for tests
+        self.endpoint = endpoint
+        self.metrics = metrics or Metrics(enabled=False)
+        self.zotero = self.new_zotero()
+        self.local = threading.local()
+
+    def new_zotero(self):
+        from pyzotero import zotero
+        client = zotero.Zotero(self.group_id, 'group', self.api_key)
+        if self.endpoint:
+            client.endpoint = self.endpoint
+        return client
+
+    def thread_zotero(self):
+        # pyzotero keeps the last response on the instance, so each worker thread gets its own
+        if not hasattr(self.local, 'zotero'):
+            self.local.zotero = self.new_zotero()
+        return self.local.zotero
+
+    def fetch_page(self, start: int) -> List[Dict[str, Any]]:
+        with self.metrics.timer("zotero_request_seconds", call="items"):
+            page = self.thread_zotero().items(limit=PAGE_SIZE, start=start)
+        self.metrics.inc("zotero_items_fetched_total", len(page))
+        return page
+
+    def iter_items(self) -> Iterator[Dict[str, Any]]:
+        with self.metrics.timer("zotero_request_seconds", call="items"):
+            first_page = self.zotero.items(limit=PAGE_SIZE, start=0)
+        self.metrics.inc("zotero_items_fetched_total", len(first_page))
+        total = int(self.zotero.request.headers.get('Total-Results', len(first_page)))
+        yield from first_page
+
+        starts = iter(range(PAGE_SIZE, total, PAGE_SIZE))
+        if self.page_workers == 1:
+            for start in starts:
+                yield from self.fetch_page(start)
+            return
+
+        # Keep a small window of pages in flight and yield them in library order
+        with ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+            pending = deque(executor.submit(self.fetch_page, start) for start, _ in zip(starts, range(self.page_workers)))
+            while pending:
+                page = pending.popleft().result()
+                next_start = next(starts, None)
+                if next_start is not None:
+                    pending.append(executor.submit(self.fetch_page, next_start))
+                yield from page
+
+    def sync_scope(self, collection_id: str = None) -> str:
+        scope = f"group:{self.group_id}"
+        return f"{scope}/collection:{collection_id}" if collection_id else scope
+
+    def get_library_version(self) -> int:
+        return int(self.zotero.last_modified_version())
+
+    def get_items_since(self, version: int, collection_id: str = None) -> List[Dict[str, Any]]:
+        with self.metrics.timer("zotero_request_seconds", call="sync"):
+            if collection_id:
+                items = self.zotero.everything(self.zotero.collection_items(collection_id, since=version))
+            else:
+                items = self.zotero.everything(self.zotero.items(since=version))
+        self.metrics.inc("zotero_items_fetched_total", len(items))
+        return items
+
+    def get_deleted_keys_since(self, version: int) -> List[str]:
+        return self.zotero.deleted(since=version).get('items', [])
+
+    def sync_items(self, sync_state: SyncState, collection_id: str = None) -> Dict[str, Any]:
+        scope = self.sync_scope(collection_id)
+        since = sync_state.get_version(scope)
+        # Read the version first so anything modified while we fetch is picked up again next run
+        version = self.get_library_version()
+        if since and since >= version:
+            return {"scope": scope, "version": version, "items": [], "deleted": []}
+        items = self.get_items_since(since, collection_id)
+        deleted = self.get_deleted_keys_since(since) if since else []
+        logging.info(f"Synced {scope} from version {since} to {version}: {len(items)} modified, {len(deleted)} deleted")
+        return {"scope": scope, "version": version, "items": items, "deleted": deleted}
 
     def get_items_and_children(self) -> List[Dict[str, Any]]:
-        items = self.zotero.items()
+        # items() already includes child items, so group them in one pass instead of one children() call per parent
+        parents = []
+        children = {}
+        for item in self.iter_items():
+            parent_key = item['data'].get('parentItem')
+            if parent_key:
+                children.setdefault(parent_key, []).append(item)
+            else:
+                parents.append(item)
+
         result = []
-        for item in items:
-            result.append(item)
-        parent_items = self.zotero.top()
-        for parent_item in parent_items:
-            parent_key = parent_item['data']['key']
-            children_items = self.zotero.children(parent_key)
-            result.extend(children_items)
+        for parent in parents:
+            result.append(parent)
+            result.extend(children.pop(parent['data']['key'], []))
+        # Children whose parent is not visible to us (e.g. in the trash) are kept at the end
+        for orphans in children.values():
+            result.extend(orphans)
         return result
 
     def get_items_from_collection(self, collection_id: str) -> List[Dict[str, Any]]:
@@ -41,22 +184,30 @@ class ZoteroClient:
             logging.error("Error fetching items from collection: %s", e)
             return []
 
+    def fetch_attachment(self, item, file_name, folder_path):
+        if 'attachment' in item['links']:
+            attachment_href = item['links']['attachment']['href']
+            attachment_id = attachment_href.rsplit('/', 1)[-1]
+        else:
+            attachment_id = item['key']
+        with self.metrics.timer("zotero_request_seconds", call="dump"):
+            self.thread_zotero().dump(attachment_id, file_name, folder_path)
+
     def download_attachment(self, item, file_name, folder_path):
         try:
-            if 'attachment' in item['links']:
-                attachment_href = item['links']['attachment']['href']
-                attachment_id = attachment_href.rsplit('/', 1)[-1]
-            else:
-                attachment_id = item['key']
-            self.zotero.dump(attachment_id, file_name, folder_path)
+            self.fetch_attachment(item, file_name, folder_path)
             logging.info("Downloaded: %s", file_name)
         except Exception as e:
             logging.error("Error downloading %s: %s", file_name, e)
 
 class ZoteroContentHandler:
-    def __init__(self, save_path, zotero_client):
+    def __init__(self, save_path, zotero_client, sync_state_path: str = None, downloader: AttachmentDownloader = None,
+                 item_store: ItemStore = None):
         self.save_path = save_path
         self.zotero_client = zotero_client
+        self.item_store = item_store or ItemStore(os.path.join(save_path, "zotero_items.db"))
+        self.downloader = downloader or AttachmentDownloader(zotero_client, item_store=self.item_store)
+        self.sync_state_path = sync_state_path or os.path.join(save_path, "zotero_sync_state.json")
 
     def create_folder(self) -> str:
         date_str = datetime.datetime.now().strftime("%Y-%m-%d")
@@ -68,104 +219,114 @@ class ZoteroContentHandler:
             logging.error(f"Error creating folder: {full_path}")
         return full_path
 
-    def save_items_as_json(self, folder_path=r"C:\Users\kamdy\Desktop\CultureX\Code\Full RAG Flow\Data\logging") -> None:
+    def handle_items(self, folder_path: str, collection_id: str, incremental: bool = False) -> None:
+        if incremental:
+            self.handle_sync(folder_path, collection_id)
+            return
+
         try:
-            items = self.zotero_client.get_items_and_children()
-            json_path = os.path.join(folder_path, "items.json")
-            with open(json_path, 'w') as json_file:
-                json.dump(items, json_file)
-            logging.info("Items saved as JSON: %s", json_path)
+            items = self.zotero_client.get_items_from_collection(collection_id)
+            logging.info(f"Fetched {len(items)} items from collection {collection_id}")
         except Exception as e:
-            logging.error(f"Error saving items as JSON: {e}")
+            logging.error("Error getting items from Zotero: %s", e)
+            return
 
-    def handle_items(self, folder_path: str, collection_id: str) -> None:
-        youtube_links = []
-        parent_item_mapping = {}
+        self.process_items(folder_path, items)
 
+    def handle_all_items(self, folder_path: str, incremental: bool = False) -> None:
+        if incremental:
+            self.handle_sync(folder_path)
+            return
+
+        # Pages go straight into the item store, so the library is never held in memory as a whole
         try:
-            items = self.zotero_client.get_items_from_collection(collection_id)
-            logging.info(f"Fetched {len(items)} items from collection {collection_id}")
+            stored = self.store_items(self.zotero_client.iter_items())
+            logging.info(f"Fetched {stored['items']} items from the library")
         except Exception as e:
             logging.error("Error getting items from Zotero: %s", e)
             return
 
-        for item in items:
-            try:
-                title = item['data']['title']
-                name = sanitize_filename(title)
-                parent_item_id = item['data']['parentItem'] if 'parentItem' in item['data'] else item['data']['key']
-            except KeyError:
-                logging.warning("Item missing title: %s", item)
-                continue
-
-            if (
-                'url' in item['data']
-                and item['data']['itemType'] == 'videoRecording'
-            ):
-                youtube_links.append(item['data']['url'])
-                logging.info(f"{title} was appended as a YouTube link")
-                # Add YouTube video to parent_item_mapping with a flag 1
-                parent_item_mapping[f"{name}_processed.pdf"] = {
-                    "parent_item_id": parent_item_id,
-                    "is_youtube_video": 1
-                }
-                logging.info(f"Added YouTube video to parent_item_mapping: {name}_processed.pdf")
-            elif (
-                item['data']['itemType'] == 'attachment'
-                and item['data']['contentType'] == 'application/pdf'
-            ):
-                self.zotero_client.download_attachment(item, f"{name}.pdf", folder_path)
-                logging.info(f"{title} was downloaded as a PDF")
-                # Add PDF to parent_item_mapping with a flag 0
-                parent_item_mapping[f"{name}_processed.pdf"] = {
-                    "parent_item_id": parent_item_id,
-                    "is_youtube_video": 0
-                }
-            elif (
-                item['data']['itemType'] == 'attachment'
-                and item['data']['contentType'] == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
-            ):
-                self.zotero_client.download_attachment(item, f"{name}.docx", folder_path)
-                logging.info(f"{title} was downloaded as a Word Doc")
-                # Add Word Doc to parent_item_mapping with a flag 0
-                parent_item_mapping[f"{name}_processed.pdf"] = {
-                    "parent_item_id": parent_item_id,
-                    "is_youtube_video": 0
-                }
-            elif (
-                item['data']['itemType'] in ['document', 'journalArticle', 'webpage']
-                and 'attachment' in item['links']
-                and item['links']['attachment']['attachmentType'] == 'application/pdf'
-            ):
-                self.zotero_client.download_attachment(item, f"{name}.pdf", folder_path)
-                logging.info(f"{title} was downloaded as a PDF")
-                # Add document to parent_item_mapping with a flag 0
-                parent_item_mapping[f"{name}_processed.pdf"] = {
-                    "parent_item_id": parent_item_id,
-                    "is_youtube_video": 0
-                }
-            else:
-                logging.info(f"{title} is not any format selected.")
+        self.download_documents(folder_path, stored["fetched_at"])
+
+    def handle_sync(self, folder_path: str, collection_id: str = None) -> None:
+        sync_state = SyncState(self.sync_state_path)
+        try:
+            delta = self.sync_delta(sync_state, collection_id)
+        except Exception as e:
+            logging.error("Error syncing items from Zotero: %s", e)
+            return
+
+        # The delta is upserted into the item store, and only the delta flows into the download and processing stages
+        self.process_items(folder_path, delta["items"])
+        self.apply_deleted(delta["deleted"])
+
+        # Record the version only once the delta has been handled, so a crash re-fetches it. Documents that
+        # failed are in the item store and come round again with the next delta
+        sync_state.set_version(delta["scope"], delta["version"])
+
+    def sync_delta(self, sync_state: SyncState, collection_id: str = None) -> Dict[str, Any]:
+        # The items modified since the last sync, plus those of documents that failed to download since
+        delta = self.zotero_client.sync_items(sync_state, collection_id)
+        keys = {item['data']['key'] for item in delta["items"]} | set(delta["deleted"])
+        retry = [item for item in self.item_store.failed_items() if item['data']['key'] not in keys]
+        if retry:
+            logging.info(f"Retrying {len(retry)} items whose documents failed in an earlier run")
+            delta["items"] = list(delta["items"]) + retry
+        return delta
+
+    def apply_deleted(self, keys: List[str]) -> None:
+        # The index stage reads the documents of deleted items back from the store and removes them
+        if keys:
+            self.item_store.mark_deleted(keys)
+            logging.info(f"{len(keys)} items deleted from Zotero marked in the item store")
+
+    def classify(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        # The document entry for an item, or None if there is nothing to fetch for it
+        try:
+            entry = classify_item(item)
+        except KeyError:
+            logging.warning("Item missing title: %s", item)
+            return None
+
+        if entry["kind"] is None:
+            logging.info(f"{entry['title']} is not any format selected.")
+            return None
+        if entry["kind"] == "youtube":
+            logging.info(f"{entry['title']} was appended as a YouTube link")
+        return entry
+
+    def store_items(self, items: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+        # Upserts the items into the item store and names their documents there; documents(fetched_at) lists them
+        stored = self.item_store.add_items(items, self.classify)
+        logging.info(f"Stored {stored['items']} items, {stored['documents']} of them documents")
+        return stored
+
+    def download_documents(self, folder_path: str, fetched_at: str) -> Dict[str, Any]:
+        download_stats = self.downloader.download_all(list(self.item_store.documents(fetched_at, DOWNLOAD_KINDS)),
+                                                      folder_path)
+        youtube_links = [document["url"] for document in self.item_store.documents(fetched_at, ["youtube"])]
 
         youtube_links_filename = f'youtube_links_{datetime.datetime.now().strftime("%Y-%m-%d")}.txt'
         youtube_links_filepath = os.path.join(folder_path, youtube_links_filename)
         with open(youtube_links_filepath, 'w') as file:
             file.write("\n".join(youtube_links))
         logging.info(f"YouTube links saved to {youtube_links_filepath}")
+        return download_stats
 
-        # Save the parent item mapping to a JSON file
-        parent_mapping_path = os.path.join(folder_path, "parent_item_mapping.json")
-        with open(parent_mapping_path, 'w') as json_file:
-            json.dump(parent_item_mapping, json_file)
-        logging.info(f"Parent item mapping saved to {parent_mapping_path}")
+    def process_items(self, folder_path: str, items: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+        stored = self.store_items(items)
+        return self.download_documents(folder_path, stored["fetched_at"])
 
-    def save_metadata_csv(self, folder_path: str, metadata: List[Dict[str, Any]]) -> None:
+    def save_metadata_csv(self, folder_path: str, metadata: Iterable[Dict[str, Any]] = None) -> None:
+        # Streams every live item from the item store unless given the rows to write
         important_keys = ['title', 'extra', 'dateAdded', 'dateModified', 'date', 'rights', 'url']
+        if metadata is None:
+            metadata = (item['data'] for item in self.item_store.iter_items())
         date_str = datetime.datetime.now().strftime("%Y-%m-%d")
         csv_path = os.path.join(folder_path, f"metadata_{date_str}.csv")
         try:
             with open(csv_path, 'w', newline='', encoding='utf-8') as csv_file:
-                writer = csv.DictWriter(csv_file, fieldnames=important_keys)
+                writer = csv.DictWriter(csv_file, fieldnames=important_keys, extrasaction='ignore')
                 writer.writeheader()
                 writer.writerows(metadata)
             logging.info(f"Metadata saved as CSV: {csv_path}")
@@ -0,0 +1,67 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chunker import Chunker
+
+WORDS = ("the project began last year and we spent most of it talking to the people who would use it "
+         "which turned out to be harder than expected because nobody agreed on what the problem was").split()
+SPEAKERS = ["Interviewer", "Interviewee", "Dr Smith"]
+
+
+def synthetic_transcript(size_bytes: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    parts = []
+    size = 0
+    while size < size_bytes:
+        turn = f"{rng.choice(SPEAKERS)}: " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 400))) + ".\n\n"
+        parts.append(turn)
+        size += len(turn)
+    return "".join(parts)
+
+
+def legacy_chunk_text(text: str, max_tokens: int, overlap: int) -> list:
+    # The word-list chunker DocumentProcessor used before chunker.py, kept for comparison
+    words = text.split()
+    chunks = []
+    start = 0
+    while start < len(words):
+        end = min(start + max_tokens, len(words))
+        chunks.append(" ".join(words[start:end]))
+        start = end - overlap if end < len(words) else end
+    return chunks
+
+
+def measure(name: str, func, text: str, repeat: int) -> None:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        chunks = func(text)
+        best = min(best, time.perf_counter() - started)
+    print(f"{name:<22} {len(chunks):>6} chunks  {best * 1000:>8.1f} ms  {len(text) / best / 1e6:>8.1f} MB/s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Chunker throughput on synthetic transcripts.")
+    parser.add_argument('--sizes_mb', type=float, nargs='+', default=[1, 5, 20])
+    parser.add_argument('--max_tokens', type=int, default=8000)
+    parser.add_argument('--overlap', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    chunker = Chunker(args.max_tokens, args.overlap)
+    for size_mb in args.sizes_mb:
+        text = synthetic_transcript(int(size_mb * 1024 * 1024))
+        lines = text.split("\n")
+        print(f"--- {size_mb:g} MB transcript")
+        measure("legacy word split", lambda t: legacy_chunk_text(t, args.max_tokens, args.overlap), text, args.repeat)
+        measure("Chunker.chunk_text", chunker.chunk_text, text, args.repeat)
+        measure("Chunker.iter_chunks", lambda t: list(chunker.iter_chunks(lines)), text, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
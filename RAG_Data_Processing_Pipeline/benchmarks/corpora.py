@@ -0,0 +1,84 @@
+import os
+import random
+import textwrap
+from typing import Any, Dict, List
+
+from docx import Document
+
+from benchmarks.chunker_benchmark import WORDS, synthetic_transcript
+
+# Corpus shapes the pipeline has trouble with: a few huge PDFs, long YouTube transcripts and lots of small DOCX files
+PRESETS = {
+    "smoke": {"pdfs": 1, "pdf_pages": 20, "transcripts": 2, "transcript_mb": 0.2, "docx": 10, "docx_paragraphs": 5},
+    "default": {"pdfs": 2, "pdf_pages": 300, "transcripts": 4, "transcript_mb": 2, "docx": 100, "docx_paragraphs": 10},
+    "large": {"pdfs": 4, "pdf_pages": 1500, "transcripts": 8, "transcript_mb": 10, "docx": 500, "docx_paragraphs": 20},
+}
+
+LINES_PER_PAGE = 45
+
+
+def pdf_escape(line: str) -> str:
+    return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path: str, pages: List[List[str]]) -> None:
+    # Smallest PDF PyPDF2 can extract text from: one Helvetica text stream per page
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_refs = []
+    for lines in pages:
+        stream = "BT /F1 10 Tf 12 TL 50 780 Td " + " ".join(f"({pdf_escape(line)}) Tj T*" for line in lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        page_refs.append(len(objects) + 1)
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {len(objects)} 0 R "
+                       f"/Resources << /Font << /F1 3 0 R >> >> >>")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{ref} 0 R' for ref in page_refs)}] /Count {len(page_refs)} >>"
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += f"{number} 0 obj\n{body}\nendobj\n".encode('latin-1')
+    xref = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode('latin-1')
+    output += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode('latin-1')
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode('latin-1')
+    with open(path, 'wb') as f:
+        f.write(output)
+
+
+def synthetic_pdf(path: str, page_count: int, seed: int = 0) -> None:
+    lines = textwrap.wrap(synthetic_transcript(page_count * LINES_PER_PAGE * 90, seed), 90)
+    write_pdf(path, [lines[i:i + LINES_PER_PAGE] for i in range(0, page_count * LINES_PER_PAGE, LINES_PER_PAGE)])
+
+
+def synthetic_docx(path: str, paragraphs: int, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    document = Document()
+    for _ in range(paragraphs):
+        document.add_paragraph(" ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 120))) + ".")
+    document.save(path)
+
+
+def build_corpus(library, source_dir: str, preset: Dict[str, Any], seed: int = 0) -> Dict[str, Dict[str, str]]:
+    # Writes the attachment files into source_dir and registers them with the fake library.
+    # Returns the synthetic transcripts for the fake YouTube loader, keyed by video id
+    os.makedirs(source_dir, exist_ok=True)
+    for n in range(preset["pdfs"]):
+        path = os.path.join(source_dir, f"report{n}.pdf")
+        synthetic_pdf(path, preset["pdf_pages"], seed + n)
+        library.add_item({"itemType": "attachment", "title": f"Report {n}", "contentType": "application/pdf"}, path)
+
+    for n in range(preset["docx"]):
+        path = os.path.join(source_dir, f"interview{n}.docx")
+        synthetic_docx(path, preset["docx_paragraphs"], seed + n)
+        library.add_item({"itemType": "attachment", "title": f"Interview {n}",
+                          "contentType": "application/vnd.openxmlformats-officedocument.wordprocessingml.document"}, path)
+
+    transcripts = {}
+    for n in range(preset["transcripts"]):
+        video_id = f"video{n:06d}"
+        transcripts[video_id] = {"title": f"Talk {n}",
+                                 "text": synthetic_transcript(int(preset["transcript_mb"] * 1024 * 1024), seed + n)}
+        library.add_item({"itemType": "videoRecording", "title": f"Talk {n}",
+                          "url": f"https://www.youtube.com/watch?v={video_id}"})
+    return transcripts
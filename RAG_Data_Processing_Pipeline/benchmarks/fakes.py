@@ -0,0 +1,263 @@
+import os
+import random
+import shutil
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List
+
+from Zotero_RAG import ZoteroClient
+from zotero_attach import ZoteroAttacher
+from zotero_download import file_md5
+
+TRANSCRIPT_MARKER = "Here is the transcript chunk:\n"
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+    def __getstate__(self):
+        return {"samples": self.samples}
+
+    def __setstate__(self, state):
+        self.lock = threading.Lock()
+        self.samples = state["samples"]
+
+
+class FakeZoteroLibrary:
+    # In-memory group library shared by every FakeZotero view; files are served from local paths
+    def __init__(self, latency: float = 0.05, bytes_per_second: float = 20e6):
+        self.latency = latency
+        self.bytes_per_second = bytes_per_second
+        self.lock = threading.Lock()
+        self.version = 1
+        self.items = []
+        self.files = {}
+        self.collections = {}
+        self.uploads = []
+        self.recorder = LatencyRecorder()
+
+    def add_item(self, data: Dict[str, Any], file_path: str = None, links: Dict[str, Any] = None,
+                 collection_id: str = None) -> Dict[str, Any]:
+        with self.lock:
+            self.version += 1
+            data = dict(data, key=data.get('key') or f"ITEM{len(self.items):04d}", version=self.version)
+            if file_path:
+                data['md5'] = file_md5(file_path)
+                self.files[data['key']] = file_path
+            item = {"key": data['key'], "version": self.version, "data": data, "links": links or {}}
+            self.items.append(item)
+            if collection_id:
+                self.collections.setdefault(collection_id, []).append(item)
+        return item
+
+    def children(self, key: str) -> List[Dict[str, Any]]:
+        return [item for item in self.items if item['data'].get('parentItem') == key]
+
+    def delay(self, name: str, size: int = 0) -> None:
+        seconds = self.latency + size / self.bytes_per_second
+        time.sleep(seconds)
+        self.recorder.record(name, seconds)
+
+
+class FakeZotero:
+    # The slice of pyzotero.zotero.Zotero the pipeline uses, one instance per thread like the real client
+    def __init__(self, library: FakeZoteroLibrary):
+        self.library = library
+        self.request = SimpleNamespace(headers={})
+
+    def _page(self, items: List[Dict[str, Any]], limit: int = None, start: int = 0, since: int = 0):
+        items = [item for item in items if item['version'] > (since or 0)]
+        self.request = SimpleNamespace(headers={'Total-Results': str(len(items)),
+                                                'Last-Modified-Version': str(self.library.version)})
+        self.library.delay("zotero.items")
+        start = start or 0
+        return items[start:start + limit] if limit else items[start:]
+
+    def items(self, limit: int = None, start: int = 0, since: int = 0) -> List[Dict[str, Any]]:
+        return self._page(self.library.items, limit, start, since)
+
+    def collection_items(self, collection_id: str, limit: int = None, start: int = 0, since: int = 0):
+        return self._page(self.library.collections.get(collection_id, []), limit, start, since)
+
+    def everything(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # Without a limit the fake already returned every page
+        return items
+
+    def last_modified_version(self) -> int:
+        self.library.delay("zotero.version")
+        return self.library.version
+
+    def deleted(self, since: int = 0) -> Dict[str, List[str]]:
+        self.library.delay("zotero.deleted")
+        return {"items": []}
+
+    def children(self, key: str) -> List[Dict[str, Any]]:
+        self.library.delay("zotero.children")
+        return self.library.children(key)
+
+    def dump(self, item_key: str, filename: str, path: str) -> str:
+        source = self.library.files[item_key]
+        self.library.delay("zotero.dump", os.path.getsize(source))
+        target = os.path.join(path, filename)
+        shutil.copyfile(source, target)
+        return target
+
+    def item_template(self, itemtype: str, linkmode: str = None) -> Dict[str, Any]:
+        return {"itemType": itemtype, "linkMode": linkmode, "title": "", "filename": "", "contentType": "", "tags": []}
+
+    def create_items(self, payload: List[Dict[str, Any]], parentid: str = None) -> Dict[str, Any]:
+        self.library.delay("zotero.create")
+        keys = {str(index): self.library.add_item(dict(data, parentItem=parentid) if parentid else data)["key"]
+                for index, data in enumerate(payload)}
+        return {"success": keys, "successful": {}, "unchanged": {}, "failed": {}}
+
+    def upload_attachments(self, attachments: List[Dict[str, Any]], parentid: str = None) -> Dict[str, List[Any]]:
+        result = {"success": [], "failure": [], "unchanged": []}
+        for attachment in attachments:
+            item = next(item for item in self.library.items if item["key"] == attachment["key"])
+            if item["data"].get("md5"):
+                result["unchanged"].append(attachment)
+                continue
+            self.library.delay("zotero.upload", os.path.getsize(attachment["filename"]))
+            with self.library.lock:
+                item["data"]["md5"] = file_md5(attachment["filename"])
+                self.library.files[attachment["key"]] = attachment["filename"]
+                self.library.uploads.append(attachment["filename"])
+            result["success"].append(attachment)
+        return result
+
+
+class FakeZoteroClient(ZoteroClient):
+    def __init__(self, library: FakeZoteroLibrary, page_workers: int = 4):
+        self.library = library
+        super().__init__("fake-key", "0", page_workers)
+
+    def new_zotero(self):
+        return FakeZotero(self.library)
+
+
+class FakeZoteroAttacher(ZoteroAttacher):
+    def __init__(self, library: FakeZoteroLibrary, max_workers: int = 4):
+        self.library = library
+        super().__init__("fake-key", "0", max_workers=max_workers, backoff=0.1)
+
+    def new_zotero(self):
+        return FakeZotero(self.library)
+
+
+class FakeRateLimitError(Exception):
+    # Same shape as the message google.api_core puts on a ResourceExhausted error
+    def __init__(self):
+        super().__init__("429 Resource has been exhausted (e.g. check quota).")
+        self.code = 429
+
+
+class FakeServerError(Exception):
+    def __init__(self):
+        super().__init__("503 The service is currently unavailable.")
+        self.code = 503
+
+
+class FakeGeminiModel:
+    # Stands in for genai.GenerativeModel: echoes the chunk back after a configurable delay.
+    # error_rate fails that share of calls at random, requests_per_minute fails calls over a sliding one-minute window
+    # (both with 429s); server_error_rate fails that share of calls with a 503
+    def __init__(self, latency: float = 1.0, jitter: float = 0.3, seconds_per_1k_chars: float = 0.05,
+                 error_rate: float = 0.0, requests_per_minute: int = None, seed: int = 0, server_error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.seconds_per_1k_chars = seconds_per_1k_chars
+        self.error_rate = error_rate
+        self.server_error_rate = server_error_rate
+        self.requests_per_minute = requests_per_minute
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = deque()
+        self.recorder = LatencyRecorder()
+        self.rate_limited = 0
+        self.server_errors = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def check_rate(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            while self.calls and now - self.calls[0] > 60:
+                self.calls.popleft()
+            over_limit = self.requests_per_minute and len(self.calls) >= self.requests_per_minute
+            random_error = self.random.random() < self.error_rate
+            self.calls.append(now)
+            if over_limit or random_error:
+                self.rate_limited += 1
+            return not (over_limit or random_error)
+
+    def generate_content(self, contents: str, generation_config: Any = None, stream: bool = False):
+        started = time.perf_counter()
+        if not self.check_rate():
+            time.sleep(self.latency / 10)
+            self.recorder.record("gemini.rate_limited", time.perf_counter() - started)
+            raise FakeRateLimitError()
+
+        with self.lock:
+            server_error = self.random.random() < self.server_error_rate
+            self.server_errors += server_error
+        if server_error:
+            time.sleep(self.latency)
+            raise FakeServerError()
+
+        chunk = contents.split(TRANSCRIPT_MARKER, 1)[-1].strip()
+        text = f"# Section\n\n{chunk}"
+        with self.lock:
+            jitter = self.random.uniform(-self.jitter, self.jitter)
+        first_byte = max(0.0, self.latency + jitter)
+        generation = len(chunk) / 1000 * self.seconds_per_1k_chars
+        if stream:
+            return self.stream_parts(text, started, first_byte, generation)
+
+        time.sleep(first_byte + generation)
+        self.recorder.record("gemini.generate", time.perf_counter() - started)
+        part = SimpleNamespace(text=text)
+        return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+    def stream_parts(self, text: str, started: float, first_byte: float, generation: float,
+                     part_chars: int = 2000) -> Iterator[SimpleNamespace]:
+        # Like a streamed GenerateContentResponse: the first part after the base latency, the rest spread over
+        # the generation time
+        time.sleep(first_byte)
+        parts = range(0, len(text), part_chars)
+        for start in parts:
+            if start:
+                time.sleep(generation / len(parts))
+            yield SimpleNamespace(text=text[start:start + part_chars])
+        self.recorder.record("gemini.generate", time.perf_counter() - started)
+
+
+class FakeYoutubeLoader:
+    # Callable like transcripts.youtube_loader, serving synthetic transcripts keyed by video id
+    def __init__(self, transcripts: Dict[str, Dict[str, str]], latency: float = 0.2):
+        self.transcripts = transcripts
+        self.latency = latency
+        self.recorder = LatencyRecorder()
+
+    def __call__(self, video_url: str) -> List[SimpleNamespace]:
+        video_id = video_url.rsplit('=', 1)[-1]
+        time.sleep(self.latency)
+        self.recorder.record("youtube.transcript", self.latency)
+        transcript = self.transcripts[video_id]
+        return [SimpleNamespace(page_content=transcript["text"], metadata={"title": transcript["title"]})]
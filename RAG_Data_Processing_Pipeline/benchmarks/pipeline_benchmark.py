@@ -0,0 +1,270 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import resource
+except ImportError:
+    # Windows has no resource module, peak RSS is reported as None there
+    resource = None
+
+from Gemini_api import DocumentProcessor
+from extraction import TextExtraction
+from Zotero_RAG import ZoteroContentHandler
+from benchmarks.corpora import PRESETS, build_corpus
+from benchmarks.fakes import (FakeGeminiModel, FakeYoutubeLoader, FakeZoteroAttacher, FakeZoteroClient,
+                              FakeZoteroLibrary, LatencyRecorder)
+from rate_limiter import RateLimiter
+from render import MarkdownRenderer
+from transcripts import TranscriptFetcher
+from zotero_download import AttachmentDownloader
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_summary(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"count": 0}
+    return {"count": len(samples), "mean": sum(samples) / len(samples), "p50": percentile(samples, 0.5),
+            "p90": percentile(samples, 0.9), "p99": percentile(samples, 0.99), "max": max(samples)}
+
+
+def peak_rss_mb() -> float:
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / scale
+
+
+def timed(recorder: LatencyRecorder, name: str, func: Callable) -> Callable:
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            recorder.record(name, time.perf_counter() - started)
+    return wrapper
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class StageTimer:
+    def __init__(self):
+        self.recorder = LatencyRecorder()
+        self.stages = {}
+
+    def run(self, name: str, func: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        # func returns the number of items and bytes it handled; per-item latencies go to self.recorder under name
+        started = time.perf_counter()
+        counts = func()
+        seconds = time.perf_counter() - started
+        stage = {
+            "items": counts["items"],
+            "bytes": counts.get("bytes", 0),
+            "seconds": seconds,
+            "items_per_second": counts["items"] / seconds if seconds else 0.0,
+            "mb_per_second": counts.get("bytes", 0) / seconds / 1e6 if seconds else 0.0,
+            "latency": latency_summary(self.recorder.samples.get(name, [])),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        stage.update(counts.get("extra", {}))
+        self.stages[name] = stage
+        print(f"{name:<12} {stage['items']:>6} items  {seconds:>8.2f} s  {stage['items_per_second']:>8.2f} items/s  "
+              f"{stage['mb_per_second']:>7.2f} MB/s  p50 {stage['latency'].get('p50', 0):.3f} s  "
+              f"p99 {stage['latency'].get('p99', 0):.3f} s  peak RSS {stage['peak_rss_mb'] or 0:.0f} MB")
+        return stage
+
+
+def run_benchmark(args: argparse.Namespace, workdir: str) -> Dict[str, Any]:
+    preset = PRESETS[args.preset]
+    library = FakeZoteroLibrary(args.zotero_latency, args.zotero_mb_per_second * 1e6)
+    transcripts = build_corpus(library, os.path.join(workdir, "library"), preset, args.seed)
+    input_folder_path = os.path.join(workdir, "input")
+    output_folder_path = os.path.join(workdir, "output")
+    os.makedirs(input_folder_path, exist_ok=True)
+    os.makedirs(output_folder_path, exist_ok=True)
+    timer = StageTimer()
+
+    client = FakeZoteroClient(library, args.page_workers)
+    downloader = AttachmentDownloader(client, max_workers=args.download_workers)
+    downloader.download = timed(timer.recorder, "fetch", downloader.download)
+    handler = ZoteroContentHandler(workdir, client, downloader=downloader)
+
+    def fetch() -> Dict[str, Any]:
+        stats = handler.process_items(input_folder_path, client.get_items_and_children())
+        return {"items": stats["downloaded"] + stats["skipped"], "bytes": stats["bytes"],
+                "extra": {"failed": stats["failed"]}}
+
+    youtube_urls = [item['data']['url'] for item in library.items if item['data']['itemType'] == 'videoRecording']
+    fetcher = TranscriptFetcher(os.path.join(workdir, "transcript_cache"), FakeYoutubeLoader(transcripts, args.youtube_latency),
+                                max_workers=args.download_workers)
+
+    def fetch_transcripts() -> Dict[str, Any]:
+        names = {url: handler.item_store.documents_for_url(url) for url in youtube_urls}
+        results = fetcher.fetch_all(youtube_urls, input_folder_path, names)
+        timer.recorder.samples["transcripts"] = [result["seconds"] for result in results]
+        return {"items": len(results), "bytes": sum(os.path.getsize(path) for result in results for path in result["file_paths"])}
+
+    model = FakeGeminiModel(args.gemini_latency, args.gemini_jitter, args.gemini_seconds_per_1k_chars,
+                            args.gemini_error_rate, args.gemini_rpm, args.seed, args.gemini_server_error_rate)
+    processor = DocumentProcessor(input_folder_path, output_folder_path, max_concurrency=args.max_concurrency,
+                                  rate_limiter=RateLimiter(args.requests_per_minute, args.tokens_per_minute),
+                                  render_pdf=False, model=model, stream=args.stream,
+                                  extraction=TextExtraction(os.path.join(workdir, "text_cache")))
+    processor.generate_content = timed(timer.recorder, "format", processor.generate_content)
+    processor.stream_chunk = timed(timer.recorder, "format", processor.stream_chunk)
+    file_paths = []
+    chunks = {}
+
+    def extract(name: str) -> Dict[str, Any]:
+        # The second pass reads the text cached by the first, as a rerun of format or validate would
+        if not file_paths:
+            file_paths.extend(processor.list_input_files())
+        seconds_by_format = {}
+        for file_path in file_paths:
+            started = time.perf_counter()
+            chunks[file_path] = processor.extract_chunks(file_path)
+            seconds = time.perf_counter() - started
+            timer.recorder.record(name, seconds)
+            extension = os.path.splitext(file_path)[1].lstrip('.')
+            seconds_by_format[extension] = seconds_by_format.get(extension, 0.0) + seconds
+        return {"items": len(file_paths), "bytes": sum(os.path.getsize(path) for path in file_paths),
+                "extra": {"chunks": sum(len(document_chunks) for document_chunks in chunks.values()),
+                          "seconds_by_format": seconds_by_format}}
+
+    def format_documents() -> Dict[str, Any]:
+        for file_path in file_paths:
+            processor.write_formatted(file_path, chunks[file_path])
+        return {"items": sum(len(document_chunks) for document_chunks in chunks.values()),
+                "bytes": sum(len(chunk) for document_chunks in chunks.values() for chunk in document_chunks),
+                "extra": {"rate_limited": model.rate_limited, "server_errors": model.server_errors}}
+
+    def render() -> Dict[str, Any]:
+        results = MarkdownRenderer(max_workers=args.render_workers).render_directory(output_folder_path)
+        timer.recorder.samples["render"] = [result["seconds"] for result in results]
+        return {"items": len(results), "extra": {"failed": sum(1 for result in results if result["status"] == "failed")}}
+
+    attacher = FakeZoteroAttacher(library, args.attach_workers)
+    attacher.attach_files = timed(timer.recorder, "attach", attacher.attach_files)
+
+    def attach() -> Dict[str, Any]:
+        # Without a render stage the markdown stands in for the PDF, the upload path is the same
+        extension = ".pdf" if args.render else ".md"
+        groups = {}
+        for document in handler.item_store.documents(kinds=["youtube"]):
+            output_path = os.path.join(output_folder_path, f"{document['document']}_processed{extension}")
+            if os.path.exists(output_path):
+                groups.setdefault(document["parent_item_id"], []).append(output_path)
+        results = attacher.attach_groups(groups)
+        paths = [path for result in results.values() for path in result["attached"]]
+        return {"items": sum(len(result["attached"]) + len(result["skipped"]) for result in results.values()),
+                "bytes": sum(os.path.getsize(path) for path in paths)}
+
+    started = time.perf_counter()
+    timer.run("fetch", fetch)
+    timer.run("transcripts", fetch_transcripts)
+    timer.run("extract", lambda: extract("extract"))
+    timer.run("extract_cached", lambda: extract("extract_cached"))
+    timer.run("format", format_documents)
+    if args.render:
+        timer.run("render", render)
+    timer.run("attach", attach)
+
+    return {
+        "benchmark": "pipeline",
+        "timestamp": datetime.datetime.now().isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "corpus": preset,
+        "total_seconds": time.perf_counter() - started,
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": timer.stages,
+        "backend_latency": {name: latency_summary(samples) for recorder in (library.recorder, model.recorder)
+                            for name, samples in recorder.samples.items()},
+    }
+
+
+def compare(results: Dict[str, Any], baseline_path: str) -> None:
+    with open(baseline_path, 'r') as json_file:
+        baseline = json.load(json_file)
+    print(f"--- compared with {baseline_path} ({baseline.get('git_commit')})")
+    for name, stage in results["stages"].items():
+        previous = baseline["stages"].get(name)
+        if not previous or not previous["items_per_second"]:
+            continue
+        change = stage["items_per_second"] / previous["items_per_second"] - 1
+        print(f"{name:<12} {previous['items_per_second']:>8.2f} -> {stage['items_per_second']:>8.2f} items/s ({change:+.0%})")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="End-to-end pipeline benchmark against fake Zotero and Gemini backends.")
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='default', help='Size of the synthetic corpus.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='Keep the corpus and outputs here instead of a temporary folder.')
+    parser.add_argument('--output', help='Results JSON path (default: benchmarks/results/pipeline_<timestamp>.json).')
+    parser.add_argument('--baseline', help='Earlier results JSON to compare stage throughput with.')
+    parser.add_argument('--stream', action='store_true', help='Stream Gemini responses into the markdown files.')
+    parser.add_argument('--render', action='store_true', help='Also time the pandoc render stage (needs pandoc and LaTeX).')
+    parser.add_argument('--page_workers', type=int, default=4)
+    parser.add_argument('--download_workers', type=int, default=4)
+    parser.add_argument('--max_concurrency', type=int, default=4)
+    parser.add_argument('--render_workers', type=int, default=4)
+    parser.add_argument('--attach_workers', type=int, default=4)
+    parser.add_argument('--requests_per_minute', type=int, default=600)
+    parser.add_argument('--tokens_per_minute', type=int, default=10_000_000)
+    parser.add_argument('--zotero_latency', type=float, default=0.05, help='Seconds per fake Zotero API call.')
+    parser.add_argument('--zotero_mb_per_second', type=float, default=20.0, help='Fake Zotero file transfer speed.')
+    parser.add_argument('--youtube_latency', type=float, default=0.2, help='Seconds per fake transcript fetch.')
+    parser.add_argument('--gemini_latency', type=float, default=1.0, help='Base seconds per fake Gemini call.')
+    parser.add_argument('--gemini_jitter', type=float, default=0.3)
+    parser.add_argument('--gemini_seconds_per_1k_chars', type=float, default=0.05)
+    parser.add_argument('--gemini_error_rate', type=float, default=0.0, help='Share of Gemini calls failing with 429.')
+    parser.add_argument('--gemini_server_error_rate', type=float, default=0.0, help='Share of Gemini calls failing with 503.')
+    parser.add_argument('--gemini_rpm', type=int, help='Fake Gemini quota; calls over it fail with 429.')
+    args = parser.parse_args()
+    # Only problems, so the per-stage table isn't buried under the pipeline's progress messages
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        results = run_benchmark(args, args.workdir)
+    else:
+        with tempfile.TemporaryDirectory(prefix="pipeline_benchmark_") as workdir:
+            results = run_benchmark(args, workdir)
+
+    output_path = args.output or os.path.join(RESULTS_DIR, f"pipeline_{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w') as json_file:
+        json.dump(results, json_file, indent=2)
+    print(f"Results written to {output_path}")
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import math
+import re
+from typing import Iterable, Iterator, List, Tuple
+
+# Average characters per Gemini token on English interview transcripts; use calibrate() to refit
+CHARS_PER_TOKEN = 4.0
+
+# Preferred cut points, best first. Each match's end is where the next chunk may begin.
+SPEAKER_TURN = re.compile(r"\n(?=[ \t]*(?:\*\*)?[A-Z][\w.'-]*(?: [A-Z][\w.'-]*){0,3}(?:\*\*)?[ \t]*:)")
+PARAGRAPH = re.compile(r"\n[ \t]*\n")
+SENTENCE = re.compile(r"[.!?][\"')\]]*\s")
+WHITESPACE = re.compile(r"\s")
+BOUNDARIES = (SPEAKER_TURN, PARAGRAPH, SENTENCE, WHITESPACE)
+
+
+def estimate_tokens(text: str, chars_per_token: float = CHARS_PER_TOKEN) -> int:
+    return math.ceil(len(text) / chars_per_token)
+
+
+def calibrate(samples: Iterable[Tuple[str, int]]) -> float:
+    # samples are (text, real token count) pairs, e.g. from model.count_tokens
+    chars = tokens = 0
+    for text, token_count in samples:
+        chars += len(text)
+        tokens += token_count
+    return chars / tokens if tokens else CHARS_PER_TOKEN
+
+
+class Chunker:
+    def __init__(self, max_tokens: int = 8000, overlap: int = 20, chars_per_token: float = CHARS_PER_TOKEN,
+                 min_fill: float = 0.5):
+        self.max_chars = max(1, int(max_tokens * chars_per_token))
+        self.overlap_chars = min(int(overlap * chars_per_token), self.max_chars // 2)
+        # Never cut before this fraction of the window just to land on a nicer boundary
+        self.min_fill = min_fill
+
+    def find_cut(self, text: str, start: int) -> int:
+        limit = start + self.max_chars
+        lowest = start + int(self.max_chars * self.min_fill)
+        for boundary in BOUNDARIES:
+            last = None
+            for last in boundary.finditer(text, lowest, limit):
+                pass
+            if last:
+                return last.end()
+        return limit
+
+    def next_start(self, text: str, start: int, cut: int) -> int:
+        if not self.overlap_chars:
+            return cut
+        # Step back by the overlap and move forward to the next word start so no word is split
+        overlap_start = max(start + 1, cut - self.overlap_chars)
+        space = WHITESPACE.search(text, overlap_start, cut)
+        return space.end() if space else cut
+
+    def spans(self, text: str) -> Iterator[Tuple[int, int]]:
+        start = 0
+        while len(text) - start > self.max_chars:
+            cut = self.find_cut(text, start)
+            yield start, cut
+            start = self.next_start(text, start, cut)
+        yield start, len(text)
+
+    def chunk_text(self, text: str) -> List[str]:
+        return [chunk for chunk in (text[start:end].strip() for start, end in self.spans(text)) if chunk]
+
+    def iter_chunks(self, pieces: Iterable[str]) -> Iterator[str]:
+        # Same chunks as chunk_text("\n".join(pieces)); only about one window of text is buffered.
+        # Cuts only look at text[start:start + max_chars], so they can be made as soon as more than that is buffered.
+        buffer = None
+        pending = []
+        pending_chars = 0
+        for piece in pieces:
+            pending.append(piece)
+            pending_chars += len(piece) + 1
+            if (len(buffer) if buffer is not None else 0) + pending_chars <= self.max_chars:
+                continue
+            buffer = "\n".join(pending if buffer is None else [buffer] + pending)
+            pending = []
+            pending_chars = 0
+            while len(buffer) > self.max_chars:
+                cut = self.find_cut(buffer, 0)
+                chunk = buffer[:cut].strip()
+                if chunk:
+                    yield chunk
+                buffer = buffer[self.next_start(buffer, 0, cut):]
+        if pending:
+            buffer = "\n".join(pending if buffer is None else [buffer] + pending)
+        # The input is exhausted, so the tail is chunked exactly like the end of a whole document
+        if buffer is not None:
+            yield from self.chunk_text(buffer)
@@ -0,0 +1,134 @@
+import contextlib
+import hashlib
+import re
+import sqlite3
+import zlib
+from typing import Iterable, Iterator
+
+import numpy as np
+
+# 128 MinHash permutations in 16 LSH bands of 8 rows: documents with a Jaccard similarity of 0.85 share a band
+# with probability 0.99, at 0.5 with probability 0.06
+NUM_PERMUTATIONS = 128
+BANDS = 16
+SHINGLE_WORDS = 5
+DEFAULT_THRESHOLD = 0.85
+# Below this many distinct shingles the similarity estimate is too noisy to skip a document on
+MIN_SHINGLES = 50
+# Shingles hashed per block, bounding the (permutations x block) working array to 8 MB
+SHINGLE_BLOCK = 8192
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64(0xFFFFFFFF)
+TOKEN = re.compile(r"[a-z0-9]+")
+
+# Fixed seed, so signatures computed in different runs and processes are comparable
+_random = np.random.RandomState(1)
+PERMUTATION_A = _random.randint(1, 1 << 32, NUM_PERMUTATIONS, dtype=np.uint64)
+PERMUTATION_B = _random.randint(0, 1 << 32, NUM_PERMUTATIONS, dtype=np.uint64)
+
+
+def shingle_hashes(pieces: Iterable[str], n: int = SHINGLE_WORDS) -> np.ndarray:
+    # Distinct 32-bit hashes of every n consecutive normalised words
+    tokens = [token for piece in pieces for token in TOKEN.findall(piece.lower())]
+    if len(tokens) < n:
+        return np.empty(0, dtype=np.uint64)
+    words = np.fromiter((zlib.crc32(token.encode('utf-8')) for token in tokens), dtype=np.uint64, count=len(tokens))
+    shingles = np.zeros(len(tokens) - n + 1, dtype=np.uint64)
+    for offset in range(n):
+        shingles = shingles * np.uint64(1_000_003) + words[offset:len(words) - n + 1 + offset]
+    return np.unique(shingles & MAX_HASH)
+
+
+def minhash_signature(shingles: np.ndarray) -> np.ndarray:
+    signature = np.full(NUM_PERMUTATIONS, MAX_HASH, dtype=np.uint64)
+    for start in range(0, len(shingles), SHINGLE_BLOCK):
+        block = shingles[start:start + SHINGLE_BLOCK]
+        hashed = ((PERMUTATION_A[:, None] * block[None, :] + PERMUTATION_B[:, None]) % MERSENNE_PRIME) & MAX_HASH
+        signature = np.minimum(signature, hashed.min(axis=1))
+    return signature.astype(np.uint32)
+
+
+def band_buckets(signature: np.ndarray) -> Iterator[tuple]:
+    rows = NUM_PERMUTATIONS // BANDS
+    for band in range(BANDS):
+        digest = hashlib.blake2b(signature[band * rows:(band + 1) * rows].tobytes(), digest_size=8).digest()
+        yield band, int.from_bytes(digest, 'big', signed=True)
+
+
+class NearDuplicateIndex:
+    # MinHash signatures of formatted documents, keyed by their markdown path, with LSH band buckets in SQLite so
+    # candidates are found without comparing against every document. Lives next to the dated folders and so
+    # spans runs; SQLite lets worker processes share it
+    def __init__(self, index_path: str, threshold: float = DEFAULT_THRESHOLD):
+        self.index_path = index_path
+        self.threshold = threshold
+        with self.connect() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    markdown_path TEXT PRIMARY KEY,
+                    signature BLOB NOT NULL,
+                    chunks INTEGER NOT NULL,
+                    formatted INTEGER NOT NULL
+                )""")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS bands (
+                    band INTEGER NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    markdown_path TEXT NOT NULL
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS bands_bucket ON bands (band, bucket)")
+            connection.execute("CREATE INDEX IF NOT EXISTS bands_document ON bands (markdown_path)")
+
+    def __getstate__(self):
+        return {"index_path": self.index_path, "threshold": self.threshold}
+
+    def __setstate__(self, state):
+        self.__init__(state["index_path"], state["threshold"])
+
+    @contextlib.contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.index_path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def signature(self, chunks: Iterable[str]) -> np.ndarray:
+        # None for documents too short to judge
+        shingles = shingle_hashes(chunks)
+        if len(shingles) < MIN_SHINGLES:
+            return None
+        return minhash_signature(shingles)
+
+    def find(self, signature: np.ndarray, exclude: str = None) -> dict:
+        # The most similar formatted document at or above the threshold, as {"markdown_path", "similarity", "chunks"}
+        with self.connect() as connection:
+            candidates = set()
+            for band, bucket in band_buckets(signature):
+                candidates.update(path for path, in connection.execute(
+                    "SELECT markdown_path FROM bands WHERE band = ? AND bucket = ?", (band, bucket)))
+            candidates.discard(exclude)
+            best = None
+            for path in candidates:
+                row = connection.execute("SELECT signature, chunks FROM documents WHERE markdown_path = ? AND formatted = 1",
+                                         (path,)).fetchone()
+                if not row:
+                    continue
+                similarity = float(np.mean(np.frombuffer(row[0], dtype=np.uint32) == signature))
+                if similarity >= self.threshold and (best is None or similarity > best["similarity"]):
+                    best = {"markdown_path": path, "similarity": similarity, "chunks": row[1]}
+        return best
+
+    def add(self, markdown_path: str, signature: np.ndarray, chunks: int) -> None:
+        # Registered as pending; only mark_formatted makes it a match for other documents
+        with self.connect() as connection:
+            connection.execute("DELETE FROM bands WHERE markdown_path = ?", (markdown_path,))
+            connection.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, 0)",
+                               (markdown_path, signature.tobytes(), chunks))
+            connection.executemany("INSERT INTO bands VALUES (?, ?, ?)",
+                                   [(band, bucket, markdown_path) for band, bucket in band_buckets(signature)])
+
+    def mark_formatted(self, markdown_path: str) -> None:
+        with self.connect() as connection:
+            connection.execute("UPDATE documents SET formatted = 1 WHERE markdown_path = ?", (markdown_path,))
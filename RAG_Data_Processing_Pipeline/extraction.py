@@ -0,0 +1,302 @@
+import contextlib
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator
+
+from manifest import file_hash
+
+# Below this many pages the cost of starting worker processes outweighs parallel extraction
+PARALLEL_PDF_MIN_PAGES = 100
+# Characters read from a cached text at a time
+BUFFER_SIZE = 1024 * 1024
+
+# Control words, \'hh escapes, escaped characters, braces, line breaks (not text in RTF) and runs of plain text
+RTF_TOKEN = re.compile(r"\\([a-z]{1,32})(-?\d{1,10})? ?|\\'([0-9a-f]{2})|\\([^a-z])|([{}])|[\r\n]+|([^\\{}\r\n]+)",
+                       re.IGNORECASE)
+# Groups that hold formatting, metadata or embedded objects rather than document text
+RTF_DESTINATIONS = {
+    "annotation", "atnauthor", "atndate", "atnid", "atnref", "author", "bkmkend", "bkmkstart", "blipuid", "buptim",
+    "category", "colorschememapping", "colortbl", "comment", "company", "creatim", "datafield", "datastore",
+    "defchp", "defpap", "do", "doccomm", "docvar", "factoidname", "falt", "ffname", "fldinst", "fldtype",
+    "fontemb", "fontfile", "fonttbl", "footer", "footerf", "footerl", "footerr", "formfield", "generator",
+    "header", "headerf", "headerl", "headerr", "info", "keywords", "latentstyles", "levelnumbers", "leveltext",
+    "listoverridetable", "listpicture", "listtable", "listtext", "lsdlockedexcept", "manager", "mmath",
+    "nesttableprops", "nonesttables", "objclass", "objdata", "object", "operator", "panose", "pgdsctbl",
+    "pict", "pn", "pntext", "pntxta", "pntxtb", "printim", "private", "propname", "protusertbl", "revtbl",
+    "revtim", "rsidtbl", "shp", "shpinst", "shppict", "stylesheet", "subject", "tc", "template", "themedata",
+    "title", "userprops", "wgrffmtfilter", "writereservation", "xe", "xmlnstbl",
+}
+RTF_SPECIAL = {
+    "par": "\n", "line": "\n", "row": "\n", "sect": "\n\n", "page": "\n\n", "tab": "\t", "cell": "\t",
+    "emdash": "\u2014", "endash": "\u2013", "emspace": "\u2003", "enspace": "\u2002", "qmspace": "\u2005",
+    "bullet": "\u2022", "lquote": "\u2018", "rquote": "\u2019", "ldblquote": "\u201c", "rdblquote": "\u201d",
+}
+RTF_ESCAPES = {"\\": "\\", "{": "{", "}": "}", "~": "\u00a0", "_": "\u2011", "\n": "\n", "\r": "\n"}
+
+
+def rtf_to_text(rtf: str) -> str:
+    # Plain text of an RTF document, without starting pandoc for it
+    stack = []
+    ignorable = False
+    # Characters to drop after a \uN: its ANSI fallback, \ucN of them
+    uc_skip = 1
+    skip = 0
+    encoding = "cp1252"
+    pending_bytes = bytearray()
+    out = []
+
+    def flush_bytes():
+        if pending_bytes:
+            try:
+                out.append(pending_bytes.decode(encoding, errors="replace"))
+            except LookupError:
+                out.append(pending_bytes.decode("cp1252", errors="replace"))
+            pending_bytes.clear()
+
+    for match in RTF_TOKEN.finditer(rtf):
+        word, argument, hex_code, escaped, brace, text = match.groups()
+        if hex_code is not None:
+            if skip:
+                skip -= 1
+            elif not ignorable:
+                # Consecutive \'hh bytes are decoded together, for multi-byte code pages
+                pending_bytes.append(int(hex_code, 16))
+            continue
+        flush_bytes()
+        if brace:
+            skip = 0
+            if brace == "{":
+                stack.append((uc_skip, ignorable))
+            elif stack:
+                uc_skip, ignorable = stack.pop()
+        elif escaped is not None:
+            skip = 0
+            if escaped == "*":
+                ignorable = True
+            elif not ignorable and escaped in RTF_ESCAPES:
+                out.append(RTF_ESCAPES[escaped])
+        elif word:
+            skip = 0
+            if word in RTF_DESTINATIONS:
+                ignorable = True
+            elif word == "ansicpg" and argument:
+                encoding = f"cp{argument}"
+            elif word == "uc" and argument:
+                uc_skip = int(argument)
+            elif ignorable:
+                continue
+            elif word == "u" and argument:
+                code = int(argument)
+                out.append(chr(code + 0x10000 if code < 0 else code))
+                skip = uc_skip
+            elif word in RTF_SPECIAL:
+                out.append(RTF_SPECIAL[word])
+        elif text:
+            if skip:
+                dropped = min(skip, len(text))
+                text = text[dropped:]
+                skip -= dropped
+            if text and not ignorable:
+                out.append(text)
+    flush_bytes()
+    result = "".join(out)
+    # \u escapes outside the BMP arrive as surrogate pairs
+    if re.search("[\ud800-\udfff]", result):
+        result = result.encode("utf-16", "surrogatepass").decode("utf-16", errors="replace")
+    return result
+
+
+def normalise_text(text: str) -> str:
+    return text.replace("\r\n", "\n").replace("\r", "\n").replace("\x00", "")
+
+
+def extract_pdf_pages(file_path: str, start: int, stop: int) -> list:
+    from PyPDF2 import PdfReader
+    with open(file_path, 'rb') as f:
+        reader = PdfReader(f)
+        return [reader.pages[i].extract_text() for i in range(start, stop)]
+
+
+# Extractors turn one file format into text pieces that, joined with "\n", are the document's text. Bump an
+# extractor's version whenever its output changes, so text cached from the old version is not used again
+class PdfExtractor:
+    name = "pdf"
+    version = "1"
+    cacheable = True
+
+    def __init__(self, workers: int = 1):
+        self.workers = max(1, workers)
+
+    def iter_text(self, file_path: str) -> Iterator[str]:
+        # One piece per page
+        from PyPDF2 import PdfReader
+        with open(file_path, 'rb') as f:
+            reader = PdfReader(f)
+            page_count = len(reader.pages)
+            if self.workers == 1 or page_count < PARALLEL_PDF_MIN_PAGES:
+                for page in reader.pages:
+                    yield page.extract_text()
+                return
+
+        # Split the page range across worker processes and yield the ranges back in page order
+        step = -(-page_count // self.workers)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(extract_pdf_pages, file_path, start, min(start + step, page_count))
+                       for start in range(0, page_count, step)]
+            for future in futures:
+                yield from future.result()
+
+
+class DocxExtractor:
+    name = "docx"
+    version = "1"
+    cacheable = True
+
+    def iter_text(self, file_path: str) -> Iterator[str]:
+        from docx import Document
+        for paragraph in Document(file_path).paragraphs:
+            yield paragraph.text
+
+
+class RtfExtractor:
+    name = "rtf"
+    version = "1"
+    cacheable = True
+
+    def iter_text(self, file_path: str) -> Iterator[str]:
+        # RTF is 7-bit; anything else is escaped inside it
+        with open(file_path, 'r', encoding='latin-1') as f:
+            yield rtf_to_text(f.read())
+
+
+class PlainTextExtractor:
+    name = "txt"
+    version = "1"
+    # Already plain text, a cached copy would only be read instead of the original
+    cacheable = False
+
+    def iter_text(self, file_path: str) -> Iterator[str]:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            yield f.read()
+
+
+class TextExtraction:
+    # Picks the extractor for a file by extension and, with a cache_dir, keeps the normalised text it produced
+    # under the file's SHA-256 and the extractor's version. Reruns of format and validation then read the cached
+    # text; content hashes are remembered by path, size and mtime, so the original file is not read at all.
+    # extractors maps extensions (".pdf") to extra or replacement extractors
+    def __init__(self, cache_dir: str = None, pdf_workers: int = 1, extractors: Dict[str, Any] = None):
+        self.cache_dir = cache_dir
+        self.pdf_workers = max(1, pdf_workers)
+        self.custom_extractors = dict(extractors or {})
+        self.extractors = {".pdf": PdfExtractor(self.pdf_workers), ".docx": DocxExtractor(), ".rtf": RtfExtractor(),
+                           ".txt": PlainTextExtractor()}
+        self.extractors.update(self.custom_extractors)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            with self.connect() as connection:
+                connection.execute("""
+                    CREATE TABLE IF NOT EXISTS files (
+                        path TEXT PRIMARY KEY,
+                        size INTEGER NOT NULL,
+                        mtime_ns INTEGER NOT NULL,
+                        sha256 TEXT NOT NULL
+                    )""")
+
+    def __getstate__(self):
+        return {"cache_dir": self.cache_dir, "pdf_workers": self.pdf_workers, "extractors": self.custom_extractors}
+
+    def __setstate__(self, state):
+        self.__init__(state["cache_dir"], state["pdf_workers"], state["extractors"])
+
+    def with_pdf_workers(self, pdf_workers: int) -> "TextExtraction":
+        return TextExtraction(self.cache_dir, pdf_workers, self.custom_extractors)
+
+    @contextlib.contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(os.path.join(self.cache_dir, "files.db"), timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def extensions(self) -> tuple:
+        return tuple(self.extractors)
+
+    def extractor(self, file_path: str):
+        extractor = self.extractors.get(os.path.splitext(file_path)[1].lower())
+        if extractor is None:
+            raise ValueError(f"Unsupported file type: {file_path}")
+        return extractor
+
+    def content_hash(self, file_path: str) -> str:
+        # file_hash, remembered while the file's size and mtime stay the same
+        if not self.cache_dir:
+            return file_hash(file_path)
+        path = os.path.abspath(file_path)
+        stat = os.stat(path)
+        with self.connect() as connection:
+            row = connection.execute("SELECT size, mtime_ns, sha256 FROM files WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        sha256 = file_hash(path)
+        with self.connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                               (path, stat.st_size, stat.st_mtime_ns, sha256))
+        return sha256
+
+    def cache_path(self, file_path: str) -> str:
+        extractor = self.extractor(file_path)
+        if not self.cache_dir or not extractor.cacheable:
+            return None
+        key = self.content_hash(file_path)
+        return os.path.join(self.cache_dir, key[:2], f"{key}.{extractor.name}-{extractor.version}.txt")
+
+    def is_cached(self, file_path: str) -> bool:
+        cache_path = self.cache_path(file_path)
+        return bool(cache_path) and os.path.exists(cache_path)
+
+    def iter_cached(self, cache_path: str) -> Iterator[str]:
+        # Cut at newlines, so the pieces joined with "\n" are the cached text again
+        carry = ""
+        with open(cache_path, 'r', encoding='utf-8', newline='') as f:
+            for buffer in iter(lambda: f.read(BUFFER_SIZE), ''):
+                text = carry + buffer
+                cut = text.rfind("\n")
+                if cut < 0:
+                    carry = text
+                    continue
+                yield text[:cut]
+                carry = text[cut + 1:]
+        yield carry
+
+    def iter_text(self, file_path: str) -> Iterator[str]:
+        # Normalised text pieces; joined with "\n" they give exactly what read_text returns
+        cache_path = self.cache_path(file_path)
+        if cache_path and os.path.exists(cache_path):
+            yield from self.iter_cached(cache_path)
+            return
+        pieces = (normalise_text(piece or "") for piece in self.extractor(file_path).iter_text(file_path))
+        if not cache_path:
+            yield from pieces
+            return
+
+        # Written alongside, and only kept once the extractor has run to the end
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+                for i, piece in enumerate(pieces):
+                    f.write(f"\n{piece}" if i else piece)
+                    yield piece
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def read_text(self, file_path: str) -> str:
+        return "\n".join(self.iter_text(file_path))
@@ -0,0 +1,166 @@
+import logging
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+from metrics import Metrics
+
+# Kinds of failure worth trying again; blocked, truncated and client errors give the same result on every attempt
+RETRYABLE = {"rate_limit", "server"}
+BLOCKED_FINISH_REASONS = {"SAFETY", "RECITATION", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII"}
+RATE_LIMIT_ERRORS = {"ResourceExhausted", "TooManyRequests"}
+SERVER_ERRORS = {"ServiceUnavailable", "InternalServerError", "DeadlineExceeded", "GatewayTimeout", "BadGateway",
+                 "ConnectionError", "Timeout", "TimeoutError", "ConnectionResetError"}
+BLOCKED_ERRORS = {"BlockedPromptException", "StopCandidateException"}
+
+
+class GeminiError(Exception):
+    def __init__(self, kind: str, message: str):
+        super().__init__(message)
+        self.kind = kind
+
+
+def classify_error(error: Exception) -> str:
+    # google.api_core errors carry the HTTP status in .code; anything else is judged by name and message
+    if isinstance(error, GeminiError):
+        return error.kind
+    name = type(error).__name__
+    code = getattr(error, 'code', None)
+    if not isinstance(code, int):
+        match = re.match(r'\s*(\d{3})\b', str(error))
+        code = int(match.group(1)) if match else None
+    if code == 429 or name in RATE_LIMIT_ERRORS:
+        return "rate_limit"
+    if (code is not None and code >= 500) or name in SERVER_ERRORS:
+        return "server"
+    if name in BLOCKED_ERRORS:
+        return "blocked"
+    return "client"
+
+
+def finish_reason_name(candidate: Any) -> str:
+    reason = getattr(candidate, 'finish_reason', None)
+    return getattr(reason, 'name', str(reason or ""))
+
+
+def check_response(response: Any, require_content: bool = True) -> None:
+    # Turns the failures Gemini reports inside a successful response into GeminiErrors
+    block_reason = getattr(getattr(response, 'prompt_feedback', None), 'block_reason', None)
+    if block_reason:
+        raise GeminiError("blocked", f"Prompt blocked: {getattr(block_reason, 'name', block_reason)}")
+    candidates = getattr(response, 'candidates', None)
+    if not candidates:
+        if require_content:
+            raise GeminiError("empty", "Response has no candidates")
+        return
+    reason = finish_reason_name(candidates[0])
+    if reason in BLOCKED_FINISH_REASONS:
+        raise GeminiError("blocked", f"Response blocked: {reason}")
+    if reason == "MAX_TOKENS":
+        raise GeminiError("truncated", "Response stopped at max_output_tokens")
+    content = getattr(candidates[0], 'content', None)
+    if require_content and not getattr(content, 'parts', None):
+        raise GeminiError("empty", "Response has no content")
+
+
+class AdaptiveLimit:
+    # AIMD concurrency limit: one more slot after a limit's worth of successes in a row, half the slots
+    # on a rate limit (at most once per cooldown, so a burst of 429s from one window only halves it once)
+    def __init__(self, maximum: int, minimum: int = 1, cooldown: float = 5.0):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.cooldown = cooldown
+        self.limit = self.maximum
+        self.active = 0
+        self.successes = 0
+        self.last_decrease = float('-inf')
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify()
+
+    def on_success(self) -> None:
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify()
+
+    def on_rate_limit(self) -> None:
+        with self.condition:
+            self.successes = 0
+            now = time.monotonic()
+            if now - self.last_decrease >= self.cooldown:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.last_decrease = now
+
+
+class GeminiScheduler:
+    # Shared by every Gemini call of a process: caps requests in flight with an AdaptiveLimit and retries
+    # rate-limit and server errors with full-jitter exponential backoff. The slot is released while backing off
+    def __init__(self, max_concurrency: int = 4, retries: int = 5, backoff: float = 2.0, max_backoff: float = 60.0,
+                 metrics: Metrics = None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.metrics = metrics or Metrics(enabled=False)
+        self.limit = AdaptiveLimit(self.max_concurrency)
+
+    def __getstate__(self):
+        return {"max_concurrency": self.max_concurrency, "retries": self.retries, "backoff": self.backoff,
+                "max_backoff": self.max_backoff, "metrics": self.metrics}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def slot(self):
+        return self.limit.slot()
+
+    def record_success(self) -> None:
+        self.limit.on_success()
+
+    def retry_delay(self, error: Exception, attempt: int) -> float:
+        # Seconds to wait before the next attempt, or None if the error is final
+        kind = classify_error(error)
+        self.metrics.inc("gemini_errors_total", kind=kind)
+        if kind == "rate_limit":
+            self.limit.on_rate_limit()
+        if kind not in RETRYABLE or attempt >= self.retries:
+            return None
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        self.metrics.inc("retries_total", call="gemini")
+        self.metrics.observe("gemini_backoff_seconds", delay)
+        logging.warning(f"Gemini {kind} error, retrying in {delay:.1f}s (attempt {attempt + 1}/{self.retries}, "
+                        f"concurrency limit {self.limit.limit}): {error}")
+        return delay
+
+    def call(self, request: Callable[[], Any], validate: Callable[[Any], None] = check_response) -> Any:
+        attempt = 0
+        while True:
+            try:
+                with self.slot():
+                    response = request()
+                    validate(response)
+                self.record_success()
+                return response
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None:
+                    raise GeminiError(classify_error(e), str(e)) from e
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,237 @@
+import contextlib
+import datetime
+import json
+import os
+import sqlite3
+from typing import Any, Dict, Iterable, Iterator, List
+
+# Items written per transaction, so a full library sync never holds more than a batch in memory
+BATCH_SIZE = 500
+# Kinds of document downloaded from Zotero; "youtube" documents are fetched as transcripts instead
+DOWNLOAD_KINDS = ("pdf", "docx", "document")
+
+
+def batched(values: Iterable[Any], size: int = BATCH_SIZE) -> Iterator[List[Any]]:
+    batch = []
+    for value in values:
+        batch.append(value)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class ItemStore:
+    # Every Zotero item as last synced, and the document each downloadable item becomes: its file name in the
+    # dated input folder, its parent item and its kind. Lives next to the dated folders so it spans runs, and
+    # replaces items.json and parent_item_mapping.json. SQLite lets worker processes share it
+    def __init__(self, store_path: str):
+        self.store_path = store_path
+        with self.connect() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS items (
+                    key TEXT PRIMARY KEY,
+                    version INTEGER,
+                    item_type TEXT,
+                    parent_key TEXT,
+                    md5 TEXT,
+                    deleted INTEGER NOT NULL DEFAULT 0,
+                    synced_at TEXT NOT NULL,
+                    data TEXT NOT NULL
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS items_parent ON items (parent_key)")
+            connection.execute("CREATE INDEX IF NOT EXISTS items_type ON items (item_type)")
+            connection.execute("CREATE INDEX IF NOT EXISTS items_version ON items (version)")
+            connection.execute("CREATE INDEX IF NOT EXISTS items_md5 ON items (md5)")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    document TEXT PRIMARY KEY,
+                    item_key TEXT NOT NULL UNIQUE,
+                    parent_item_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    file_name TEXT,
+                    url TEXT,
+                    md5 TEXT,
+                    fetched_at TEXT NOT NULL,
+                    duplicate_of TEXT
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS documents_parent ON documents (parent_item_id)")
+            connection.execute("CREATE INDEX IF NOT EXISTS documents_fetch ON documents (fetched_at, kind)")
+            connection.execute("CREATE INDEX IF NOT EXISTS documents_url ON documents (url)")
+            # Documents whose download or transcript failed. An incremental sync has already moved the library
+            # version past their items, so they are added to the next sync instead
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS failed_documents (
+                    document TEXT PRIMARY KEY,
+                    failed_at TEXT NOT NULL
+                )""")
+
+    def __getstate__(self):
+        return {"store_path": self.store_path}
+
+    def __setstate__(self, state):
+        self.__init__(state["store_path"])
+
+    @contextlib.contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.store_path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def upsert_items(self, connection: sqlite3.Connection, items: List[Dict[str, Any]], synced_at: str) -> None:
+        connection.executemany("""
+            INSERT INTO items VALUES (?, ?, ?, ?, ?, 0, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET version = excluded.version, item_type = excluded.item_type,
+                parent_key = excluded.parent_key, md5 = excluded.md5, deleted = 0, synced_at = excluded.synced_at,
+                data = excluded.data""",
+            [(item['data']['key'], item['data'].get('version', item.get('version')), item['data'].get('itemType'),
+              item['data'].get('parentItem'), item['data'].get('md5'), synced_at, json.dumps(item)) for item in items])
+
+    def assign_document(self, connection: sqlite3.Connection, entry: Dict[str, Any], fetched_at: str) -> str:
+        # An item gets the plain sanitised title unless another item already holds it, in which case its key
+        # tells them apart. It keeps whichever it got for as long as its title stays the same
+        item_key = entry["item"]['data']['key']
+        name = entry["name"] or item_key
+        current = connection.execute("SELECT document, duplicate_of FROM documents WHERE item_key = ?",
+                                     (item_key,)).fetchone()
+        if current and current["document"] in (name, f"{name}_{item_key}"):
+            document = current["document"]
+        else:
+            owner = connection.execute("SELECT item_key FROM documents WHERE document = ?", (name,)).fetchone()
+            document = f"{name}_{item_key}" if owner else name
+        file_name = f"{document}{os.path.splitext(entry['file_name'])[1]}" if entry.get("file_name") else None
+        duplicate_of = current["duplicate_of"] if current and current["document"] == document else None
+        # Replaces this item's row, under its new name if its title changed
+        connection.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           (document, item_key, entry["parent_item_id"], entry["kind"], file_name, entry.get("url"),
+                            entry.get("md5"), fetched_at, duplicate_of))
+        return document
+
+    def add_items(self, items: Iterable[Dict[str, Any]], classify) -> Dict[str, Any]:
+        # Upserts the items a batch at a time and names a document for each one classify gives a kind; the
+        # documents of this call are the ones documents(fetched_at) returns
+        fetched_at = datetime.datetime.now().isoformat()
+        stats = {"fetched_at": fetched_at, "items": 0, "documents": 0}
+        for batch in batched(items):
+            entries = [entry for entry in map(classify, batch) if entry and entry["kind"]]
+            with self.connect() as connection:
+                self.upsert_items(connection, batch, fetched_at)
+                for entry in entries:
+                    self.assign_document(connection, entry, fetched_at)
+            stats["items"] += len(batch)
+            stats["documents"] += len(entries)
+        return stats
+
+    def mark_deleted(self, keys: Iterable[str]) -> None:
+        with self.connect() as connection:
+            connection.executemany("UPDATE items SET deleted = 1 WHERE key = ?", [(key,) for key in keys])
+
+    def deleted_documents(self) -> List[Dict[str, Any]]:
+        # Documents whose own item or parent item was deleted from Zotero, as {"document", "parent_item_id"}.
+        # They stay here until forget_documents, so no deletion is missed by a stage run later
+        with self.connect() as connection:
+            rows = connection.execute("""
+                SELECT document, parent_item_id FROM documents
+                WHERE item_key IN (SELECT key FROM items WHERE deleted = 1)
+                    OR parent_item_id IN (SELECT key FROM items WHERE deleted = 1)
+                ORDER BY document""").fetchall()
+        return [self.row_document(row) for row in rows]
+
+    def forget_documents(self, names: Iterable[str]) -> None:
+        # Drops the documents of deleted items once they are out of the index; an item restored in Zotero
+        # later gets its document named again
+        names = [(name,) for name in names]
+        with self.connect() as connection:
+            connection.executemany("DELETE FROM documents WHERE document = ?", names)
+            connection.executemany("DELETE FROM failed_documents WHERE document = ?", names)
+
+    def row_document(self, row: sqlite3.Row) -> Dict[str, Any]:
+        document = {key: row[key] for key in row.keys() if key != "data"}
+        if "data" in row.keys():
+            document["item"] = json.loads(row["data"])
+        return document
+
+    def documents(self, fetched_at: str = None, kinds: Iterable[str] = None) -> Iterator[Dict[str, Any]]:
+        # Documents with the item they came from, as the downloader takes them. Read a page at a time, so no
+        # connection is held open while the caller works through them
+        conditions = ["documents.document > ?"]
+        parameters = []
+        if fetched_at:
+            conditions.append("documents.fetched_at = ?")
+            parameters.append(fetched_at)
+        if kinds:
+            kinds = list(kinds)
+            conditions.append(f"documents.kind IN ({','.join('?' * len(kinds))})")
+            parameters.extend(kinds)
+        query = ("SELECT documents.*, items.data FROM documents JOIN items ON items.key = documents.item_key "
+                 f"WHERE {' AND '.join(conditions)} ORDER BY documents.document LIMIT {BATCH_SIZE}")
+        last = ""
+        while True:
+            with self.connect() as connection:
+                rows = connection.execute(query, [last] + parameters).fetchall()
+            for row in rows:
+                yield self.row_document(row)
+            if len(rows) < BATCH_SIZE:
+                return
+            last = rows[-1]["document"]
+
+    def document(self, name: str) -> Dict[str, Any]:
+        with self.connect() as connection:
+            row = connection.execute("SELECT * FROM documents WHERE document = ?", (name,)).fetchone()
+        return self.row_document(row) if row else None
+
+    def documents_for_url(self, url: str) -> List[str]:
+        with self.connect() as connection:
+            return [row["document"] for row in connection.execute(
+                "SELECT document FROM documents WHERE url = ? ORDER BY document", (url,))]
+
+    def documents_with_md5(self, md5: str) -> List[Dict[str, Any]]:
+        # Documents of the live attachments with this content
+        with self.connect() as connection:
+            rows = connection.execute("SELECT documents.* FROM items JOIN documents ON documents.item_key = items.key "
+                                      "WHERE items.md5 = ? AND items.deleted = 0", (md5,)).fetchall()
+        return [self.row_document(row) for row in rows]
+
+    def set_duplicate(self, name: str, duplicate_of: str = None) -> None:
+        with self.connect() as connection:
+            connection.execute("UPDATE documents SET duplicate_of = ? WHERE document = ?", (duplicate_of, name))
+
+    def set_failed(self, names: Iterable[str], failed: bool = True) -> None:
+        with self.connect() as connection:
+            if failed:
+                failed_at = datetime.datetime.now().isoformat()
+                connection.executemany("INSERT OR REPLACE INTO failed_documents VALUES (?, ?)",
+                                       [(name, failed_at) for name in names])
+            else:
+                connection.executemany("DELETE FROM failed_documents WHERE document = ?", [(name,) for name in names])
+
+    def failed_items(self) -> List[Dict[str, Any]]:
+        # The live items of the documents that failed, as Zotero returned them
+        with self.connect() as connection:
+            rows = connection.execute("SELECT DISTINCT items.data FROM failed_documents "
+                                      "JOIN documents ON documents.document = failed_documents.document "
+                                      "JOIN items ON items.key = documents.item_key WHERE items.deleted = 0").fetchall()
+        return [json.loads(row["data"]) for row in rows]
+
+    def iter_items(self, item_type: str = None) -> Iterator[Dict[str, Any]]:
+        # Live items in key order, a page at a time
+        query = "SELECT key, data FROM items WHERE deleted = 0 AND key > ?"
+        parameters = []
+        if item_type:
+            query += " AND item_type = ?"
+            parameters.append(item_type)
+        query += f" ORDER BY key LIMIT {BATCH_SIZE}"
+        last = ""
+        while True:
+            with self.connect() as connection:
+                rows = connection.execute(query, [last] + parameters).fetchall()
+            for row in rows:
+                yield json.loads(row["data"])
+            if len(rows) < BATCH_SIZE:
+                return
+            last = rows[-1]["key"]
@@ -0,0 +1,78 @@
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+from typing import Dict, Any, Iterator
+
+# Per-document states, in pipeline order
+DOCUMENT_STATES = ['downloaded', 'extracted', 'formatted', 'indexed', 'rendered', 'attached']
+
+
+def file_hash(file_path: str, buffer_size: int = 1024 * 1024) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(buffer_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def document_name(file_name: str) -> str:
+    # "Foo.pdf", "Foo_processed.md" and "Foo_processed.pdf" all belong to document "Foo"
+    name = os.path.splitext(os.path.basename(file_name))[0]
+    return name[:-len("_processed")] if name.endswith("_processed") else name
+
+
+class RunManifest:
+    # SQLite rather than JSON so worker processes can record progress without clobbering each other
+    def __init__(self, manifest_path: str):
+        self.manifest_path = manifest_path
+        with self.connect() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS stages (
+                    document TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    input_hash TEXT,
+                    completed_at TEXT NOT NULL,
+                    info TEXT,
+                    PRIMARY KEY (document, stage)
+                )""")
+
+    def __getstate__(self):
+        return {"manifest_path": self.manifest_path}
+
+    def __setstate__(self, state):
+        self.__init__(state["manifest_path"])
+
+    @contextlib.contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.manifest_path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, document: str, stage: str) -> Dict[str, Any]:
+        with self.connect() as connection:
+            row = connection.execute("SELECT input_hash, completed_at, info FROM stages WHERE document = ? AND stage = ?",
+                                     (document, stage)).fetchone()
+        if not row:
+            return None
+        return {"input_hash": row[0], "completed_at": row[1], "info": json.loads(row[2]) if row[2] else {}}
+
+    def is_done(self, document: str, stage: str, input_hash: str) -> bool:
+        entry = self.get(document, stage)
+        return bool(entry) and entry["input_hash"] == input_hash
+
+    def mark_done(self, document: str, stage: str, input_hash: str, **info) -> None:
+        with self.connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)",
+                               (document, stage, input_hash, datetime.datetime.now().isoformat(), json.dumps(info)))
+
+    def summary(self) -> Dict[str, int]:
+        with self.connect() as connection:
+            rows = connection.execute("SELECT stage, COUNT(*) FROM stages GROUP BY stage").fetchall()
+        counts = dict(rows)
+        return {stage: counts.get(stage, 0) for stage in DOCUMENT_STATES}
@@ -0,0 +1,216 @@
+import bisect
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, Iterator, List, Tuple
+
+PREFIX = "zotero_pipeline_"
+# Upper bounds in seconds, spanning a quick API call up to a long pandoc render
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# Samples kept per histogram for percentiles; beyond this a uniform reservoir sample is kept
+MAX_SAMPLES = 10_000
+# Shared no-op context manager handed out by disabled timers
+NULL_TIMER = nullcontext()
+
+
+def series_key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...], extra: Dict[str, str] = None) -> str:
+    pairs = list(labels) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.samples = []
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(value)
+        else:
+            slot = random.randrange(self.count)
+            if slot < MAX_SAMPLES:
+                self.samples[slot] = value
+
+    def merge(self, other: "Histogram") -> None:
+        self.bucket_counts = [a + b for a, b in zip(self.bucket_counts, other.bucket_counts)]
+        self.count += other.count
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+        self.samples = (self.samples + other.samples)[:MAX_SAMPLES]
+
+    def percentile(self, fraction: float) -> float:
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else None
+
+    def summary(self) -> Dict[str, Any]:
+        return {"count": self.count, "sum": self.sum, "mean": self.sum / self.count if self.count else None,
+                "min": self.min, "max": self.max, "p50": self.percentile(0.5), "p95": self.percentile(0.95),
+                "p99": self.percentile(0.99)}
+
+
+class Metrics:
+    # Counters and histograms keyed by name and labels. When disabled every call returns straight away, so
+    # instrumented code can call it unconditionally. With trace_path set, each timed span is appended as a JSON line
+    def __init__(self, enabled: bool = True, trace_path: str = None):
+        self.enabled = enabled
+        self.trace_path = trace_path if enabled else None
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.trace_file = None
+        self.started = time.time()
+
+    def __getstate__(self):
+        # Worker processes start with empty series and hand theirs back with drain()
+        return {"enabled": self.enabled, "trace_path": self.trace_path}
+
+    def __setstate__(self, state):
+        self.__init__(state["enabled"], state["trace_path"])
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        if not self.enabled:
+            return
+        key = series_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        if not self.enabled:
+            return
+        key = series_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def timer(self, name: str, **labels):
+        if not self.enabled:
+            return NULL_TIMER
+        return self._timer(name, labels)
+
+    @contextmanager
+    def _timer(self, name: str, labels: Dict[str, Any]) -> Iterator[None]:
+        started = time.time()
+        perf_started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - perf_started
+            self.observe(name, seconds, **labels)
+            if self.trace_path:
+                self.trace(name, started, seconds, labels)
+
+    def trace(self, name: str, started: float, seconds: float, labels: Dict[str, Any]) -> None:
+        line = json.dumps({"span": name, "start": started, "seconds": seconds, "pid": os.getpid(),
+                           "thread": threading.current_thread().name, **{key: str(value) for key, value in labels.items()}})
+        with self.lock:
+            if self.trace_file is None:
+                self.trace_file = open(self.trace_path, 'a', encoding='utf-8')
+            self.trace_file.write(line + "\n")
+            self.trace_file.flush()
+
+    def drain(self) -> Dict[str, Any]:
+        # Hands the series over (e.g. from a worker process to the parent) and starts afresh
+        with self.lock:
+            drained = {"counters": self.counters, "histograms": self.histograms}
+            self.counters = {}
+            self.histograms = {}
+        return drained
+
+    def merge(self, drained: Dict[str, Any]) -> None:
+        if not self.enabled or not drained:
+            return
+        with self.lock:
+            for key, value in drained["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, histogram in drained["histograms"].items():
+                if key in self.histograms:
+                    self.histograms[key].merge(histogram)
+                else:
+                    self.histograms[key] = histogram
+
+    def counter_value(self, name: str, **labels) -> float:
+        return self.counters.get(series_key(name, labels), 0)
+
+    def report(self) -> Dict[str, Any]:
+        with self.lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{"name": name, "labels": dict(labels), **histogram.summary()}
+                          for (name, labels), histogram in sorted(self.histograms.items())]
+        return {"started": self.started, "finished": time.time(), "counters": counters, "histograms": histograms}
+
+    def write_json(self, path: str, extra: Dict[str, Any] = None) -> None:
+        if not self.enabled:
+            return
+        report = self.report()
+        report.update(extra or {})
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+        os.replace(tmp_path, path)
+
+    def prometheus_lines(self) -> List[str]:
+        lines = []
+        with self.lock:
+            counter_names = sorted({name for name, _ in self.counters})
+            for name in counter_names:
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                lines.extend(f"{PREFIX}{name}{format_labels(labels)} {value}"
+                             for (series, labels), value in sorted(self.counters.items()) if series == name)
+
+            histogram_names = sorted({name for name, _ in self.histograms})
+            for name in histogram_names:
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for (series, labels), histogram in sorted(self.histograms.items()):
+                    if series != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                        cumulative += count
+                        lines.append(f"{PREFIX}{name}_bucket{format_labels(labels, {'le': str(bound)})} {cumulative}")
+                    lines.append(f"{PREFIX}{name}_bucket{format_labels(labels, {'le': '+Inf'})} {histogram.count}")
+                    lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{PREFIX}{name}_count{format_labels(labels)} {histogram.count}")
+        return lines
+
+    def write_prometheus(self, path: str) -> None:
+        # node_exporter's textfile collector may read at any moment, so replace the file atomically
+        if not self.enabled:
+            return
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as prom_file:
+            prom_file.write("\n".join(self.prometheus_lines()) + "\n")
+        os.replace(tmp_path, path)
+
+    def close(self) -> None:
+        with self.lock:
+            if self.trace_file is not None:
+                self.trace_file.close()
+                self.trace_file = None
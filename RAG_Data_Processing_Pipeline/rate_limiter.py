@@ -0,0 +1,70 @@
+import threading
+import time
+
+# Roughly matches the old fixed 2 second sleep between chunks
+DEFAULT_REQUESTS_PER_MINUTE = 30
+DEFAULT_TOKENS_PER_MINUTE = 1_000_000
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute: float, burst_seconds: float = 1.0):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        # A single request larger than the bucket can never fit, so it only waits for a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    # Shared between worker threads; every call takes one request plus its estimated tokens
+    def __init__(self, requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: float = DEFAULT_TOKENS_PER_MINUTE, burst_seconds: float = 1.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.burst_seconds = burst_seconds
+        self.requests = TokenBucket(requests_per_minute, burst_seconds) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, burst_seconds) if tokens_per_minute else None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"requests_per_minute": self.requests_per_minute, "tokens_per_minute": self.tokens_per_minute,
+                "burst_seconds": self.burst_seconds}
+
+    def __setstate__(self, state):
+        self.__init__(state["requests_per_minute"], state["tokens_per_minute"], state["burst_seconds"])
+
+    def split(self, parts: int) -> 'RateLimiter':
+        # Each worker process gets an equal share of the quota since buckets can't be shared across processes
+        parts = max(1, parts)
+        return RateLimiter(self.requests_per_minute and self.requests_per_minute / parts,
+                           self.tokens_per_minute and self.tokens_per_minute / parts,
+                           self.burst_seconds)
+
+    def acquire(self, tokens: int = 0) -> float:
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                buckets = [(bucket, amount) for bucket, amount in ((self.requests, 1), (self.tokens, tokens)) if bucket]
+                for bucket, _ in buckets:
+                    bucket.refill(now)
+                wait = max((bucket.wait_time(amount) for bucket, amount in buckets), default=0.0)
+                if wait <= 0:
+                    for bucket, amount in buckets:
+                        bucket.take(amount)
+                    return waited
+            time.sleep(wait)
+            waited += wait
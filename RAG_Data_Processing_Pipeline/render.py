@@ -0,0 +1,111 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any
+
+from metrics import Metrics
+
+DEFAULT_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "custom-template.tex")
+MANIFEST_NAME = "render_manifest.json"
+
+
+def sanitize_text(text: str) -> str:
+    # The LaTeX template can't typeset most non-ASCII characters
+    return re.sub(r'[^\x00-\x7F]+', '', text)
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class MarkdownRenderer:
+    # Renders markdown to PDF with pandoc on a thread pool; each pandoc call is its own process
+    def __init__(self, template_path: str = DEFAULT_TEMPLATE, max_workers: int = 4, metrics: Metrics = None):
+        self.template_path = template_path
+        self.max_workers = max(1, max_workers)
+        self.metrics = metrics or Metrics(enabled=False)
+        self.lock = threading.Lock()
+        with open(template_path, 'rb') as f:
+            self.template_hash = content_hash(f.read())
+
+    def convert(self, markdown_content: str, pdf_path: str) -> None:
+        import pypandoc
+        pypandoc.convert_text(sanitize_text(markdown_content), 'pdf', format='md', outputfile=pdf_path,
+                              extra_args=[f'--template={self.template_path}'])
+
+    def load_manifest(self, output_dir: str) -> Dict[str, Any]:
+        manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            return {}
+        try:
+            with open(manifest_path, 'r') as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable render manifest {manifest_path}: {e}")
+            return {}
+
+    def save_manifest(self, output_dir: str, manifest: Dict[str, Any]) -> None:
+        manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        tmp_path = f"{manifest_path}.tmp"
+        with open(tmp_path, 'w') as json_file:
+            json.dump(manifest, json_file, indent=2)
+        os.replace(tmp_path, manifest_path)
+
+    def render(self, markdown_path: str, pdf_path: str, manifest: Dict[str, Any]) -> Dict[str, Any]:
+        pdf_name = os.path.basename(pdf_path)
+        with open(markdown_path, 'rb') as f:
+            markdown_bytes = f.read()
+        markdown_hash = content_hash(markdown_bytes)
+        result = {"file": pdf_name, "status": "skipped", "seconds": 0.0, "error": None, "markdown_hash": markdown_hash}
+
+        previous = manifest.get(pdf_name)
+        if (previous and os.path.exists(pdf_path) and previous["markdown_hash"] == markdown_hash
+                and previous["template_hash"] == self.template_hash):
+            return result
+
+        started = time.perf_counter()
+        try:
+            self.convert(markdown_bytes.decode('utf-8'), pdf_path)
+            result["status"] = "rendered"
+        except Exception as e:
+            logging.error(f"Error converting Markdown to PDF: {e}")
+            result["status"] = "failed"
+            result["error"] = str(e)
+        result["seconds"] = time.perf_counter() - started
+        self.metrics.observe("render_seconds", result["seconds"])
+
+        if result["status"] == "rendered":
+            with self.lock:
+                manifest[pdf_name] = {
+                    "markdown_hash": markdown_hash,
+                    "template_hash": self.template_hash,
+                    "seconds": result["seconds"],
+                    "rendered_at": datetime.datetime.now().isoformat()
+                }
+        return result
+
+    def render_directory(self, markdown_dir: str, output_dir: str = None) -> List[Dict[str, Any]]:
+        output_dir = output_dir or markdown_dir
+        manifest = self.load_manifest(output_dir)
+        jobs = [(os.path.join(markdown_dir, filename), os.path.join(output_dir, f"{os.path.splitext(filename)[0]}.pdf"))
+                for filename in sorted(os.listdir(markdown_dir)) if filename.endswith('.md')]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(lambda job: self.render(job[0], job[1], manifest), jobs))
+        self.save_manifest(output_dir, manifest)
+        for result in results:
+            self.metrics.inc("renders_total", status=result["status"])
+
+        for result in results:
+            if result["status"] == "rendered":
+                logging.info(f"Rendered {result['file']} in {result['seconds']:.1f}s")
+        rendered = sum(1 for result in results if result["status"] == "rendered")
+        skipped = sum(1 for result in results if result["status"] == "skipped")
+        logging.info(f"Render stage: {rendered} rendered, {skipped} unchanged, {len(results) - rendered - skipped} failed")
+        return results
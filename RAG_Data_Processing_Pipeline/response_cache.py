@@ -0,0 +1,101 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+DEFAULT_CACHE_MAX_BYTES = 500 * 1024 * 1024
+
+
+class ResponseCache:
+    # One file per response under a two character shard; file mtime doubles as the LRU clock
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_CACHE_MAX_BYTES, bypass: bool = False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(size for _, size, _ in self._entries())
+
+    def __getstate__(self):
+        return {"cache_dir": self.cache_dir, "max_bytes": self.max_bytes, "bypass": self.bypass}
+
+    def __setstate__(self, state):
+        self.__init__(state["cache_dir"], state["max_bytes"], state["bypass"])
+
+    @staticmethod
+    def make_key(model_name: str, system_prompt: str, is_first_chunk: bool, is_last_chunk: bool,
+                 generation_config: dict, content: str) -> str:
+        payload = json.dumps([model_name, system_prompt, is_first_chunk, is_last_chunk, generation_config, content],
+                             sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.txt")
+
+    def _entries(self):
+        for root, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith(".txt"):
+                    path = os.path.join(root, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key: str):
+        # With bypass set every lookup misses, but fresh responses are still written back
+        if self.bypass:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = f.read()
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: str) -> None:
+        # Empty strings are what generate_content returns on errors, never store them
+        if not value:
+            return
+        path = self._path(key)
+        data = value.encode('utf-8')
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not write response cache entry {key}: {e}")
+            return
+        with self.lock:
+            self.total_bytes += len(data)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        # Drop least recently used entries until we are back under 90% of the cap
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self.total_bytes = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for path, size, _ in entries:
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.total_bytes -= size
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.total_bytes}
@@ -0,0 +1,235 @@
+import argparse
+import contextlib
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+DEFAULT_DIM = 4096
+INITIAL_CAPACITY = 1024
+# Rows scored at a time by a query
+QUERY_BLOCK_ROWS = 65536
+TOKEN = re.compile(r"[a-z0-9]+")
+HEADER = re.compile(r"^#+\s*(.*?)\s*#*\s*$")
+# "**Interviewer**: ..." or "**Interviewer:** ..." at the start of a line, as SYSTEM_PROMPT asks for
+SPEAKER = re.compile(r"^\*\*([^*\n]{1,60}?):?\*\*:?\s*")
+
+
+def split_sections(markdown: str) -> List[Dict[str, str]]:
+    # One entry per speaker turn within each '#' section; text before the first header has an empty title
+    sections = []
+    title = ""
+    speaker = None
+    lines = []
+
+    def flush():
+        text = "\n".join(lines).strip()
+        if text:
+            sections.append({"title": title, "speaker": speaker, "text": text})
+        lines.clear()
+
+    for line in markdown.splitlines():
+        header = HEADER.match(line)
+        if header:
+            flush()
+            title = header.group(1)
+            speaker = None
+            continue
+        turn = SPEAKER.match(line)
+        if turn:
+            flush()
+            speaker = turn.group(1).strip()
+            line = line[turn.end():]
+        lines.append(line)
+    flush()
+    return sections
+
+
+def hashed_features(text: str, dim: int) -> np.ndarray:
+    # Sublinear term frequencies of words and word pairs, hashed into dim signed buckets. crc32 rather than
+    # hash() so vectors stay comparable between runs
+    counts = {}
+    tokens = TOKEN.findall(text.lower())
+    for feature in tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]:
+        counts[feature] = counts.get(feature, 0) + 1
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature, count in counts.items():
+        digest = zlib.crc32(feature.encode('utf-8'))
+        vector[digest % dim] += (1.0 if digest & 0x80000000 else -1.0) * (1.0 + math.log(count))
+    return vector
+
+
+class RetrievalIndex:
+    # Hashed TF vectors in a memory-mapped float32 matrix, one row per section, plus section metadata and
+    # document frequencies in SQLite. IDF weights are applied at query time, so adding or removing documents
+    # never rewrites existing rows. Rows of removed sections are zeroed and reused
+    def __init__(self, index_dir: str, dim: int = DEFAULT_DIM):
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+        self.db_path = os.path.join(index_dir, "index.db")
+        self.vectors_path = os.path.join(index_dir, "vectors.f32")
+        self.lock = threading.Lock()
+        with self.connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS sections (
+                    row INTEGER PRIMARY KEY,
+                    parent_item_id TEXT,
+                    document TEXT,
+                    title TEXT,
+                    speaker TEXT,
+                    text TEXT
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS sections_parent ON sections (parent_item_id)")
+            connection.execute("CREATE TABLE IF NOT EXISTS free_rows (row INTEGER PRIMARY KEY)")
+            connection.execute("CREATE TABLE IF NOT EXISTS df (bucket INTEGER PRIMARY KEY, count INTEGER NOT NULL)")
+            connection.execute("INSERT OR IGNORE INTO meta VALUES ('dim', ?)", (dim,))
+            connection.execute("INSERT OR IGNORE INTO meta VALUES ('capacity', ?)", (INITIAL_CAPACITY,))
+            connection.execute("INSERT OR IGNORE INTO meta VALUES ('rows', 0)")
+            meta = dict(connection.execute("SELECT key, value FROM meta").fetchall())
+        # An existing index keeps the dimension it was built with
+        self.dim = meta["dim"]
+        self.capacity = meta["capacity"]
+        self.rows = meta["rows"]
+        self.vectors = self.open_vectors(self.capacity)
+
+    @contextlib.contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def open_vectors(self, capacity: int) -> np.memmap:
+        size = capacity * self.dim * 4
+        with open(self.vectors_path, 'ab') as f:
+            if f.tell() < size:
+                f.truncate(size)
+        return np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+
+    def allocate_rows(self, connection: sqlite3.Connection, count: int) -> List[int]:
+        free = [row for row, in connection.execute("SELECT row FROM free_rows ORDER BY row LIMIT ?", (count,))]
+        connection.executemany("DELETE FROM free_rows WHERE row = ?", [(row,) for row in free])
+        new_rows = list(range(self.rows, self.rows + count - len(free)))
+        self.rows += len(new_rows)
+        if self.rows > self.capacity:
+            self.vectors.flush()
+            while self.capacity < self.rows:
+                self.capacity *= 2
+            self.vectors = self.open_vectors(self.capacity)
+            connection.execute("UPDATE meta SET value = ? WHERE key = 'capacity'", (self.capacity,))
+        connection.execute("UPDATE meta SET value = ? WHERE key = 'rows'", (self.rows,))
+        return free + new_rows
+
+    def update_df(self, connection: sqlite3.Connection, rows: List[int], sign: int) -> None:
+        buckets, counts = np.unique(np.nonzero(self.vectors[rows])[1], return_counts=True)
+        connection.executemany("INSERT INTO df VALUES (?, ?) ON CONFLICT(bucket) DO UPDATE SET count = count + ?",
+                               [(int(bucket), sign * int(count), sign * int(count))
+                                for bucket, count in zip(buckets, counts)])
+
+    def remove(self, parent_item_id: str, document: str = None) -> int:
+        with self.lock, self.connect() as connection:
+            if document is None:
+                rows = [row for row, in connection.execute("SELECT row FROM sections WHERE parent_item_id = ?",
+                                                           (parent_item_id,))]
+            else:
+                rows = [row for row, in connection.execute(
+                    "SELECT row FROM sections WHERE parent_item_id = ? AND document = ?", (parent_item_id, document))]
+            if not rows:
+                return 0
+            self.update_df(connection, rows, -1)
+            self.vectors[rows] = 0
+            connection.executemany("DELETE FROM sections WHERE row = ?", [(row,) for row in rows])
+            connection.executemany("INSERT INTO free_rows VALUES (?)", [(row,) for row in rows])
+        self.vectors.flush()
+        return len(rows)
+
+    def add_document(self, parent_item_id: str, document: str, markdown: str) -> int:
+        # Replaces whatever was indexed for this document before
+        self.remove(parent_item_id, document)
+        sections = split_sections(markdown)
+        if not sections:
+            return 0
+        vectors = np.stack([hashed_features(f"{section['title']}\n{section['text']}", self.dim) for section in sections])
+        with self.lock, self.connect() as connection:
+            rows = self.allocate_rows(connection, len(sections))
+            self.vectors[rows] = vectors
+            self.update_df(connection, rows, 1)
+            connection.executemany("INSERT INTO sections VALUES (?, ?, ?, ?, ?, ?)",
+                                   [(row, parent_item_id, document, section["title"], section["speaker"], section["text"])
+                                    for row, section in zip(rows, sections)])
+        self.vectors.flush()
+        return len(sections)
+
+    def idf(self, connection: sqlite3.Connection) -> np.ndarray:
+        sections = connection.execute("SELECT COUNT(*) FROM sections").fetchone()[0]
+        df = np.zeros(self.dim, dtype=np.float32)
+        for bucket, count in connection.execute("SELECT bucket, count FROM df"):
+            df[bucket] = count
+        return (np.log((1 + sections) / (1 + df)) + 1).astype(np.float32)
+
+    def query(self, text: str, k: int = 10) -> List[Dict[str, Any]]:
+        with self.lock, self.connect() as connection:
+            if not self.rows:
+                return []
+            idf_squared = self.idf(connection) ** 2
+            query = hashed_features(text, self.dim)
+            query_norm = math.sqrt(float((query * query) @ idf_squared))
+            if not query_norm:
+                return []
+            weighted_query = query * idf_squared / query_norm
+            # Cosine similarity of the IDF-weighted vectors, a block of rows at a time so neither the whole
+            # matrix nor a weighted copy of it is ever held in memory
+            scores = np.empty(self.rows, dtype=np.float32)
+            for start in range(0, self.rows, QUERY_BLOCK_ROWS):
+                block = np.asarray(self.vectors[start:min(start + QUERY_BLOCK_ROWS, self.rows)])
+                norms = np.sqrt((block * block) @ idf_squared)
+                scores[start:start + len(block)] = np.where(norms > 0, (block @ weighted_query) / np.maximum(norms, 1e-12), 0)
+            k = min(k, int(np.count_nonzero(scores > 0)))
+            if k <= 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            placeholders = ",".join("?" * len(top))
+            metadata = {row: values for row, *values in connection.execute(
+                f"SELECT row, parent_item_id, document, title, speaker, text FROM sections WHERE row IN ({placeholders})",
+                [int(row) for row in top])}
+        results = []
+        for row in top:
+            parent_item_id, document, title, speaker, section_text = metadata[int(row)]
+            results.append({"score": float(scores[row]), "parent_item_id": parent_item_id, "document": document,
+                            "title": title, "speaker": speaker, "text": section_text})
+        return results
+
+    def documents(self) -> Dict[Tuple[str, str], int]:
+        with self.connect() as connection:
+            rows = connection.execute("SELECT parent_item_id, document, COUNT(*) FROM sections "
+                                      "GROUP BY parent_item_id, document").fetchall()
+        return {(parent_item_id, document): count for parent_item_id, document, count in rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search the sections of the processed documents.")
+    parser.add_argument('query', help='Free-text query.')
+    parser.add_argument('--index_dir', default=os.path.join(os.getenv('SAVE_PATH', '.'), "retrieval_index"))
+    parser.add_argument('-k', type=int, default=5, help='Number of sections to return.')
+    args = parser.parse_args()
+
+    index = RetrievalIndex(args.index_dir)
+    for result in index.query(args.query, args.k):
+        heading = " / ".join(part for part in (result["title"], result["speaker"]) if part)
+        print(f"{result['score']:.3f}  {result['document']} ({result['parent_item_id']})  {heading}")
+        print(f"       {result['text'][:200]!r}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
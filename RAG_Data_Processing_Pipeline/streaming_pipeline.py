@@ -0,0 +1,153 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List
+
+# Marks the end of a stage's input
+_DONE = object()
+
+
+class Stage:
+    # func takes one item and returns the item for the next stage, or None to drop it
+    def __init__(self, name: str, func: Callable[[Any], Any], workers: int = 1, queue_size: int = 8):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.inbox = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.depth_samples = 0
+        self.depth_total = 0
+        self.max_depth = 0
+        self.started = None
+        self.finished = None
+
+    def sample_depth(self) -> None:
+        depth = self.inbox.qsize()
+        self.depth_samples += 1
+        self.depth_total += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def stats(self) -> Dict[str, Any]:
+        elapsed = ((self.finished or time.perf_counter()) - self.started) if self.started else 0.0
+        return {
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "workers": self.workers,
+            "busy_seconds": self.busy_seconds,
+            # Close to 1.0 means every worker of this stage was busy the whole time: the bottleneck
+            "utilisation": self.busy_seconds / (elapsed * self.workers) if elapsed else 0.0,
+            "items_per_second": self.processed / elapsed if elapsed else 0.0,
+            "queue_depth": self.inbox.qsize(),
+            "max_queue_depth": self.max_depth,
+            "mean_queue_depth": self.depth_total / self.depth_samples if self.depth_samples else 0.0,
+        }
+
+
+class StreamingPipeline:
+    # Stages run concurrently and are connected by bounded queues, so an item moves on as soon as it is ready
+    def __init__(self, stages: List[Stage], report_interval: float = 30.0, sample_interval: float = 0.5,
+                 on_report: Callable[[], None] = None, label: Callable[[Any], str] = None):
+        self.stages = stages
+        self.report_interval = report_interval
+        self.sample_interval = sample_interval
+        # Called along with log_stats, e.g. to log progress the stages don't see
+        self.on_report = on_report
+        # Names an item in the log when a stage fails on it; items can be large, so they are never logged whole
+        self.label = label or (lambda item: type(item).__name__)
+        self.results = []
+        self.results_lock = threading.Lock()
+
+    def _worker(self, index: int, remaining: List[int]) -> None:
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            item = stage.inbox.get()
+            if item is _DONE:
+                break
+            started = time.perf_counter()
+            try:
+                output = stage.func(item)
+            except Exception as e:
+                logging.error(f"Stage {stage.name} failed on {self.label(item)}: {e}")
+                output = None
+                with stage.lock:
+                    stage.errors += 1
+            with stage.lock:
+                stage.busy_seconds += time.perf_counter() - started
+                stage.processed += 1
+                if output is None:
+                    stage.dropped += 1
+            if output is None:
+                continue
+            if next_stage:
+                next_stage.inbox.put(output)
+            else:
+                with self.results_lock:
+                    self.results.append(output)
+
+        # The last worker of a stage to finish tells every worker of the next stage to stop
+        with stage.lock:
+            remaining[index] -= 1
+            last = remaining[index] == 0
+            if last:
+                stage.finished = time.perf_counter()
+        if last and next_stage:
+            for _ in range(next_stage.workers):
+                next_stage.inbox.put(_DONE)
+
+    def _feed(self, items: Iterable[Any]) -> None:
+        first = self.stages[0]
+        try:
+            for item in items:
+                first.inbox.put(item)
+        except Exception as e:
+            logging.error(f"Pipeline source failed: {e}")
+        finally:
+            for _ in range(first.workers):
+                first.inbox.put(_DONE)
+
+    def run(self, items: Iterable[Any]) -> List[Any]:
+        remaining = [stage.workers for stage in self.stages]
+        started = time.perf_counter()
+        for stage in self.stages:
+            stage.started = started
+
+        threads = [threading.Thread(target=self._feed, args=(items,), name="pipeline-source", daemon=True)]
+        for index, stage in enumerate(self.stages):
+            threads.extend(threading.Thread(target=self._worker, args=(index, remaining), name=f"{stage.name}-{n}",
+                                            daemon=True)
+                           for n in range(stage.workers))
+        for thread in threads:
+            thread.start()
+
+        last_report = started
+        while any(thread.is_alive() for thread in threads):
+            threads[-1].join(self.sample_interval)
+            for stage in self.stages:
+                stage.sample_depth()
+            if time.perf_counter() - last_report >= self.report_interval:
+                self.report()
+                last_report = time.perf_counter()
+
+        self.report()
+        return self.results
+
+    def report(self) -> None:
+        self.log_stats()
+        if self.on_report:
+            self.on_report()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def log_stats(self) -> None:
+        for name, stats in self.stats().items():
+            logging.info(f"Stage {name}: {stats['processed']} done ({stats['errors']} errors, {stats['dropped']} dropped), "
+                         f"{stats['items_per_second']:.2f}/s, utilisation {stats['utilisation']:.0%}, "
+                         f"queue {stats['queue_depth']} (max {stats['max_queue_depth']}, mean {stats['mean_queue_depth']:.1f})")
@@ -0,0 +1,141 @@
+import json
+import logging
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+from metrics import Metrics
+
+# "LIBRARY", "LIBRARY/COLLECTION", optionally followed by "=WEIGHT"
+TARGET_SPEC = re.compile(r"^\s*([^/=\s]+)(?:/([^=\s]+))?(?:=([0-9]*\.?[0-9]+))?\s*$")
+
+
+class Target:
+    # A Zotero group library, or one collection of it, processed under its own folder. weight is its share of
+    # the shared pools relative to the other targets
+    def __init__(self, library: str, collection_id: str = None, weight: float = 1.0):
+        if weight <= 0:
+            raise ValueError(f"Target weight must be positive, got {weight}")
+        self.library = str(library)
+        self.collection_id = collection_id
+        self.weight = weight
+
+    @classmethod
+    def parse(cls, spec: str) -> "Target":
+        match = TARGET_SPEC.match(spec)
+        if not match:
+            raise ValueError(f"Invalid target {spec!r}, expected LIBRARY[/COLLECTION][=WEIGHT]")
+        library, collection_id, weight = match.groups()
+        return cls(library, collection_id, float(weight) if weight else 1.0)
+
+    @property
+    def name(self) -> str:
+        return f"{self.library}/{self.collection_id}" if self.collection_id else self.library
+
+    @property
+    def folder_name(self) -> str:
+        name = f"group_{self.library}"
+        return f"{name}_collection_{self.collection_id}" if self.collection_id else name
+
+    def __repr__(self):
+        return f"Target({self.name!r}, weight={self.weight})"
+
+
+def load_targets(specs: List[str] = None, targets_file: str = None) -> List[Target]:
+    # targets_file holds a JSON list of {"library": ..., "collection": ..., "weight": ...}
+    targets = [Target.parse(spec) for spec in specs or []]
+    if targets_file:
+        with open(targets_file, 'r') as json_file:
+            targets.extend(Target(entry["library"], entry.get("collection"), float(entry.get("weight", 1.0)))
+                           for entry in json.load(json_file))
+    names = [target.name for target in targets]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Targets listed more than once: {', '.join(duplicates)}")
+    return targets
+
+
+def fair_share(sources: Dict[str, Iterable[Any]], weights: Dict[str, float]) -> Iterator[Tuple[str, Any]]:
+    # Interleaves the sources by smooth weighted round robin: every turn each source still running earns its
+    # weight in credit, and the one with the most credit yields next and pays back the total. Over any stretch
+    # each source gets its weighted share of the turns, evenly spread, and an exhausted source's share goes to
+    # the rest. Sources are only advanced when they yield, so they can be lazy
+    iterators = {name: iter(source) for name, source in sources.items()}
+    credit = {name: 0.0 for name in iterators}
+    while iterators:
+        total = sum(weights.get(name, 1.0) for name in iterators)
+        for name in iterators:
+            credit[name] += weights.get(name, 1.0)
+        name = max(iterators, key=lambda candidate: credit[candidate])
+        credit[name] -= total
+        try:
+            item = next(iterators[name])
+        except StopIteration:
+            del iterators[name]
+            del credit[name]
+            continue
+        yield name, item
+
+
+class TargetProgress:
+    # Per-target counts of what each stage finished, dropped and spent time on, for the targets sharing a pipeline
+    def __init__(self, targets: Iterable[str], stages: List[str], metrics: Metrics = None):
+        self.stages = list(stages)
+        self.metrics = metrics or Metrics(enabled=False)
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        # last is when the target last had a document through the final stage
+        self.targets = {name: {"documents": 0, "stages": {}, "last": None} for name in targets}
+
+    def set_documents(self, target: str, documents: int) -> None:
+        with self.lock:
+            self.targets[target]["documents"] = documents
+
+    def record(self, target: str, stage: str, seconds: float, dropped: bool = False) -> None:
+        with self.lock:
+            counts = self.targets[target]["stages"].setdefault(stage, {"processed": 0, "dropped": 0, "busy_seconds": 0.0})
+            counts["processed"] += 1
+            counts["dropped"] += dropped
+            counts["busy_seconds"] += seconds
+            if stage == self.stages[-1] and not dropped:
+                self.targets[target]["last"] = time.perf_counter()
+        self.metrics.inc("target_stage_documents_total", target=target, stage=stage,
+                         status="dropped" if dropped else "ok")
+        self.metrics.observe("target_stage_seconds", seconds, target=target, stage=stage)
+
+    def wrap(self, stage: str, func: Callable[[Dict[str, Any]], Any],
+             target_of: Callable[[Dict[str, Any]], str]) -> Callable[[Dict[str, Any]], Any]:
+        # The stage function, recording each call under the target of the item it was given
+        def recorded(item: Dict[str, Any]) -> Any:
+            started = time.perf_counter()
+            output = None
+            try:
+                output = func(item)
+                return output
+            finally:
+                self.record(target_of(item), stage, time.perf_counter() - started, output is None)
+        return recorded
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        now = time.perf_counter()
+        with self.lock:
+            stats = {}
+            for name, target in self.targets.items():
+                last_stage = target["stages"].get(self.stages[-1], {})
+                completed = last_stage.get("processed", 0) - last_stage.get("dropped", 0)
+                # Up to its last finished document, so a target that is through isn't timed until the others are
+                elapsed = (target["last"] or now) - self.started
+                stats[name] = {
+                    "documents": target["documents"],
+                    "completed": completed,
+                    "documents_per_minute": completed * 60 / elapsed if elapsed else 0.0,
+                    "stages": {stage: dict(counts) for stage, counts in target["stages"].items()},
+                }
+        return stats
+
+    def log_stats(self) -> None:
+        for name, stats in self.stats().items():
+            stages = ", ".join(f"{stage} {counts['processed'] - counts['dropped']}" for stage, counts in stats["stages"].items())
+            logging.info(f"Target {name}: {stats['completed']} of {stats['documents']} documents done, "
+                         f"{stats['documents_per_minute']:.1f}/min ({stages or 'not started'})")
@@ -1,27 +1,14 @@
-import pypandoc
-import os
+from render import MarkdownRenderer
 
-# Define the path to your markdown file and the custom LaTeX template
-markdown_file_path = r'C:\Users\kamdy\Desktop\CultureX\github\RAG_Data_Processing_Pipeline\Data\test\output'  # Replace with the actual path to your Markdown file
+# Define the path to your markdown files and the custom LaTeX template
+markdown_file_path = r'C:\Users\kamdy\Desktop\CultureX\github\RAG_Data_Processing_Pipeline\Data\test\output'  # Replace with the actual path to your Markdown files
 custom_template_path = r'C:\Users\kamdy\Desktop\CultureX\github\RAG_Data_Processing_Pipeline\custom-template.tex'  # Replace with the actual path to your custom LaTeX template
-output_pdf_path = r'C:\Users\kamdy\Desktop\CultureX\github\RAG_Data_Processing_Pipeline\Data\test'  # Replace with the desired output path for the PDF
+output_pdf_path = r'C:\Users\kamdy\Desktop\CultureX\github\RAG_Data_Processing_Pipeline\Data\test'  # Replace with the desired output path for the PDFs
 
-for filename in os.listdir(markdown_file_path):
-    if filename.endswith('.md'):  # Process only Markdown files
-        # Full path to the Markdown file
-        source_file = os.path.join(markdown_file_path, filename)
-        # Full path for the output PDF file
-        output_file = os.path.join(output_pdf_path, os.path.splitext(filename)[0] + '.pdf')
-        
-        # Convert the Markdown file to PDF using the custom LaTeX template
-        try:
-            output = pypandoc.convert_file(
-                source_file=source_file,
-                to='pdf',
-                format='md',
-                outputfile=output_file,
-                extra_args=[f'--template={custom_template_path}']
-            )
-            print(f"PDF successfully created at {output_file}")
-        except Exception as e:
-            print(f"Error during conversion of {filename}: {e}")
+# Convert every Markdown file to PDF with the custom LaTeX template, skipping files unchanged since the last render
+renderer = MarkdownRenderer(custom_template_path)
+for result in renderer.render_directory(markdown_file_path, output_pdf_path):
+    if result["status"] == "rendered":
+        print(f"PDF successfully created for {result['file']} in {result['seconds']:.1f}s")
+    elif result["status"] == "failed":
+        print(f"Error during conversion of {result['file']}: {result['error']}")
@@ -0,0 +1,61 @@
+import os
+import sys
+import tempfile
+import unittest
+from typing import Any, Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from item_store import ItemStore
+from retrieval_index import RetrievalIndex
+from Main import remove_deleted_documents
+
+MARKDOWN = "# Introduction\nSome text about {name}.\n\n# Results\nMore text about {name}.\n"
+
+
+def attachment(key: str, parent_key: str) -> Dict[str, Any]:
+    return {"key": key, "version": 1, "data": {"key": key, "version": 1, "itemType": "attachment",
+                                               "parentItem": parent_key, "title": f"Attachment {key}"}}
+
+
+def classify(item: Dict[str, Any]) -> Dict[str, Any]:
+    data = item["data"]
+    if data["itemType"] != "attachment":
+        return None
+    return {"kind": "pdf", "name": data["title"].replace(" ", "_"), "parent_item_id": data["parentItem"],
+            "file_name": f"{data['key']}.pdf", "item": item}
+
+
+class DeletedDocumentsTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.item_store = ItemStore(os.path.join(self.temp_dir.name, "items.db"))
+        self.index = RetrievalIndex(os.path.join(self.temp_dir.name, "index"))
+        parent = {"key": "PARENT", "version": 1, "data": {"key": "PARENT", "version": 1, "itemType": "book", "title": "Book"}}
+        self.item_store.add_items([parent, attachment("ATTACH1", "PARENT"), attachment("ATTACH2", "PARENT")], classify)
+        for document in self.item_store.documents():
+            self.index.add_document(document["parent_item_id"], document["document"],
+                                    MARKDOWN.format(name=document["document"]))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def indexed_documents(self):
+        with self.index.connect() as connection:
+            return sorted(document for document, in connection.execute("SELECT DISTINCT document FROM sections"))
+
+    def test_deleted_attachment_leaves_sibling(self):
+        self.item_store.mark_deleted(["ATTACH1"])
+        self.assertEqual(remove_deleted_documents(self.index, self.item_store), 2)
+        self.assertEqual(self.indexed_documents(), ["Attachment_ATTACH2"])
+        # Removed once; a later pass has nothing left to remove
+        self.assertEqual(remove_deleted_documents(self.index, self.item_store), 0)
+
+    def test_deleted_parent_removes_all_attachments(self):
+        self.item_store.mark_deleted(["PARENT"])
+        self.assertEqual(remove_deleted_documents(self.index, self.item_store), 4)
+        self.assertEqual(self.indexed_documents(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
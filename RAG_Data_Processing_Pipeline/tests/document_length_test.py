@@ -1,60 +1,198 @@
+import math
 import os
 import logging
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+from chunker import Chunker
+from Gemini_api import DocumentProcessor
+
+INPUT_EXTENSIONS = (".txt", ".pdf", ".docx", ".rtf")
+# Characters read from disk at a time
+BUFFER_SIZE = 1024 * 1024
+WORD = re.compile(r"\S+")
+NON_WORD = re.compile(r"\W+")
+# Rolling hash over word hashes: polynomial mod a Mersenne prime
+HASH_BASE = 1_000_003
+HASH_MOD = (1 << 61) - 1
+
+
+def iter_words(pieces: Iterable[str]) -> Iterator[Tuple[int, str]]:
+    # (character offset, word) for every whitespace-separated word, with words split across pieces rejoined
+    offset = 0
+    carry = ""
+    for piece in pieces:
+        text = carry + piece
+        base = offset - len(carry)
+        offset += len(piece)
+        end = len(text)
+        if text and not text[-1].isspace():
+            # The last word may continue in the next piece
+            last_space = max(text.rfind(" "), text.rfind("\n"), text.rfind("\t"), text.rfind("\r"))
+            end = last_space + 1
+        for match in WORD.finditer(text, 0, end):
+            yield base + match.start(), match.group()
+        carry = text[end:]
+    if carry.strip():
+        yield offset - len(carry), carry.strip()
+
+
+def iter_ngrams(words: Iterable[Tuple[int, str]], n: int, sample: int) -> Iterator[Tuple[int, int]]:
+    # (offset of the first word, hash) of every sampled n-gram of normalised words. Sampling on the hash keeps
+    # the same n-grams on both sides, so input and output can be compared on a fraction of them
+    window = deque()
+    drop = pow(HASH_BASE, n - 1, HASH_MOD)
+    rolling = 0
+    for offset, word in words:
+        word = NON_WORD.sub("", word.lower())
+        if not word:
+            continue
+        word_hash = hash(word) & 0xFFFFFFFF
+        if len(window) == n:
+            rolling = (rolling - window.popleft()[1] * drop) % HASH_MOD
+        window.append((offset, word_hash))
+        rolling = (rolling * HASH_BASE + word_hash) % HASH_MOD
+        if len(window) == n and rolling % sample == 0:
+            yield window[0][0], rolling
+
+
+class TextStats:
+    def __init__(self):
+        self.chars = 0
+        self.words = 0
+
+    def count(self, pieces: Iterable[str]) -> Iterator[str]:
+        # Passes the pieces through while counting characters and words, so one pass feeds every check
+        in_word = False
+        for piece in pieces:
+            if not piece:
+                continue
+            self.chars += len(piece)
+            self.words += len(piece.split()) - (1 if in_word and not piece[0].isspace() else 0)
+            in_word = not piece[-1].isspace()
+            yield piece
+
 
 class DocumentLengthTest:
-    
-    def __init__(self, input_folder_path, output_folder_path, max_tokens=8000, overlap=20):
+
+    def __init__(self, input_folder_path, output_folder_path, max_tokens=8000, overlap=20, workers=None,
+                 ngram_size=5, ngram_sample=4, min_coverage=0.5, output_paths=None, extraction=None):
         self.input_folder_path = input_folder_path
         self.output_folder_path = output_folder_path
         self.max_tokens = max_tokens
         self.overlap = overlap
+        self.workers = workers or os.cpu_count() or 1
+        self.ngram_size = ngram_size
+        self.ngram_sample = ngram_sample
+        # A chunk half with fewer of its sampled n-grams in the output than this counts as dropped or truncated
+        self.min_coverage = min_coverage
+        # Document name -> markdown to check instead of its own, for near-duplicates that reuse another's output
+        self.output_paths = output_paths or {}
+        # A TextExtraction with a cache reads the text the format stage extracted instead of the original files
+        self.extraction = extraction
+        chunker = Chunker(max_tokens, overlap)
+        self.max_chars = chunker.max_chars
+        self.overlap_chars = chunker.overlap_chars
 
     def word_count(self, text):
         return len(text.split())
 
     def chunk_text(self, text: str) -> list:
-        words = text.split()
-        chunks = []
-        start = 0
-
-        while start < len(words):
-            end = start + self.max_tokens
-            if end > len(words):
-                end = len(words)
-            chunk = " ".join(words[start:end])
-            chunks.append(chunk)
-            start = end - self.overlap if end < len(words) else end
-
-        return chunks
-
-    def run_test(self):
-        for filename in os.listdir(self.input_folder_path):
-            if filename.endswith('.txt'):
-                # Read input file
-                input_file_path = os.path.join(self.input_folder_path, filename)
-                with open(input_file_path, 'r', encoding='utf-8') as f:
-                    input_text = f.read()
-                
-                # Calculate the expected length of the processed document
-                input_word_count = self.word_count(input_text)
-                expected_chunks = self.chunk_text(input_text)
-                expected_word_count = sum(self.word_count(chunk) for chunk in expected_chunks)
-                
-                # Construct corresponding output file path
-                output_filename = filename.replace('.txt', '_processed.md')
-                output_file_path = os.path.join(self.output_folder_path, output_filename)
-                
-                # Read output file
-                if os.path.exists(output_file_path):
-                    with open(output_file_path, 'r', encoding='utf-8') as f:
-                        output_text = f.read()
-                    
-                    # Compare word counts
-                    output_word_count = self.word_count(output_text)
-                    
-                    if output_word_count >= expected_word_count:
-                        logging.info(f"Document {output_filename} passed.")
-                    else:
-                        logging.warning(f"Document {output_filename} did not pass. Output has fewer words than expected. (Expected at least {expected_word_count}, got {output_word_count})")
-                else:
-                    logging.warning(f"Output file {output_filename} does not exist for input file {filename}")
+        # Must match how DocumentProcessor chunks the input, so both use the shared chunker
+        return Chunker(self.max_tokens, self.overlap).chunk_text(text)
+
+    def chunk_count(self, chars: int) -> int:
+        # Windows of max_chars that each start overlap_chars before the previous one ended. Boundary-aware cuts
+        # only ever add chunks, so this is the fewest the chunker can produce
+        if chars <= self.max_chars:
+            return 1 if chars else 0
+        return 1 + math.ceil((chars - self.max_chars) / (self.max_chars - self.overlap_chars))
+
+    def expected_word_count(self, chars: int, words: int) -> int:
+        # Every word once, plus the words of each overlap that is sent to Gemini twice
+        if not chars:
+            return 0
+        overlap_words = words * self.overlap_chars / chars
+        return int(words + (self.chunk_count(chars) - 1) * overlap_words)
+
+    def iter_file(self, file_path: str) -> Iterator[str]:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for buffer in iter(lambda: f.read(BUFFER_SIZE), ''):
+                yield buffer
+
+    def iter_input(self, file_path: str) -> Iterator[str]:
+        if file_path.endswith(".txt"):
+            yield from self.iter_file(file_path)
+            return
+        # Same text DocumentProcessor sends to Gemini: its pieces joined with newlines
+        processor = DocumentProcessor(self.input_folder_path, self.output_folder_path, extraction=self.extraction)
+        for i, piece in enumerate(processor.iter_text(file_path)):
+            if i:
+                yield "\n"
+            yield piece
+
+    def segment_chars(self) -> int:
+        # Each chunk's new text is checked in two halves, so a chunk cut off halfway shows up too
+        return max(1, (self.max_chars - self.overlap_chars) // 2)
+
+    def validate(self, filename: str) -> Dict[str, Any]:
+        input_file_path = os.path.join(self.input_folder_path, filename)
+        output_filename = f"{os.path.splitext(filename)[0]}_processed.md"
+        output_file_path = (self.output_paths.get(os.path.splitext(filename)[0])
+                            or os.path.join(self.output_folder_path, output_filename))
+        result = {"file": filename, "output": output_filename, "status": "missing", "input_words": 0,
+                  "expected_words": 0, "output_words": 0, "chunks": 0, "uncovered_chunks": []}
+        if not os.path.exists(output_file_path):
+            return result
+
+        output_stats = TextStats()
+        output_ngrams = {ngram for _, ngram in iter_ngrams(iter_words(output_stats.count(self.iter_file(output_file_path))),
+                                                         self.ngram_size, self.ngram_sample)}
+
+        input_stats = TextStats()
+        segment_chars = self.segment_chars()
+        segments = {}
+        for offset, ngram in iter_ngrams(iter_words(input_stats.count(self.iter_input(input_file_path))),
+                                         self.ngram_size, self.ngram_sample):
+            found, total = segments.get(offset // segment_chars, (0, 0))
+            segments[offset // segment_chars] = (found + (ngram in output_ngrams), total + 1)
+
+        result.update(input_words=input_stats.words, output_words=output_stats.words,
+                      chunks=self.chunk_count(input_stats.chars),
+                      expected_words=self.expected_word_count(input_stats.chars, input_stats.words))
+        uncovered = {}
+        for segment, (found, total) in sorted(segments.items()):
+            # Too few samples say nothing either way
+            if total >= 4 and found / total < self.min_coverage:
+                chunk = min(segment * segment_chars // (self.max_chars - self.overlap_chars), result["chunks"] - 1) + 1
+                uncovered[chunk] = min(uncovered.get(chunk, 1.0), found / total)
+        result["uncovered_chunks"] = [{"chunk": chunk, "coverage": coverage} for chunk, coverage in sorted(uncovered.items())]
+        passed = result["output_words"] >= result["expected_words"] and not uncovered
+        result["status"] = "passed" if passed else "failed"
+        return result
+
+    def input_files(self) -> List[str]:
+        return sorted(filename for filename in os.listdir(self.input_folder_path)
+                      if filename.endswith(INPUT_EXTENSIONS) and not filename.startswith("youtube_links_"))
+
+    def run_test(self) -> List[Dict[str, Any]]:
+        filenames = self.input_files()
+        if self.workers <= 1 or len(filenames) < 2:
+            results = [self.validate(filename) for filename in filenames]
+        else:
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(filenames))) as executor:
+                results = list(executor.map(self.validate, filenames))
+
+        for result in results:
+            if result["status"] == "missing":
+                logging.warning(f"Output file {result['output']} does not exist for input file {result['file']}")
+            elif result["status"] == "passed":
+                logging.info(f"Document {result['output']} passed.")
+            elif result["output_words"] < result["expected_words"]:
+                logging.warning(f"Document {result['output']} did not pass. Output has fewer words than expected. (Expected at least {result['expected_words']}, got {result['output_words']})")
+            else:
+                chunks = ", ".join(f"{entry['chunk']} ({entry['coverage']:.0%})" for entry in result["uncovered_chunks"])
+                logging.warning(f"Document {result['output']} did not pass. Text of chunks {chunks} is missing from the output.")
+        return results
@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+from urllib.parse import parse_qs, urlparse
+
+from Zotero_RAG import sanitize_filename
+
+VIDEO_ID = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+
+def extract_video_id(url: str) -> str:
+    # Handles watch?v=, youtu.be/, /embed/, /shorts/ and /live/ links; returns None for anything else
+    url = url.strip()
+    if VIDEO_ID.match(url):
+        return url
+    parsed = urlparse(url if "://" in url else f"https://{url}")
+    host = parsed.netloc.lower().split(':')[0]
+    if host.startswith("www.") or host.startswith("m."):
+        host = host.split('.', 1)[1]
+    video_id = None
+    if host == "youtu.be":
+        video_id = parsed.path.strip('/').split('/')[0]
+    elif host in ("youtube.com", "youtube-nocookie.com", "music.youtube.com"):
+        if parsed.path == "/watch":
+            video_id = parse_qs(parsed.query).get('v', [None])[0]
+        else:
+            parts = parsed.path.strip('/').split('/')
+            if len(parts) >= 2 and parts[0] in ("embed", "shorts", "live", "v"):
+                video_id = parts[1]
+    return video_id if video_id and VIDEO_ID.match(video_id) else None
+
+
+def youtube_loader(video_url: str) -> List[Any]:
+    from langchain_community.document_loaders import YoutubeLoader
+    return YoutubeLoader.from_youtube_url(video_url, add_video_info=True).load()
+
+
+class TranscriptFetcher:
+    # loader takes a video URL and returns documents with page_content and metadata, like YoutubeLoader.load()
+    def __init__(self, cache_dir: str, loader: Callable[[str], List[Any]] = None, max_workers: int = 4):
+        self.cache_dir = cache_dir
+        self.loader = loader or youtube_loader
+        self.max_workers = max(1, max_workers)
+        # One lock per video, so concurrent fetches of the same video load it once and the rest read the cache
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def video_lock(self, video_id: str) -> threading.Lock:
+        with self.locks_lock:
+            return self.locks.setdefault(video_id, threading.Lock())
+
+    def cache_path(self, video_id: str) -> str:
+        return os.path.join(self.cache_dir, f"{video_id}.json")
+
+    def load_cached(self, video_id: str) -> List[Dict[str, Any]]:
+        try:
+            with open(self.cache_path(video_id), 'r', encoding='utf-8') as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError):
+            return None
+
+    def save_cached(self, video_id: str, documents: List[Dict[str, Any]]) -> None:
+        tmp_path = f"{self.cache_path(video_id)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as json_file:
+            json.dump(documents, json_file)
+        os.replace(tmp_path, self.cache_path(video_id))
+
+    def fetch(self, video_id: str, folder_path: str, names: List[str] = None) -> Dict[str, Any]:
+        # names are the documents the item store gave the video's items; without them the files are named
+        # after the video title
+        result = {"video_id": video_id, "status": "cached", "file_paths": [], "seconds": 0.0, "error": None}
+        started = time.perf_counter()
+        with self.video_lock(video_id):
+            documents = self.load_cached(video_id)
+            if documents is None:
+                try:
+                    loaded = self.loader(f"https://www.youtube.com/watch?v={video_id}")
+                except Exception as e:
+                    logging.error(f"Error fetching transcript for YouTube video {video_id}: {e}")
+                    result.update(status="failed", error=str(e), seconds=time.perf_counter() - started)
+                    return result
+                documents = [{"page_content": doc.page_content, "metadata": dict(doc.metadata)} for doc in loaded]
+                self.save_cached(video_id, documents)
+                result["status"] = "fetched"
+
+        if names:
+            files = [(name, "\n".join(doc["page_content"] for doc in documents)) for name in names]
+        else:
+            files = [(sanitize_filename(doc["metadata"].get('title', 'untitled')), doc["page_content"]) for doc in documents]
+        for name, text in files:
+            file_path = os.path.join(folder_path, f"{name}.txt")
+            with open(file_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            result["file_paths"].append(file_path)
+        result["seconds"] = time.perf_counter() - started
+        logging.info(f"Processed YouTube video {video_id} ({result['status']})")
+        return result
+
+    def fetch_all(self, urls: List[str], folder_path: str, names: Dict[str, List[str]] = None) -> List[Dict[str, Any]]:
+        # names maps a URL to the documents its transcript is written as
+        results = []
+        video_ids = []
+        video_names = {}
+        for url in urls:
+            url = url.strip()
+            if not url:
+                continue
+            video_id = extract_video_id(url)
+            if not video_id:
+                logging.warning(f"Not a YouTube video URL: {url}")
+                results.append({"video_id": None, "url": url, "status": "invalid", "file_paths": [], "seconds": 0.0,
+                                "error": "unrecognised URL"})
+            else:
+                if video_id not in video_ids:
+                    video_ids.append(video_id)
+                for name in (names or {}).get(url, []):
+                    if name not in video_names.setdefault(video_id, []):
+                        video_names[video_id].append(name)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results.extend(executor.map(lambda video_id: self.fetch(video_id, folder_path, video_names.get(video_id)),
+                                        video_ids))
+
+        counts = {}
+        for result in results:
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+        logging.info(f"YouTube transcripts: {len(video_ids)} unique videos, {counts}")
+        return results
@@ -1,29 +1,151 @@
 import os
 import logging
-from pyzotero import zotero
-from dotenv import load_dotenv
-from logging_config import setup_logging
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from zotero_download import file_md5
+from metrics import Metrics
 
-# Load environment variables
-load_dotenv("../.env")
-
-# Setup logging
-setup_logging()
+def is_retryable(error: Exception) -> bool:
+    # pyzotero raises TooManyRequests for 429 and puts the status code in the message of other HTTP errors
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is None:
+        match = re.search(r'Code: (\d{3})', str(error))
+        status = int(match.group(1)) if match else None
+    if status is not None:
+        return status == 429 or status >= 500
+    return type(error).__name__ in ('TooManyRequests', 'ConnectionError', 'Timeout', 'ReadTimeout', 'ConnectTimeout')
 
 class ZoteroAttacher:
-    def __init__(self, api_key, group_id):
-        self.zotero = zotero.Zotero(group_id, 'group', api_key)
+    def __init__(self, api_key, group_id, endpoint: str = None, max_workers: int = 4, retries: int = 4,
+                 backoff: float = 1.0, metrics: Metrics = None):
+        self.api_key = api_key
+        self.group_id = group_id
+        # Point at a local server instead of api.zotero.org, e.g. for tests
+        self.endpoint = endpoint
+        self.max_workers = max(1, max_workers)
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics = metrics or Metrics(enabled=False)
+        self.local = threading.local()
+        self.zotero = self.new_zotero()
+
+    def new_zotero(self):
+        from pyzotero import zotero
+        client = zotero.Zotero(self.group_id, 'group', self.api_key)
+        if self.endpoint:
+            client.endpoint = self.endpoint
+        return client
+
+    def thread_zotero(self):
+        # pyzotero keeps the last response on the instance, so each upload thread gets its own
+        if not hasattr(self.local, 'zotero'):
+            self.local.zotero = self.new_zotero()
+        return self.local.zotero
+
+    def with_backoff(self, call, description: str, name: str):
+        for attempt in range(self.retries + 1):
+            try:
+                with self.metrics.timer("zotero_request_seconds", call=name):
+                    return call()
+            except Exception as e:
+                if attempt == self.retries or not is_retryable(e):
+                    raise
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                logging.warning(f"Retrying {description} in {delay:.1f}s after error: {e}")
+                self.metrics.inc("retries_total", call=name)
+                time.sleep(delay)
 
-    def attach_pdf_to_item(self, file_path: str, parent_id: str, is_youtube_video: bool) -> None:
+    def attach_pdf_to_item(self, file_path: str, parent_id: str, is_youtube_video: bool) -> bool:
         try:
             # Check if the item is a YouTube video
             if is_youtube_video:
                 response = self.zotero.attachment_simple([file_path], parentid=parent_id)
                 if 'success' in response:
                     logging.info(f"Successfully attached {file_path} to item {parent_id}")
+                    return True
                 else:
                     logging.warning(f"Failed to attach {file_path} to item {parent_id}: {response}")
             else:
                 logging.info(f"Skipped attaching {file_path} to item {parent_id} as it is not a YouTube video.")
         except Exception as e:
             logging.error(f"Error attaching {file_path} to item {parent_id}: {e}")
+        return False
+
+    def attachment_children(self, parent_id: str) -> list:
+        # Every page of the parent's children, not just the first
+        def list_children():
+            zotero = self.thread_zotero()
+            return zotero.everything(zotero.children(parent_id))
+        children = self.with_backoff(list_children, f"listing children of {parent_id}", "children")
+        return [child for child in children if child['data'].get('itemType') == 'attachment']
+
+    def create_attachments(self, parent_id: str, file_paths: List[str]) -> Dict[str, str]:
+        # Creates an attachment item per file and returns their keys by file path. Not retried: a create that
+        # failed on our side may still have gone through, and its items are picked up by the next attach
+        # instead of being created twice
+        template = self.with_backoff(lambda: self.thread_zotero().item_template("attachment", linkmode="imported_file"),
+                                     "fetching the attachment template", "template")
+        payload = [dict(template, title=os.path.basename(path), filename=os.path.basename(path),
+                        contentType="application/pdf") for path in file_paths]
+        with self.metrics.timer("zotero_request_seconds", call="create"):
+            response = self.thread_zotero().create_items(payload, parentid=parent_id)
+        return {file_paths[int(index)]: key for index, key in response.get('success', {}).items()}
+
+    def attach_files(self, parent_id: str, file_paths: List[str]) -> Dict[str, List[str]]:
+        result = {"attached": [], "skipped": [], "failed": []}
+        try:
+            children = self.attachment_children(parent_id)
+            existing = {child['data'].get('md5') for child in children}
+            # Attachment items an earlier upload created but never got a file into, by title
+            empty = {child['data'].get('title'): child['data']['key'] for child in children
+                     if not child['data'].get('md5') and child['data'].get('linkMode') == 'imported_file'}
+            keys = {}
+            to_create = []
+            for file_path in file_paths:
+                if file_md5(file_path) in existing:
+                    logging.info(f"Skipped {file_path}, already attached to item {parent_id}")
+                    result["skipped"].append(file_path)
+                elif os.path.basename(file_path) in empty:
+                    keys[file_path] = empty.pop(os.path.basename(file_path))
+                else:
+                    to_create.append(file_path)
+            if to_create:
+                keys.update(self.create_attachments(parent_id, to_create))
+            result["failed"].extend(path for path in to_create if path not in keys)
+            if not keys:
+                return result
+
+            # Only the upload is retried: the items already have keys, so pyzotero doesn't create them again,
+            # and a file that made it up before the error is reported as existing rather than sent twice
+            attachments = [{"key": key, "filename": file_path} for file_path, key in keys.items()]
+            self.with_backoff(lambda: self.thread_zotero().upload_attachments(
+                [dict(attachment) for attachment in attachments], parentid=parent_id),
+                f"upload to item {parent_id}", "upload")
+            result["attached"].extend(keys)
+            logging.info(f"Attached {len(result['attached'])} files to item {parent_id}")
+        except Exception as e:
+            logging.error(f"Error attaching {file_paths} to item {parent_id}: {e}")
+            result["failed"].extend(path for path in file_paths
+                                    if path not in result["skipped"] and path not in result["failed"])
+        if self.metrics.enabled:
+            for status, paths in result.items():
+                self.metrics.inc("attachments_total", len(paths), status=status)
+            self.metrics.inc("upload_bytes_total", sum(os.path.getsize(path) for path in result["attached"]))
+        return result
+
+    def attach_groups(self, groups: Dict[str, List[str]]) -> Dict[str, Dict[str, List[str]]]:
+        # groups maps parent item keys to the files to attach to them; parents are uploaded concurrently
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {parent_id: executor.submit(self.attach_files, parent_id, file_paths)
+                       for parent_id, file_paths in groups.items()}
+            results = {parent_id: future.result() for parent_id, future in futures.items()}
+
+        totals = {status: sum(len(result[status]) for result in results.values())
+                  for status in ("attached", "skipped", "failed")}
+        logging.info(f"Attach stage: {len(groups)} parent items, {totals['attached']} attached, "
+                     f"{totals['skipped']} already attached, {totals['failed']} failed")
+        return results
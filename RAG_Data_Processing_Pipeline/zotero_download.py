@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import os
+import random
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any
+
+
+def file_md5(file_path: str, buffer_size: int = 1024 * 1024) -> str:
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(buffer_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class AttachmentDownloader:
+    def __init__(self, zotero_client, max_workers: int = 4, retries: int = 3, backoff: float = 1.0,
+                 item_store=None):
+        self.zotero_client = zotero_client
+        # With an ItemStore, an attachment whose content another document already has locally is copied, not fetched
+        self.item_store = item_store
+        self.metrics = zotero_client.metrics
+        self.max_workers = max(1, max_workers)
+        self.retries = retries
+        self.backoff = backoff
+
+    def is_current(self, file_path: str, md5: str) -> bool:
+        return bool(md5) and os.path.exists(file_path) and file_md5(file_path) == md5
+
+    def local_copy(self, entry: Dict[str, Any], folder_path: str) -> str:
+        if not self.item_store or not entry.get("md5"):
+            return None
+        for document in self.item_store.documents_with_md5(entry["md5"]):
+            if document["file_name"] and document["file_name"] != entry["file_name"]:
+                file_path = os.path.join(folder_path, document["file_name"])
+                if self.is_current(file_path, entry["md5"]):
+                    return file_path
+        return None
+
+    def download(self, entry: Dict[str, Any], folder_path: str) -> Dict[str, Any]:
+        result = self.download_file(entry, folder_path)
+        # A failed document is kept in the item store, so the next sync fetches it again
+        if self.item_store and entry.get("document"):
+            self.item_store.set_failed([entry["document"]], result["status"] == "failed")
+        return result
+
+    def download_file(self, entry: Dict[str, Any], folder_path: str) -> Dict[str, Any]:
+        file_name = entry["file_name"]
+        file_path = os.path.join(folder_path, file_name)
+        result = {"file_name": file_name, "status": "skipped", "bytes": 0, "error": None}
+
+        # Zotero only reports an md5 on attachment items, parent documents are always fetched
+        if self.is_current(file_path, entry.get("md5")):
+            logging.info(f"Skipped {file_name}, local copy matches md5")
+            self.metrics.inc("downloads_total", status="skipped")
+            return result
+
+        copy_path = self.local_copy(entry, folder_path)
+        if copy_path:
+            shutil.copyfile(copy_path, file_path)
+            logging.info(f"Copied {file_name} from {os.path.basename(copy_path)}, which has the same md5")
+            self.metrics.inc("downloads_total", status="copied")
+            return result
+
+        for attempt in range(self.retries + 1):
+            try:
+                self.zotero_client.fetch_attachment(entry["item"], file_name, folder_path)
+                if entry.get("md5") and file_md5(file_path) != entry["md5"]:
+                    raise IOError(f"md5 mismatch for {file_name}")
+                result["status"] = "downloaded"
+                result["bytes"] = os.path.getsize(file_path)
+                logging.info("Downloaded: %s", file_name)
+                self.metrics.inc("downloads_total", status="downloaded")
+                self.metrics.inc("download_bytes_total", result["bytes"])
+                return result
+            except Exception as e:
+                result["error"] = str(e)
+                if attempt == self.retries:
+                    break
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                logging.warning(f"Retrying {file_name} in {delay:.1f}s after error: {e}")
+                self.metrics.inc("retries_total", call="download")
+                time.sleep(delay)
+
+        logging.error("Error downloading %s: %s", file_name, result["error"])
+        result["status"] = "failed"
+        self.metrics.inc("downloads_total", status="failed")
+        return result
+
+    def download_all(self, entries: List[Dict[str, Any]], folder_path: str) -> Dict[str, Any]:
+        started = time.perf_counter()
+        stats = {"downloaded": 0, "skipped": 0, "failed": 0, "bytes": 0}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.download, entry, folder_path) for entry in entries]
+            for future in as_completed(futures):
+                result = future.result()
+                stats[result["status"]] += 1
+                stats["bytes"] += result["bytes"]
+
+        stats["seconds"] = time.perf_counter() - started
+        stats["bytes_per_second"] = stats["bytes"] / stats["seconds"] if stats["seconds"] else 0.0
+        logging.info(f"Downloads: {stats['downloaded']} downloaded, {stats['skipped']} skipped, {stats['failed']} failed, "
+                     f"{stats['bytes'] / 1e6:.1f} MB in {stats['seconds']:.1f}s ({stats['bytes_per_second'] / 1e6:.2f} MB/s)")
+        return stats